@@ -0,0 +1,68 @@
+"""Benchmark reading transit handshakes.
+
+Simulates racing COUNT candidate connections: each socketpair carries a
+relay "ok" line, a peer handshake, and a "go", and we time how long it takes
+to read and check them all, and how many recv() calls that needs, comparing
+the old byte-at-a-time reader with transit.HandshakeReader.
+
+    python misc/bench_handshake.py [COUNT]
+"""
+from __future__ import print_function
+import sys, time, socket
+from wormhole.blocking import transit
+
+OK = b"ok max-bytes=10000000 max-seconds=60 max-rate=0\n"
+HANDSHAKE = transit.build_sender_handshake(b"k"*32) + b"go\n"
+
+class CountingSocket:
+    def __init__(self, skt):
+        self.skt = skt
+        self.recvs = 0
+    def recv(self, size):
+        self.recvs += 1
+        return self.skt.recv(size)
+
+def bytewise(skt):
+    # what connector() and handle() used to do
+    got = b""
+    while not got.endswith(b"\n"):
+        got += skt.recv(1)
+    got = b""
+    while len(got) < len(HANDSHAKE):
+        got += skt.recv(1)
+        if HANDSHAKE[:len(got)] != got:
+            raise transit.BadHandshake
+    return b""
+
+def buffered(skt):
+    r = transit.HandshakeReader(skt, "bench")
+    transit.parse_relay_response(r.read_line())
+    r.wait_for(HANDSHAKE)
+    return r.leftover()
+
+def run(reader, count):
+    pairs = [socket.socketpair() for i in range(count)]
+    for (a, b) in pairs:
+        a.sendall(OK + HANDSHAKE)
+    recvs = 0
+    start = time.time()
+    for (a, b) in pairs:
+        skt = CountingSocket(b)
+        reader(skt)
+        recvs += skt.recvs
+    elapsed = time.time() - start
+    for (a, b) in pairs:
+        a.close()
+        b.close()
+    return elapsed, recvs
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for (name, reader) in [("byte-at-a-time", bytewise),
+                           ("buffered", buffered)]:
+        elapsed, recvs = run(reader, count)
+        print("%-15s %6.1fus/handshake %5.1f recv()s/handshake"
+              % (name, 1e6*elapsed/count, float(recvs)/count))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Benchmark reading files for 'wormhole send'.
+
+Writes a SIZE MB file (unless FILE is given), then, each in a fresh process
+so peak RSS can be compared, pushes it through the sender's read+encrypt
+pipeline into a null sink: with buffered reads encrypted by SecretBox (as
+before the mmap reader), with buffered reads (read_chunks), and with the
+mmap reader (map_chunks). Drop the page cache between runs (echo 3 >
+/proc/sys/vm/drop_caches) to measure cold reads.
+
+    python misc/bench_mmap.py [SIZE_MB [RECORD_BYTES [FILE]]]
+"""
+from __future__ import print_function
+import os, sys, time, resource, subprocess
+
+KEY = b"k"*32
+
+def child(how, fn, record_size):
+    from wormhole.blocking import transit
+    from wormhole.blocking.transit import RecordPipe
+    from wormhole.blocking.pipeline import pipelined
+    from wormhole.scripts.cmd_send import read_chunks, map_chunks
+    class Sizer:
+        size = record_size
+    pipe = RecordPipe(None, KEY, KEY)
+    chunks = {"box": read_chunks, "read": read_chunks,
+              "mmap": map_chunks}[how]
+    if how == "box":
+        transit._lib = None
+    filesize = os.stat(fn).st_size
+    start = time.time()
+    with open(fn, "rb") as f:
+        for sealed in pipelined(chunks(f, filesize, Sizer()),
+                                [pipe.seal_record]):
+            pass
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # kB on linux
+    print("%-5s %7.1f MB/s  peak RSS %6.1f MB"
+          % (how, filesize / elapsed / 1e6, rss / 1e3))
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    record_size = int(sys.argv[2]) if len(sys.argv) > 2 else 256*1024
+    if len(sys.argv) > 3:
+        fn = sys.argv[3]
+    else:
+        fn = "bench_mmap.data"
+        with open(fn, "wb") as f:
+            block = os.urandom(1000*1000)
+            for i in range(size):
+                f.write(block)
+    try:
+        for how in ["box", "read", "mmap"]:
+            subprocess.check_call([sys.executable, __file__, "--child", how,
+                                   fn, str(record_size)])
+    finally:
+        if len(sys.argv) <= 3:
+            os.unlink(fn)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main()
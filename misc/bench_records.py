@@ -0,0 +1,125 @@
+"""Benchmark the transit record layer on its own.
+
+Receiving: a thread sends SIZE MB of RECORD-byte records over a loopback TCP
+connection with RecordPipe.send_record(), and we time how fast they can be
+received with RecordPipe.receive_record(), using the current ReceiveBuffer
+and the old one (which grew a bytes string 4kB at a time, then sliced it).
+
+Sending: a thread drains the connection, and we time the old send_record()
+(hex-built nonce and length, two send loops), the current one (struct, one
+sendmsg), and send_records() with batches of small records.
+
+    python misc/bench_records.py [SIZE_MB] [RECORD_BYTES]
+"""
+from __future__ import print_function
+import sys, time, socket, threading
+from binascii import unhexlify
+from wormhole.blocking import transit
+
+KEY = b"k"*32
+
+class OldReceiveBuffer:
+    def __init__(self, skt, initial=b"", recv_size=None):
+        self.skt = skt
+        self.buf = initial
+
+    def read(self, count):
+        while len(self.buf) < count:
+            more = self.skt.recv(4096)
+            if not more:
+                raise transit.TransitClosed
+            self.buf += more
+        rc = self.buf[:count]
+        self.buf = self.buf[count:]
+        return memoryview(rc)
+
+def old_send_record(self, record):
+    nonce = unhexlify("%048x" % self.send_nonce) # big-endian
+    self.send_nonce += 1
+    encrypted = self.send_box.encrypt(record, nonce)
+    length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
+    for data in [length, encrypted]:
+        sent = 0
+        while sent < len(data):
+            sent += self.skt.send(data[sent:])
+
+def connected_pair():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, _ = listener.accept()
+    listener.close()
+    return a, b
+
+def run(receive_buffer_class, size, record_size):
+    a, b = connected_pair()
+    sender = transit.RecordPipe(a, KEY, KEY)
+    receiver = transit.RecordPipe(b, KEY, KEY)
+    receiver.receive_buf = receive_buffer_class(b)
+    count = size // record_size
+    record = b"x" * record_size
+    def _send():
+        for i in range(count):
+            sender.send_record(record)
+    t = threading.Thread(target=_send)
+    start = time.time()
+    t.start()
+    for i in range(count):
+        receiver.receive_record()
+    elapsed = time.time() - start
+    t.join()
+    a.close()
+    b.close()
+    return count * record_size / elapsed / 1e6
+
+def drain(skt):
+    buf = bytearray(1024*1024)
+    while skt.recv_into(buf):
+        pass
+
+def run_send(how, size, record_size, batch=16):
+    a, b = connected_pair()
+    t = threading.Thread(target=drain, args=(b,))
+    t.start()
+    sender = transit.RecordPipe(a, KEY, KEY)
+    count = size // record_size
+    record = b"x" * record_size
+    start = time.time()
+    if how == "old":
+        for i in range(count):
+            old_send_record(sender, record)
+    elif how == "new":
+        for i in range(count):
+            sender.send_record(record)
+    else:
+        for i in range(count // batch):
+            sender.send_records([record] * batch)
+    elapsed = time.time() - start
+    a.close()
+    t.join()
+    b.close()
+    return count * record_size / elapsed / 1e6
+
+def main():
+    size = int(sys.argv[1]) * 1000*1000 if len(sys.argv) > 1 else 200*1000*1000
+    record_size = int(sys.argv[2]) if len(sys.argv) > 2 else 256*1024
+    for (name, cls) in [("old ReceiveBuffer", OldReceiveBuffer),
+                        ("ReceiveBuffer", transit.ReceiveBuffer)]:
+        print("receive, %-18s %7.1f MB/s" % (name, run(cls, size,
+                                                        record_size)))
+    for (name, how) in [("old send_record", "old"),
+                        ("send_record", "new"),
+                        ("send_records x16", "batched")]:
+        print("send, %s bytes, %-16s %7.1f MB/s"
+              % (record_size, name, run_send(how, size, record_size)))
+    # where batching matters: small records
+    small = size // 100
+    for (name, how) in [("old send_record", "old"),
+                        ("send_record", "new"),
+                        ("send_records x16", "batched")]:
+        print("send, 1000 bytes, %-16s %7.1f MB/s"
+              % (name, run_send(how, small, 1000)))
+
+if __name__ == "__main__":
+    main()
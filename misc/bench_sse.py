@@ -0,0 +1,75 @@
+"""Micro-benchmark for relay event-stream fan-out.
+
+Broadcasts messages to many event-stream subscribers of a single channel and
+reports how many transport writes each broadcast costs, and how many
+subscriber-events per second we can push, for the old per-line framing and
+the current frame-once framing.
+
+    python misc/bench_sse.py [SUBSCRIBERS] [MESSAGES]
+"""
+from __future__ import print_function
+import sys, time, json
+from twisted.web import http
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError: # Twisted < 19.7
+    from twisted.test.proto_helpers import StringTransport
+from wormhole.servers.relay_server import EventsProtocol, frame_event
+
+class CountingTransport(StringTransport):
+    writes = 0
+    def write(self, data):
+        self.writes += 1
+        self.clear() # don't let the buffer grow without bound
+    def writeSequence(self, seq):
+        self.writes += 1
+        self.clear()
+
+def make_subscriber():
+    channel = http.HTTPChannel()
+    transport = CountingTransport()
+    channel.makeConnection(transport)
+    request = http.Request(channel, False)
+    request.method = b"GET"
+    request.clientproto = b"HTTP/1.1"
+    request.setHeader(b"content-type", b"text/event-stream; charset=utf-8")
+    request.write(b"") # send the headers now, not during the benchmark
+    transport.writes = 0
+    return request, transport
+
+def legacy_send_event(request, data):
+    # the framing EventsProtocol.sendEvent used to do: one write per line,
+    # repeated for every subscriber
+    for line in data.splitlines():
+        request.write(b"data: " + line.encode("utf-8") + b"\n")
+    request.write(b"\n")
+
+def run(mode, subscribers, messages):
+    subs = [make_subscriber() for i in range(subscribers)]
+    eps = [EventsProtocol(request) for (request, _) in subs]
+    bodies = [json.dumps({"phase": "1", "body": "%064x" % i})
+              for i in range(messages)]
+    start = time.time()
+    for data in bodies:
+        if mode == "legacy":
+            for ep in eps:
+                legacy_send_event(ep.request, data)
+        else:
+            framed = frame_event(data.encode("utf-8"))
+            for ep in eps:
+                ep.sendFramedEvents(framed)
+    elapsed = time.time() - start
+    writes = sum([t.writes for (_, t) in subs])
+    events = subscribers * messages
+    print("%-7s %6d subscribers x %5d msgs: %5.2f transport writes/event,"
+          " %9.0f events/s" % (mode, subscribers, messages,
+                               1.0 * writes / events, events / elapsed))
+
+def main():
+    subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for mode in ["legacy", "framed"]:
+        run(mode, subscribers, messages)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark transit relay forwarding modes.
+
+For each forwarding mode, starts a transit relay in a subprocess, pushes
+SIZE bytes through a matched pair, and reports the relay's CPU time per GB
+(from /proc, so Linux only) and the throughput seen by the receiver.
+
+    python misc/bench_transit_forward.py [GB] [MODE..]
+"""
+from __future__ import print_function
+import os, sys, time, socket, threading, subprocess
+
+SERVER = """
+from twisted.internet import reactor, endpoints
+from wormhole.servers.transit_server import Transit
+t = Transit(max_length=0, max_time=0, forwarding=%r)
+endpoints.serverFromString(reactor, "tcp:%d:interface=127.0.0.1").listen(t)
+reactor.run()
+"""
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def cpu_seconds(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15, counting from 1 before the split
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+def connect(port, token):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(b"please relay " + token + b"\n")
+    return s
+
+def send(s, size):
+    chunk = memoryview(b"x" * (1024*1024))
+    sent = 0
+    while sent < size:
+        n = min(len(chunk), size - sent)
+        s.sendall(chunk[:n])
+        sent += n
+
+def receive(s, size):
+    buf = bytearray(1024*1024)
+    got = 0
+    while got < size:
+        n = s.recv_into(buf)
+        if not n:
+            raise EOFError("relay hung up after %d bytes" % got)
+        got += n
+
+def run(mode, size):
+    port = free_port()
+    relay = subprocess.Popen([sys.executable, "-c", SERVER % (mode, port)],
+                             stdout=open(os.devnull, "w"))
+    try:
+        time.sleep(1.0)
+        token = b"d" * 64
+        a = connect(port, token)
+        b = connect(port, token)
+        assert a.recv(3) == b"ok\n"
+        assert b.recv(3) == b"ok\n"
+        cpu_before = cpu_seconds(relay.pid)
+        start = time.time()
+        t = threading.Thread(target=send, args=(a, size))
+        t.start()
+        receive(b, size)
+        elapsed = time.time() - start
+        t.join()
+        cpu = cpu_seconds(relay.pid) - cpu_before
+        a.close()
+        b.close()
+    finally:
+        relay.terminate()
+    gb = size / 1e9
+    print("%-8s %5.1f GB: relay CPU %6.2fs/GB, %7.1f MB/s"
+          % (mode, gb, cpu / gb, size / elapsed / 1e6))
+
+def main():
+    gb = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    modes = sys.argv[2:] or ["reactor", "buffer", "splice"]
+    for mode in modes:
+        run(mode, int(gb * 1e9))
+
+if __name__ == "__main__":
+    main()
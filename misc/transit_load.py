@@ -0,0 +1,85 @@
+"""Load test for transit relay buffering.
+
+Starts a transit relay in a subprocess, then connects a sender that writes
+as fast as it can and a receiver that is throttled to a slow read rate.
+Samples the relay's resident memory once a second: with backpressure it
+should stay flat, rather than growing by (send rate - read rate).
+
+    python misc/transit_load.py [SECONDS] [RECEIVE_KBPS]
+"""
+from __future__ import print_function
+import sys, os, time, socket, subprocess, threading
+
+SERVER = """
+import sys
+from twisted.internet import reactor, endpoints
+from wormhole.servers.transit_server import Transit
+t = Transit()
+endpoints.serverFromString(reactor, "tcp:%d:interface=127.0.0.1").listen(t)
+reactor.run()
+"""
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def rss_kb(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+def connect(port, token):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.sendall(b"please relay " + token + b"\n")
+    return s
+
+def sender(s, stop):
+    chunk = b"x" * 65536
+    try:
+        while not stop.is_set():
+            s.sendall(chunk)
+    except socket.error:
+        pass
+
+def receiver(s, stop, kbps):
+    try:
+        while not stop.is_set():
+            s.recv(kbps * 1000 // 10)
+            time.sleep(0.1)
+    except socket.error:
+        pass
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    kbps = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    port = free_port()
+    relay = subprocess.Popen([sys.executable, "-c", SERVER % port],
+                             stdout=open(os.devnull, "w"))
+    time.sleep(1.0)
+    try:
+        token = b"b" * 64
+        a = connect(port, token)
+        b = connect(port, token)
+        assert a.recv(3) == b"ok\n"
+        stop = threading.Event()
+        threads = [threading.Thread(target=sender, args=(a, stop)),
+                   threading.Thread(target=receiver, args=(b, stop, kbps))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        print("receiver throttled to %dkB/s" % kbps)
+        for i in range(seconds):
+            time.sleep(1.0)
+            print("t=%2ds relay RSS: %6d kB" % (i+1, rss_kb(relay.pid)))
+        stop.set()
+        a.close()
+        b.close()
+    finally:
+        relay.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
 
+import sys
 from setuptools import setup
 
 import versioneer
 
 commands = versioneer.get_cmdclass()
 
+packages = ["wormhole",
+            "wormhole.blocking", "wormhole.twisted",
+            "wormhole.scripts", "wormhole.test", "wormhole.util",
+            "wormhole.servers"]
+if sys.version_info >= (3, 5):
+    # async/await
+    packages.append("wormhole.aio")
+
 setup(name="magic-wormhole",
       version=versioneer.get_version(),
       description="Securely transfer data between computers",
@@ -13,15 +22,14 @@ setup(name="magic-wormhole",
       license="MIT",
       url="https://github.com/warner/magic-wormhole",
       package_dir={"": "src"},
-      packages=["wormhole",
-                "wormhole.blocking", "wormhole.twisted",
-                "wormhole.scripts", "wormhole.test", "wormhole.util",
-                "wormhole.servers"],
+      packages=packages,
       package_data={"wormhole": ["db-schemas/*.sql"]},
       entry_points={"console_scripts":
                     ["wormhole = wormhole.scripts.runner:entry"]},
       install_requires=["spake2==0.3", "pynacl", "requests", "argparse",
-                        "six"],
+                        "six", 'selectors34; python_version < "3.4"'],
+      # faster codecs for compressed transfers (zlib is always there)
+      extras_require={"compression": ["zstandard", "lz4"]},
       test_suite="wormhole.test",
       cmdclass=commands,
       )
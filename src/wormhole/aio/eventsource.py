@@ -0,0 +1,49 @@
+from .http import open_request
+
+class EventSourceFollower:
+    # Like blocking.eventsource.EventSourceFollower: call open(), then
+    # next_event() until it returns None (when the server hangs up).
+    def __init__(self, url):
+        self.url = url
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        (_, self.reader, self.writer) = await open_request(
+            "GET", self.url, headers=[("Accept", "text/event-stream")])
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+    async def _next_field(self):
+        # the lines up to the next blank one, as (fieldname, data)
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return None # closed
+            line = line.decode("utf-8").rstrip("\r\n")
+            if not line:
+                if lines:
+                    break
+                continue
+            if line.startswith(":"):
+                continue # a comment, which keeps the connection alive
+            lines.append(line)
+        fieldname, _, data = lines[0].partition(": ")
+        return fieldname, "\n".join([data] + lines[1:])
+
+    async def next_event(self):
+        # returns (eventtype, data), or None once the server hangs up
+        eventtype = "message"
+        while True:
+            field = await self._next_field()
+            if field is None:
+                return None
+            (fieldname, data) = field
+            if fieldname == "data":
+                return (eventtype, data)
+            elif fieldname == "event":
+                eventtype = data
+            # "id" and "retry" mean nothing to us
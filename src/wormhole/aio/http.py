@@ -0,0 +1,80 @@
+import json, asyncio
+from urllib.parse import urlsplit
+from .. import __version__
+
+# Just enough HTTP for the rendezvous server, on asyncio streams, so we don't
+# need an HTTP library (or a thread per request). We speak HTTP/1.0, so the
+# server never sends us a chunked body: it's either Content-Length bytes, or
+# everything until the connection closes (which is how an event-stream
+# arrives).
+
+# the longest line we'll read: an event-stream line can carry a whole message
+MAX_LINE = 1024*1024
+
+class HTTPError(Exception):
+    pass
+
+async def open_request(method, url, body=None, headers=()):
+    # sends the request and reads the response's status and headers.
+    # Returns (headers, reader, writer), with the body left in 'reader'.
+    parts = urlsplit(url)
+    ssl = parts.scheme == "https"
+    port = parts.port or (443 if ssl else 80)
+    reader, writer = await asyncio.open_connection(parts.hostname, port,
+                                                   ssl=ssl or None,
+                                                   limit=MAX_LINE)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    lines = ["%s %s HTTP/1.0" % (method, path),
+             "Host: %s" % parts.netloc,
+             "User-Agent: magic-wormhole/%s" % __version__]
+    lines.extend("%s: %s" % header for header in headers)
+    if body is not None:
+        lines.append("Content-Length: %d" % len(body))
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if body:
+        writer.write(body)
+    try:
+        words = (await reader.readline()).split(None, 2)
+        if len(words) < 2 or not words[0].startswith(b"HTTP/"):
+            raise HTTPError("bad response from %s" % (url,))
+        status = int(words[1])
+        if not 200 <= status < 300:
+            raise HTTPError(status, url)
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+    except BaseException:
+        writer.close()
+        raise
+    return response_headers, reader, writer
+
+async def request_json(method, url, request_body=None):
+    # send a JSON body (if any) to a URL, parsing the response as JSON
+    body = None
+    headers = []
+    if request_body is not None:
+        body = json.dumps(request_body).encode("utf-8")
+        headers.append(("Content-Type", "application/json"))
+    response_headers, reader, writer = await open_request(method, url, body,
+                                                          headers)
+    try:
+        if "content-length" in response_headers:
+            length = int(response_headers["content-length"])
+            data = await reader.readexactly(length)
+        else:
+            data = await reader.read()
+    finally:
+        writer.close()
+    return json.loads(data.decode("utf-8"))
+
+def post_json(url, request_body):
+    return request_json("POST", url, request_body)
+
+def get_json(url):
+    return request_json("GET", url)
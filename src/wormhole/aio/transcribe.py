@@ -0,0 +1,131 @@
+import time, json, asyncio
+from .http import post_json, get_json
+from .eventsource import EventSourceFollower
+from .. import codes
+from ..errors import Timeout, UsageError
+from ..transcribe_common import ChannelCommon, WormholeCommon
+
+# The same client as blocking/transcribe.py, for asyncio programs: every
+# method that talks to the server is a coroutine. The rest, they both take
+# from transcribe_common.py. See blocking/transcribe.py for the relay URLs.
+
+class Channel(ChannelCommon):
+    async def send(self, phase, msg):
+        payload = self._outbound_message(phase, msg)
+        resp = await post_json(self._channel_url, payload)
+        self._add_inbound_messages(resp["messages"])
+
+    async def get(self, phase):
+        if not isinstance(phase, type(u"")): raise UsageError(type(phase))
+        # returns the first message for 'phase' that wasn't one of ours,
+        # either from those we've already seen, or from an EventSource that
+        # we attach to the channel's URL
+        body = self._find_inbound_message(phase)
+        while body is None:
+            remaining = self._started + self._timeout - time.time()
+            if remaining < 0:
+                raise Timeout
+            try:
+                body = await asyncio.wait_for(self._follow(phase), remaining)
+            except asyncio.TimeoutError:
+                raise Timeout
+            if body is None:
+                await asyncio.sleep(self._wait)
+        return body
+
+    async def _follow(self, phase):
+        # until the connection is lost (None), or we see the message we want
+        f = EventSourceFollower(self._channel_url)
+        await f.open()
+        try:
+            while True:
+                event = await f.next_event()
+                if event is None:
+                    return None
+                (eventtype, data) = event
+                if eventtype == "welcome":
+                    self._handle_welcome(json.loads(data))
+                if eventtype == "message":
+                    self._add_inbound_messages([json.loads(data)])
+                    body = self._find_inbound_message(phase)
+                    if body is not None:
+                        return body
+        finally:
+            f.close()
+
+    async def deallocate(self):
+        # only try once, no retries, and ignore failure
+        try:
+            await post_json(self._channel_url+"/deallocate",
+                            {"side": self._side})
+        except Exception:
+            pass
+
+class ChannelManager:
+    def __init__(self, relay, side, handle_welcome):
+        self._relay = relay
+        self._side = side
+        self._handle_welcome = handle_welcome
+
+    async def list_channels(self):
+        data = await get_json(self._relay + "list")
+        return data["channel-ids"]
+
+    async def allocate(self):
+        data = await post_json(self._relay + "allocate",
+                               {"side": self._side})
+        if "welcome" in data:
+            self._handle_welcome(data["welcome"])
+        return data["channel-id"]
+
+    def connect(self, channel_id):
+        return Channel(self._relay, channel_id, self._side,
+                       self._handle_welcome)
+
+class Wormhole(WormholeCommon):
+    def __init__(self, appid, relay):
+        WormholeCommon.__init__(self, appid, relay)
+        self._channel_manager = ChannelManager(relay, self.side,
+                                               self.handle_welcome)
+        self._started_get_code = False
+
+    async def get_code(self, code_length=2):
+        if self.code is not None: raise UsageError
+        if self._started_get_code: raise UsageError
+        self._started_get_code = True
+        channel_id = await self._channel_manager.allocate()
+        code = codes.make_code(channel_id, code_length)
+        assert isinstance(code, str), type(code)
+        self._set_code_and_channel_id(code)
+        self._start()
+        return code
+
+    async def _get_key(self):
+        if not self.key:
+            await self.channel.send(u"pake", self.msg1)
+            self._got_pake(await self.channel.get(u"pake"))
+
+    async def get_verifier(self):
+        self._check_ready()
+        await self._get_key()
+        return self.verifier
+
+    async def send_data(self, outbound_data):
+        if self._sent_data: raise UsageError # only call this once
+        if not isinstance(outbound_data, type(b"")): raise UsageError
+        self._check_ready()
+        self._sent_data = True
+        await self._get_key()
+        await self.channel.send(u"data", self._seal_data(outbound_data))
+
+    async def get_data(self):
+        if self._got_data: raise UsageError # only call this once
+        self._check_ready()
+        self._got_data = True
+        await self._get_key()
+        return self._open_data(await self.channel.get(u"data"))
+
+    async def close(self):
+        await self.channel.deallocate()
+        self._closed = True
+
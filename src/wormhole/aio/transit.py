@@ -0,0 +1,227 @@
+import struct, asyncio
+from nacl.secret import SecretBox
+from ..errors import UsageError
+from ..transit_common import (TransitCommon, BadHandshake, LegacyRelay,
+                              build_relay_handshake, parse_relay_response,
+                              parse_hint_tcp, rank_hint, make_nonce)
+from ..blocking.transit import (TransitError, TransitClosed, BadNonce,
+                                RECORD_OVERHEAD, TIMEOUT, STAGGER,
+                                RELAY_DELAY, INBOUND_GRACE)
+
+# The same transit as blocking/transit.py (and so, the same handshakes and
+# records on the wire, which both take from transit_common.py), for asyncio
+# programs: connect() is a coroutine that races our outbound connections
+# against inbound ones, and the RecordPipe it returns has coroutines to send
+# and receive records. See those two for the details of the protocol, and
+# of how the race is run.
+
+class RecordPipe:
+    def __init__(self, reader, writer, send_key, receive_key,
+                 max_record_size=None):
+        self.reader = reader
+        self.writer = writer
+        self.send_box = SecretBox(send_key)
+        self.send_nonce = 0
+        self.max_record_size = max_record_size
+        self.receive_box = SecretBox(receive_key)
+        self.next_receive_nonce = 0
+
+    async def send_record(self, record):
+        if not isinstance(record, type(b"")): raise UsageError
+        assert len(record) < 2**(8*4)
+        nonce = make_nonce(self.send_nonce)
+        self.send_nonce += 1
+        encrypted = self.send_box.encrypt(record, nonce)
+        self.writer.write(struct.pack(">L", len(encrypted)))
+        self.writer.write(encrypted)
+        await self.writer.drain()
+
+    async def receive_record(self):
+        try:
+            header = await self.reader.readexactly(4)
+            (length,) = struct.unpack(">L", header)
+            if (self.max_record_size
+                and length > self.max_record_size + RECORD_OVERHEAD):
+                raise TransitError("record of %d bytes exceeds the %d we "
+                                   "agreed" % (length - RECORD_OVERHEAD,
+                                               self.max_record_size))
+            encrypted = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise TransitClosed
+        nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
+        if nonce_buf != make_nonce(self.next_receive_nonce):
+            raise BadNonce("received out-of-order record")
+        self.next_receive_nonce += 1
+        return self.receive_box.decrypt(encrypted)
+
+    def close(self):
+        self.writer.close()
+
+async def read_expected(reader, expected, description):
+    # like HandshakeReader.wait_for(): we hang up at the first wrong byte,
+    # and never read past 'expected', so the first record stays in 'reader'
+    got = b""
+    while len(got) < len(expected):
+        more = await reader.read(len(expected) - len(got))
+        if not more:
+            raise BadHandshake("disconnect after merely '%r' on %s"
+                               % (got, description))
+        got += more
+        if expected[:len(got)] != got:
+            raise BadHandshake("got '%r' want '%r' on %s"
+                               % (got, expected, description))
+
+class Common(TransitCommon):
+    def describe(self):
+        if not self.winning_description:
+            return "not yet established"
+        return self.winning_description
+
+    async def connect(self, max_record_size=None):
+        (reader, writer) = await self.establish_connection()
+        return RecordPipe(reader, writer, self._sender_record_key(),
+                          self._receiver_record_key(), max_record_size)
+
+    async def establish_connection(self):
+        # returns the winner's (reader, writer)
+        loop = asyncio.get_event_loop()
+        self.winning_description = None
+        self.relay_limits = None
+        self._won = loop.create_future()
+        self._attempts = set()
+        self.listener.setblocking(False)
+        server = await asyncio.start_server(self._accepted,
+                                            sock=self.listener)
+        outbound = asyncio.ensure_future(self._outbound())
+        try:
+            winner = await asyncio.wait_for(self._wait_for_winner(outbound),
+                                            2*TIMEOUT)
+        except asyncio.TimeoutError:
+            winner = None
+        finally:
+            # the losers, and the listener, go away right now
+            outbound.cancel()
+            for attempt in self._attempts:
+                attempt.cancel()
+            server.close()
+        if not winner:
+            raise TransitError
+        (reader, writer, description, limits) = winner
+        self.winning_description = description
+        self.relay_limits = limits
+        return reader, writer
+
+    async def _wait_for_winner(self, outbound):
+        await asyncio.wait([self._won, outbound],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not self._won.done():
+            # everything we tried has failed: they have a little while to
+            # reach us, or longer if they're already in the middle of it
+            await asyncio.wait([self._won], timeout=INBOUND_GRACE)
+            while not self._won.done() and self._attempts:
+                await asyncio.wait([self._won] + list(self._attempts),
+                                   return_when=asyncio.FIRST_COMPLETED)
+        if self._won.done():
+            return self._won.result()
+        return None
+
+    def _start(self, coro):
+        attempt = asyncio.ensure_future(coro)
+        self._attempts.add(attempt)
+        attempt.add_done_callback(self._attempts.discard)
+        return attempt
+
+    async def _outbound(self):
+        # direct hints best first, each STAGGER after the last (or as soon
+        # as it fails), and the relay after RELAY_DELAY, or once there are
+        # no direct hints left
+        loop = asyncio.get_event_loop()
+        relay_at = loop.time() + RELAY_DELAY
+        hints = sorted(self._their_direct_hints,
+                       key=lambda hint: rank_hint(hint, self.my_addresses))
+        direct = []
+        for hint in hints:
+            direct.append(self._start(self._connect(hint, False)))
+            await asyncio.wait(direct[-1:], timeout=STAGGER)
+        remaining = relay_at - loop.time()
+        if direct and remaining > 0:
+            await asyncio.wait(direct, timeout=remaining)
+        relays = [self._start(self._connect(hint, True))
+                  for hint in self._their_relay_hints]
+        if direct + relays:
+            await asyncio.wait(direct + relays)
+
+    async def _connect(self, hint, is_relay, with_limits=True):
+        parsed_hint = parse_hint_tcp(hint)
+        if not parsed_hint:
+            return # unparseable
+        addr, port = parsed_hint
+        description = "->%s" % (hint,)
+        if is_relay:
+            description = "->relay:%s" % (hint,)
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(addr, port), TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return
+        relay_handshake = None
+        if is_relay:
+            relay_handshake = build_relay_handshake(self._transit_key,
+                                                    with_limits)
+        try:
+            await self._handshake(reader, writer, description,
+                                  relay_handshake)
+        except LegacyRelay:
+            # it refused "with-limits": ask again, the old way
+            await self._connect(hint, True, with_limits=False)
+
+    def _accepted(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        description = "<-tcp:%s:%d" % (peer[0], peer[1])
+        self._start(self._handshake(reader, writer, description))
+
+    async def _handshake(self, reader, writer, description,
+                         relay_handshake=None):
+        won = False
+        try:
+            won = await asyncio.wait_for(
+                self._negotiate(reader, writer, description,
+                                relay_handshake), TIMEOUT)
+        except LegacyRelay:
+            raise # _connect() asks again
+        except (OSError, BadHandshake, asyncio.TimeoutError):
+            pass
+        finally:
+            if not won:
+                writer.close()
+
+    async def _negotiate(self, reader, writer, description, relay_handshake):
+        limits = None
+        if relay_handshake:
+            writer.write(relay_handshake)
+            line = await reader.readline()
+            if not line.endswith(b"\n"):
+                raise BadHandshake("relay hung up on %s" % (description,))
+            try:
+                limits = parse_relay_response(line)
+            except BadHandshake:
+                if relay_handshake.endswith(b" with-limits\n"):
+                    raise LegacyRelay("relay said '%r' on %s"
+                                      % (line, description))
+                raise
+        writer.write(self._send_this())
+        # for the receiver, the expected handshake includes the "go\n"
+        await read_expected(reader, self._expect_this(), description)
+        if self._won.done():
+            return False
+        if self.is_sender:
+            # the first one wins and gets a "go". The rest are closed.
+            writer.write(b"go\n")
+        self._won.set_result((reader, writer, description, limits))
+        return True
+
+class TransitSender(Common):
+    is_sender = True
+
+class TransitReceiver(Common):
+    is_sender = False
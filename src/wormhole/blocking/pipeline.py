@@ -0,0 +1,99 @@
+from __future__ import print_function
+import sys, threading
+import six
+from six.moves import queue
+
+# A pipeline runs the steps of a transfer (e.g. read, encrypt, send) in
+# separate threads connected by bounded queues, so the disk, the crypto (nacl
+# releases the GIL), and the network can all be busy at once, while at most
+# DEPTH items wait between any two steps.
+
+DEPTH = 4
+POLL = 0.1 # how often blocked threads check whether the consumer went away
+
+class _End:
+    pass
+_END = _End()
+
+class _Failed:
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class _Stopped(Exception):
+    pass
+
+def pipelined(source, functions=(), depth=DEPTH):
+    """Yield f_n(..f_1(item)) for each item of the 'source' iterable, in
+    order. 'source' is consumed in one thread, each function runs in a
+    thread of its own, and whatever consumes our output is the last stage.
+    An exception raised in any thread is re-raised here, after the results
+    that preceded it. If the consumer stops early, the threads shut down
+    (although one stuck in a blocking call will linger until it returns)."""
+    stopping = threading.Event()
+    queues = [queue.Queue(depth) for i in range(len(functions)+1)]
+
+    def put(q, item):
+        while not stopping.is_set():
+            try:
+                q.put(item, timeout=POLL)
+                return
+            except queue.Full:
+                pass
+        raise _Stopped
+
+    def get(q):
+        while True:
+            try:
+                return q.get(timeout=POLL)
+            except queue.Empty:
+                if stopping.is_set():
+                    raise _Stopped
+
+    def produce(outbox):
+        try:
+            try:
+                for item in source:
+                    put(outbox, item)
+            except _Stopped:
+                return
+            except BaseException:
+                put(outbox, _Failed(sys.exc_info()))
+                return
+            put(outbox, _END)
+        except _Stopped:
+            pass
+
+    def process(function, inbox, outbox):
+        try:
+            while True:
+                item = get(inbox)
+                if isinstance(item, (_End, _Failed)):
+                    put(outbox, item)
+                    return
+                try:
+                    result = function(item)
+                except BaseException:
+                    put(outbox, _Failed(sys.exc_info()))
+                    return
+                put(outbox, result)
+        except _Stopped:
+            pass
+
+    threads = [threading.Thread(target=produce, args=(queues[0],))]
+    for (i, function) in enumerate(functions):
+        threads.append(threading.Thread(target=process,
+                                        args=(function, queues[i],
+                                              queues[i+1])))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while True:
+            item = get(queues[-1])
+            if isinstance(item, _End):
+                return
+            if isinstance(item, _Failed):
+                six.reraise(*item.exc_info)
+            yield item
+    finally:
+        stopping.set()
@@ -1,57 +1,29 @@
 from __future__ import print_function
-import re, time, threading, socket
-from six.moves import socketserver
-from binascii import hexlify, unhexlify
+import os, time, errno, socket, struct, threading
+from six.moves import queue
+try:
+    import selectors
+except ImportError: # py2
+    import selectors34 as selectors
 from nacl.secret import SecretBox
-from ..util import ipaddrs
-from ..util.hkdf import HKDF
+try:
+    # PyNaCl's own binding to libsodium, which can encrypt straight out of
+    # any buffer (e.g. a memoryview of a mapped file) and into the one we
+    # send, where SecretBox copies its input and its output
+    from nacl._sodium import ffi as _ffi, lib as _lib
+    if not hasattr(_lib, "crypto_secretbox_easy"):
+        _lib = None
+except ImportError: # older PyNaCl
+    _lib = None
 from ..errors import UsageError
+from ..transit_common import (TransitCommon, BadHandshake, LegacyRelay,
+                              stream_key, build_relay_handshake,
+                              parse_relay_response, parse_hint_tcp,
+                              rank_hint, make_nonce)
 
 class TransitError(Exception):
     pass
 
-# The beginning of each TCP connection consists of the following handshake
-# messages. The sender transmits the same text regardless of whether it is on
-# the initiating/connecting end of the TCP connection, or on the
-# listening/accepting side. Same for the receiver.
-#
-#  sender -> receiver: transit sender TXID_HEX ready\n\n
-#  receiver -> sender: transit receiver RXID_HEX ready\n\n
-#
-# Any deviations from this result in the socket being closed. The handshake
-# messages are designed to provoke an invalid response from other sorts of
-# servers (HTTP, SMTP, echo).
-#
-# If the sender is satisfied with the handshake, and this is the first socket
-# to complete negotiation, the sender does:
-#
-#  sender -> receiver: go\n
-#
-# and the next byte on the wire will be from the application.
-#
-# If this is not the first socket, the sender does:
-#
-#  sender -> receiver: nevermind\n
-#
-# and closes the socket.
-
-# So the receiver looks for "transit sender TXID_HEX ready\n\ngo\n" and hangs
-# up upon the first wrong byte. The sender lookgs for "transit receiver
-# RXID_HEX ready\n\n" and then makes a first/not-first decision about sending
-# "go\n" or "nevermind\n"+close().
-
-def build_receiver_handshake(key):
-    hexid = HKDF(key, 32, CTXinfo=b"transit_receiver")
-    return b"transit receiver "+hexlify(hexid)+b" ready\n\n"
-
-def build_sender_handshake(key):
-    hexid = HKDF(key, 32, CTXinfo=b"transit_sender")
-    return b"transit sender "+hexlify(hexid)+b" ready\n\n"
-
-def build_relay_handshake(key):
-    token = HKDF(key, 32, CTXinfo=b"transit_relay_token")
-    return b"please relay "+hexlify(token)+b"\n"
-
 TIMEOUT=15
 
 # 1: sender only transmits, receiver only accepts, both wait forever
@@ -60,52 +32,106 @@ TIMEOUT=15
 # 4: add relay
 # 5: accelerate shutdown of losing sockets
 
-
-class BadHandshake(Exception):
-    pass
+IOV_MAX = 1024 # the smallest limit on buffers per sendmsg() we know of
 
 def send_to(skt, data):
-    sent = 0
-    while sent < len(data):
-        sent += skt.send(data[sent:])
-
-def wait_for(skt, expected, description):
-    got = b""
-    while len(got) < len(expected):
-        got += skt.recv(1)
+    skt.sendall(data)
+
+def send_vectored(skt, buffers):
+    # send several buffers with as few syscalls as possible, and without
+    # joining them into one string first
+    if not hasattr(skt, "sendmsg"): # py2, windows
+        skt.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    while buffers:
+        sent = skt.sendmsg(buffers[:IOV_MAX])
+        # drop whatever made it out, which may end partway through a buffer
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+class HandshakeReader:
+    # I read the handshake messages a chunk at a time, instead of a byte at a
+    # time, and check each prefix as it arrives, so a bad peer is still
+    # rejected at its first wrong byte. Whatever arrives after the handshake
+    # (e.g. the first record, right behind the sender's "go\n") is left in
+    # the buffer, for leftover() to hand to the RecordPipe. Bytes can also be
+    # fed in from elsewhere: the check_*() methods never touch the socket,
+    # and return None/False until enough has arrived.
+    CHUNK_SIZE = 4096
+
+    def __init__(self, skt, description):
+        self.skt = skt
+        self.description = description
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def fill(self):
+        more = self.skt.recv(self.CHUNK_SIZE)
+        if not more:
+            raise BadHandshake("disconnect after merely '%r' on %s" %
+                               (bytes(self.buf), self.description))
+        self.buf += more
+
+    def check_for(self, expected):
+        got = self.buf[:len(expected)]
         if expected[:len(got)] != got:
             raise BadHandshake("got '%r' want '%r' on %s" %
-                               (got, expected, description))
-
-# The hint format is: TYPE,VALUE= /^([a-zA-Z0-9]+):(.*)$/ . VALUE depends
-# upon TYPE, and it can have more colons in it. For TYPE=tcp (the only one
-# currently defined), ADDR,PORT = /^(.*):(\d+)$/ , so ADDR can have colons.
-# ADDR can be a hostname, ipv4 dotted-quad, or ipv6 colon-hex. If the hint
-# publisher wants anonymity, their only hint's ADDR will end in .onion .
-
-def parse_hint_tcp(hint):
-    assert isinstance(hint, str)
-    # return tuple or None for an unparseable hint
-    mo = re.search(r'^([a-zA-Z0-9]+):(.*)$', hint)
-    if not mo:
-        print("unparseable hint '%s'" % (hint,))
-        return None
-    hint_type = mo.group(1)
-    if hint_type != "tcp":
-        print("unknown hint type '%s' in '%s'" % (hint_type, hint))
-        return None
-    hint_value = mo.group(2)
-    mo = re.search(r'^(.*):(\d+)$', hint_value)
-    if not mo:
-        print("unparseable TCP hint '%s'" % (hint,))
-        return None
-    hint_host = mo.group(1)
-    try:
-        hint_port = int(mo.group(2))
-    except ValueError:
-        print("non-numeric port in TCP hint '%s'" % (hint,))
+                               (bytes(got), expected, self.description))
+        if len(got) < len(expected):
+            return False
+        del self.buf[:len(expected)]
+        return True
+
+    def check_for_any(self, candidates):
+        # like check_for(), when any one of 'candidates' would do. Returns
+        # the one that arrived.
+        possible = False
+        for expected in candidates:
+            got = self.buf[:len(expected)]
+            if expected[:len(got)] != got:
+                continue
+            if len(got) == len(expected):
+                del self.buf[:len(expected)]
+                return expected
+            possible = True
+        if not possible:
+            raise BadHandshake("got '%r' on %s, which matches nothing"
+                               % (bytes(self.buf[:100]), self.description))
         return None
-    return hint_host, hint_port
+
+    def check_line(self, maxlength=200):
+        eol = self.buf.find(b"\n", 0, maxlength)
+        if eol == -1:
+            if len(self.buf) >= maxlength:
+                raise BadHandshake("overlong line '%r' on %s" %
+                                   (bytes(self.buf), self.description))
+            return None
+        line = bytes(self.buf[:eol+1])
+        del self.buf[:eol+1]
+        return line
+
+    def wait_for(self, expected):
+        while not self.check_for(expected):
+            self.fill()
+
+    def read_line(self, maxlength=200):
+        while True:
+            line = self.check_line(maxlength)
+            if line is not None:
+                return line
+            self.fill()
+
+    def leftover(self):
+        data = bytes(self.buf)
+        self.buf = bytearray()
+        return data
 
 def debug(msg):
     if False:
@@ -113,102 +139,456 @@ def debug(msg):
 def since(start):
     return time.time() - start
 
-def connector(owner, hint, description,
-              send_handshake, expected_handshake, relay_handshake=None):
-    start = time.time()
-    parsed_hint = parse_hint_tcp(hint)
-    if not parsed_hint:
-        return # unparseable
-    addr,port = parsed_hint
-    skt = None
-    debug("+ connector(%s)" % hint)
-    try:
-        skt = socket.create_connection((addr,port),
-                                       TIMEOUT) # timeout or ECONNREFUSED
-        skt.settimeout(TIMEOUT)
-        debug(" - socket(%s) connected CT+%.1f" % (description, since(start)))
-        if relay_handshake:
-            debug(" - sending relay_handshake")
-            send_to(skt, relay_handshake)
-            wait_for(skt, "ok\n", description)
-            debug(" - relay ready CT+%.1f" % (since(start),))
-        send_to(skt, send_handshake)
-        wait_for(skt, expected_handshake, description)
-        debug(" + connector(%s) ready CT+%.1f" % (hint, since(start)))
-    except Exception as e:
-        debug(" - timeout(%s) CT+%.1f" % (hint, since(start)))
+# Connection racing: instead of a thread for each hint (and another for
+# each inbound connection), one loop, in the thread that called connect(),
+# drives every outbound connect(), every accept() on our listening socket,
+# and all of their handshakes, with non-blocking sockets and a selector. The
+# first connection to complete its handshake wins, and all the others are
+# closed right then.
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+                getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+
+class Attempt:
+    # One connection we might end up using, driven by Racer. send_handshake
+    # is sent (after the relay's "ok" line, for relay connections) while we
+    # wait for expected_handshake. We're finished once it has arrived and
+    # ours has gone out, and anything after it is in reader.leftover(). An
+    # inbound connection for one of several streams is given 'choices'
+    # instead: {their handshake: (stream, ours, what else they'll send)}.
+
+    def __init__(self, skt, description, send_handshake, expected_handshake,
+                 relay_handshake=None, connecting=False, hint=None,
+                 is_relay=False, stream=0, choices=None, with_limits=False,
+                 address=None):
+        self.skt = skt
+        self.address = address # the getaddrinfo() entry we connected to
+        self.stream = stream
+        self.choices = choices
+        self.description = description
+        self.hint = hint
+        self.is_relay = is_relay
+        self.outbound = connecting
+        self.connecting = connecting
+        self.send_handshake = send_handshake
+        self.expected_handshake = expected_handshake
+        self.reader = HandshakeReader(skt, description)
+        self.relay_limits = None
+        self.with_limits = with_limits
+        self.waiting_for_relay = bool(relay_handshake)
+        self.outbuf = relay_handshake or send_handshake or b""
+        self.got_handshake = False
+        self.finished = False
+        self.deadline = time.time() + TIMEOUT
+
+    def events(self):
+        if self.connecting or self.outbuf:
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def writable(self):
+        if self.connecting:
+            err = self.skt.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.connecting = False
+            debug(" - socket(%s) connected" % (self.description,))
+        if self.outbuf:
+            try:
+                sent = self.skt.send(self.outbuf)
+            except socket.error as e:
+                if e.args[0] in _IN_PROGRESS:
+                    return
+                raise
+            self.outbuf = self.outbuf[sent:]
+            self.finished = self.got_handshake and not self.outbuf
+
+    def readable(self):
+        if self.connecting:
+            # a refused connect() shows up as readable (EOF) on some systems
+            self.writable()
         try:
-            if skt:
-                skt.shutdown(socket.SHUT_WR)
-        except socket.error:
-            pass
-        if skt:
-            skt.close()
-        # ignore socket errors, warn about coding errors
-        if not isinstance(e, (socket.error, socket.timeout, BadHandshake)):
+            data = self.skt.recv(HandshakeReader.CHUNK_SIZE)
+        except socket.error as e:
+            if e.args[0] in _IN_PROGRESS:
+                return
             raise
-        debug(" - notifying owner._connector_failed(%s) CT+%.1f" % (hint, since(start)))
-        owner._connector_failed(hint)
-        return
-    # owner is now responsible for the socket
-    owner._negotiation_finished(skt, description) # note thread
+        if not data:
+            raise BadHandshake("disconnect after merely '%r' on %s" %
+                               (bytes(self.reader.buf), self.description))
+        self.reader.feed(data)
+        if self.waiting_for_relay:
+            line = self.reader.check_line()
+            if line is None:
+                return
+            try:
+                self.relay_limits = parse_relay_response(line)
+            except BadHandshake:
+                if self.with_limits:
+                    raise LegacyRelay("relay said '%r' on %s"
+                                      % (line, self.description))
+                raise
+            debug(" - relay ready (%s)" % (self.description,))
+            self.waiting_for_relay = False
+            self.outbuf += self.send_handshake
+        if self.choices:
+            theirs = self.reader.check_for_any(self.choices)
+            if theirs is None:
+                return
+            (self.stream, ours, self.expected_handshake) = self.choices[theirs]
+            self.choices = None
+            self.outbuf += ours
+        if (not self.got_handshake
+            and self.reader.check_for(self.expected_handshake)):
+            self.got_handshake = True
+            self.finished = not self.outbuf
 
-def handle(skt, client_address, owner, description,
-           send_handshake, expected_handshake):
-    try:
-        debug("handle %r" %  (skt,))
-        skt.settimeout(TIMEOUT)
-        send_to(skt, send_handshake)
-        got = b""
-        # for the receiver, this includes the "go\n"
-        while len(got) < len(expected_handshake):
-            more = skt.recv(1)
-            if not more:
-                raise BadHandshake("disconnect after merely '%r'" % got)
-            got += more
-            if expected_handshake[:len(got)] != got:
-                raise BadHandshake("got '%r' want '%r'" %
-                                   (got, expected_handshake))
-        debug("handler negotiation finished %r" % (client_address,))
-    except Exception as e:
-        debug("handler failed %r" % (client_address,))
+    def close(self):
         try:
-            # this raises socket.err(EBADF) if the socket was already closed
-            skt.shutdown(socket.SHUT_WR)
+            self.skt.close()
         except socket.error:
             pass
-        skt.close() # this appears to be idempotent
-        # ignore socket errors, warn about coding errors
-        if not isinstance(e, (socket.error, socket.timeout, BadHandshake)):
-            raise
-        return
-    # owner is now responsible for the socket
-    owner._negotiation_finished(skt, description) # note thread
-
-class MyTCPServer(socketserver.TCPServer):
-    allow_reuse_address = True
-
-    def process_request(self, request, client_address):
-        description = "<-tcp:%s:%d" % (client_address[0], client_address[1])
-        kc = self.owner._have_transit_key
-        kc.acquire()
-        while not self.owner._transit_key:
-            kc.wait()
-        # owner._transit_key is either None or set to a value. We don't
-        # modify it from here, so we can release the condition lock before
-        # grabbing the key.
-        kc.release()
-
-        # Once it is set, we can get handler_(send|receive)_handshake, which
-        # is what we actually care about.
-        t = threading.Thread(target=handle,
-                             args=(request, client_address,
-                                   self.owner, description,
-                                   self.owner.handler_send_handshake,
-                                   self.owner.handler_expected_handshake))
-        t.daemon = True
+
+# Like "Happy Eyeballs" (RFC 8305), we don't start every outbound attempt at
+# once. Direct hints are tried in order of how likely they are to work (see
+# rank_hint), each STAGGER seconds after the last, or as soon as the last
+# one fails. The relay isn't kept waiting for all of them to give up (which
+# could take TIMEOUT, behind a firewall that drops SYNs): it starts
+# RELAY_DELAY seconds into the race regardless, or as soon as there are no
+# direct hints left to try.
+STAGGER = 0.25
+RELAY_DELAY = 1.0
+# Once all of our own attempts have failed, there's no point waiting out the
+# full timeout: we only give the other side this long to reach our listener,
+# since its attempts started at about the same time as ours.
+INBOUND_GRACE = 5.0
+# how long we wait for the rest of the streams, once stream 0 is up
+STREAM_WAIT = 2.0
+# the most streams a receiver agrees to
+MAX_STREAMS = 8
+
+class _Lookup:
+    # a hint's hostname, being resolved for Racer._connect()
+    def __init__(self, hint, is_relay, stream, with_limits):
+        self.hint = hint
+        self.is_relay = is_relay
+        self.stream = stream
+        self.with_limits = with_limits
+        self.deadline = time.time() + TIMEOUT
+
+_WAKEUP = object() # the selector key of Racer's wakeup socket
+
+class Racer:
+    # Call add_listener() and start_outbound() to set up the race, then
+    # run() to drive it until a winning Attempt is returned (or None, when
+    # time runs out, or there's nothing left to wait for).
+    #
+    # A hint with a hostname (the relay's usually has one) is resolved on a
+    # thread of its own, since getaddrinfo() blocks, and the results come
+    # back through self.resolved and the wakeup socket. Every address it
+    # resolves to gets an Attempt, and the first of those to connect is the
+    # one we keep.
+
+    def __init__(self, owner, selector=None):
+        self.owner = owner
+        self.selector = selector or selectors.DefaultSelector()
+        self.attempts = set()
+        self.direct_outbound = set()
+        self.relays_started = False
+        self.listener = None
+        self.pending = [] # direct hints not yet tried, best first
+        self.next_start = None
+        self.relay_at = None
+        self.give_up_at = None
+        self.choices = None # what to expect from inbound extra streams
+        self.lookups = set()
+        self.resolved = queue.Queue() # (lookup, getaddrinfo() results)
+        self.wakeup = self._wakeup_w = None
+
+    def add_listener(self, listener):
+        listener.setblocking(False)
+        self.listener = listener
+        self.selector.register(listener, selectors.EVENT_READ, None)
+
+    def start_outbound(self, my_addresses=()):
+        now = time.time()
+        hints = self.owner._their_direct_hints
+        # sorted() is stable, so equally good hints keep their order
+        self.pending = sorted(hints,
+                              key=lambda hint: rank_hint(hint, my_addresses))
+        self.next_start = now
+        self.relay_at = now + RELAY_DELAY
+        self._schedule(now)
+
+    def _schedule(self, now):
+        # start whatever is due, and return when the next thing will be
+        while self.pending and now >= self.next_start:
+            hint = self.pending.pop(0)
+            started = self._connect(hint, is_relay=False)
+            if started:
+                self.direct_outbound.update(started)
+                self.next_start = now + STAGGER
+        if not self.relays_started:
+            if now >= self.relay_at or not (self.pending
+                                            or self.direct_outbound):
+                self._start_relays()
+        due = []
+        if self.pending:
+            due.append(self.next_start)
+        if not self.relays_started:
+            due.append(self.relay_at)
+        return due
+
+    def _start_relays(self):
+        self.relays_started = True
+        for hint in self.owner._their_relay_hints:
+            self._connect(hint, is_relay=True)
+
+    def start_streams(self, winner, streams):
+        # Stream 0 is 'winner': the rest go the same way. If it was one of
+        # our outbound connections (direct or through a relay), we connect
+        # again for each of them. If it came in to our listener, they will.
+        for attempt in list(self.attempts):
+            self._drop(attempt)
+        self.lookups.clear()
+        self.pending = []
+        self.relays_started = True
+        self.give_up_at = None
+        if winner.outbound:
+            self._close_listener()
+            for stream in streams:
+                self._connect(winner.hint, winner.is_relay, stream,
+                              addresses=[winner.address])
+        else:
+            self.choices = self.owner._stream_choices(streams)
+
+    def _connect(self, hint, is_relay, stream=0, with_limits=True,
+                 addresses=None):
+        # Returns what is now underway for the hint: an Attempt for each of
+        # its addresses, or a _Lookup while they're found. 'addresses'
+        # (getaddrinfo() entries) saves us the looking.
+        parsed_hint = parse_hint_tcp(hint)
+        if not parsed_hint:
+            return [] # unparseable
+        addr, port = parsed_hint
+        if addresses is None:
+            try:
+                # this never blocks: it only takes addresses
+                addresses = socket.getaddrinfo(addr, port, 0,
+                                               socket.SOCK_STREAM, 0,
+                                               socket.AI_NUMERICHOST)
+            except socket.gaierror:
+                lookup = _Lookup(hint, is_relay, stream, with_limits)
+                self._resolve(lookup, addr, port)
+                return [lookup]
+            except socket.error:
+                return []
+        started = [self._connect_to(hint, is_relay, stream, with_limits,
+                                    address) for address in addresses]
+        return [attempt for attempt in started if attempt]
+
+    def _resolve(self, lookup, addr, port):
+        if self.wakeup is None:
+            self.wakeup, self._wakeup_w = socket.socketpair()
+            self.wakeup.setblocking(False)
+            self.selector.register(self.wakeup, selectors.EVENT_READ,
+                                   _WAKEUP)
+        resolved, wakeup_w = self.resolved, self._wakeup_w
+        def _run():
+            try:
+                addresses = socket.getaddrinfo(addr, port, 0,
+                                               socket.SOCK_STREAM)
+            except socket.error as e:
+                debug(" - unable to resolve %s: %s" % (addr, e))
+                addresses = []
+            resolved.put((lookup, addresses))
+            try:
+                wakeup_w.send(b"\n")
+            except socket.error:
+                pass # the race is over
+        self.lookups.add(lookup)
+        t = threading.Thread(target=_run)
+        t.daemon = True # we don't wait for a slow lookup when we're done
         t.start()
 
+    def _got_addresses(self):
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while True:
+            try:
+                (lookup, addresses) = self.resolved.get_nowait()
+            except queue.Empty:
+                return
+            if lookup not in self.lookups:
+                continue # given up on
+            self.lookups.discard(lookup)
+            started = self._connect(lookup.hint, lookup.is_relay,
+                                    lookup.stream, lookup.with_limits,
+                                    addresses)
+            if lookup in self.direct_outbound:
+                self.direct_outbound.update(started)
+                self._forget_direct(lookup)
+
+    def _connect_to(self, hint, is_relay, stream, with_limits, address):
+        description = "->%s" % (hint,)
+        relay_handshake = None
+        if is_relay:
+            description = "->relay:%s" % (hint,)
+            relay_handshake = build_relay_handshake(
+                stream_key(self.owner._transit_key, stream), with_limits)
+        debug("+ connector(%s)" % hint)
+        skt = None
+        try:
+            (family, socktype, proto, _, sockaddr) = address
+            skt = socket.socket(family, socktype, proto)
+            skt.setblocking(False)
+            err = skt.connect_ex(sockaddr)
+            if err and err not in _IN_PROGRESS:
+                raise socket.error(err, os.strerror(err))
+        except socket.error:
+            debug(" - failed connector %s" % hint)
+            if skt:
+                skt.close()
+            return None
+        attempt = Attempt(skt, description, self.owner._send_this(stream),
+                          self.owner._expect_this(stream), relay_handshake,
+                          connecting=True, hint=hint, is_relay=is_relay,
+                          stream=stream, with_limits=with_limits,
+                          address=address)
+        self._add(attempt)
+        return attempt
+
+    def _add(self, attempt):
+        self.attempts.add(attempt)
+        self.selector.register(attempt.skt, attempt.events(), attempt)
+
+    def _accept(self):
+        while True:
+            try:
+                skt, client_address = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in _IN_PROGRESS:
+                    return
+                raise
+            skt.setblocking(False)
+            description = "<-tcp:%s:%d" % (client_address[0],
+                                           client_address[1])
+            debug("handle %r" % (client_address,))
+            if self.choices:
+                self._add(Attempt(skt, description, None, None,
+                                  choices=self.choices))
+                continue
+            # for the receiver, the expected handshake includes the "go\n"
+            self._add(Attempt(skt, description, self.owner._send_this(),
+                              self.owner._expect_this()))
+
+    def _drop(self, attempt):
+        debug("- failed %s" % (attempt.description,))
+        self.attempts.discard(attempt)
+        self.selector.unregister(attempt.skt)
+        attempt.close()
+        self._forget_direct(attempt)
+
+    def _forget_direct(self, attempt):
+        # an Attempt or _Lookup for a direct hint is done with
+        if attempt not in self.direct_outbound:
+            return
+        self.direct_outbound.discard(attempt)
+        # once nothing is left of this hint, there's no need to wait for the
+        # stagger: try the next one now
+        if not [a for a in self.direct_outbound if a.hint == attempt.hint]:
+            self.next_start = time.time()
+
+    def _step(self, attempt, mask):
+        connecting = attempt.connecting
+        try:
+            if mask & selectors.EVENT_WRITE:
+                attempt.writable()
+            if mask & selectors.EVENT_READ:
+                attempt.readable()
+        except LegacyRelay as e:
+            debug(" - %s: %s, retrying" % (attempt.description, e))
+            self._drop(attempt)
+            self._connect(attempt.hint, True, attempt.stream,
+                          with_limits=False, addresses=[attempt.address])
+            return
+        except (socket.error, BadHandshake) as e:
+            # ignore socket errors, warn about coding errors
+            debug(" - %s: %s" % (attempt.description, e))
+            self._drop(attempt)
+            return
+        if connecting and not attempt.connecting:
+            # the rest of this hint's addresses are too late. (Two of them
+            # could be the same relay, which would pair them together.)
+            for other in [a for a in self.attempts if a.connecting
+                          and (a.hint, a.is_relay, a.stream)
+                          == (attempt.hint, attempt.is_relay,
+                              attempt.stream)]:
+                self._drop(other)
+        if not attempt.finished:
+            self.selector.modify(attempt.skt, attempt.events(), attempt)
+
+    def run(self, deadline):
+        while True:
+            now = time.time()
+            if now >= deadline:
+                return None
+            due = self._schedule(now)
+            if not (self.pending or self.attempts or self.lookups
+                    or not self.relays_started):
+                # everything we started has failed
+                if self.give_up_at is None:
+                    grace = INBOUND_GRACE if self.listener else 0
+                    self.give_up_at = now + grace
+                if now >= self.give_up_at:
+                    return None
+                due.append(self.give_up_at)
+            timeout = min([deadline] + due
+                          + [a.deadline for a in self.attempts]
+                          + [l.deadline for l in self.lookups])
+            for (key, mask) in self.selector.select(max(0, timeout - now)):
+                if key.data is None:
+                    self._accept()
+                    continue
+                if key.data is _WAKEUP:
+                    self._got_addresses()
+                    continue
+                attempt = key.data
+                if attempt not in self.attempts:
+                    continue # dropped earlier in this pass
+                self._step(attempt, mask)
+                if attempt.finished:
+                    self.attempts.discard(attempt)
+                    self.selector.unregister(attempt.skt)
+                    return attempt
+            now = time.time()
+            for attempt in [a for a in self.attempts if a.deadline <= now]:
+                self._drop(attempt) # timeout
+            for lookup in [l for l in self.lookups if l.deadline <= now]:
+                debug("- gave up resolving %s" % (lookup.hint,))
+                self.lookups.discard(lookup)
+                self._forget_direct(lookup)
+
+    def _close_listener(self):
+        if self.listener:
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+
+    def close(self):
+        # the losers, and the listener, go away right now
+        for attempt in self.attempts:
+            attempt.close()
+        self.attempts.clear()
+        self.lookups.clear()
+        self._close_listener()
+        for skt in [self.wakeup, self._wakeup_w]:
+            if skt:
+                skt.close()
+        self.selector.close()
 
 class TransitClosed(TransitError):
     pass
@@ -216,208 +596,502 @@ class TransitClosed(TransitError):
 class BadNonce(TransitError):
     pass
 
+# ReceiveBuffer's initial size, which is the most that each recv_into() asks
+# for until a larger record makes it grow
+RECV_SIZE = 256*1024
+
 class ReceiveBuffer:
-    def __init__(self, skt):
+    # I recv_into() one reusable bytearray, and read() returns memoryview
+    # slices of it, so bytes are not copied on their way to the caller. The
+    # unread bytes live in buf[start:end]. They are moved back to the front
+    # when we run out of room behind them, and the buffer only grows (by
+    # replacing it) when a single read() needs more than it can hold. A view
+    # returned by read() is only valid until the next read().
+
+    def __init__(self, skt, initial=b"", recv_size=RECV_SIZE):
         self.skt = skt
-        self.buf = b""
+        self.buf = bytearray(max(recv_size, len(initial)))
+        # anything that was read along with the handshake
+        self.buf[:len(initial)] = initial
+        self.start = 0
+        self.end = len(initial)
+
+    def _make_room(self, count):
+        unread = self.end - self.start
+        if count > len(self.buf):
+            new = bytearray(max(count, 2*len(self.buf)))
+            new[:unread] = self.buf[self.start:self.end]
+            self.buf = new
+        else:
+            self.buf[:unread] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+    def available(self):
+        return self.end - self.start
+
+    def peek(self, count):
+        return memoryview(self.buf)[self.start:self.start+count]
+
+    def fill(self, count):
+        # one recv_into(), with room for 'count' unread bytes in all
+        if self.start + count > len(self.buf):
+            self._make_room(count)
+        more = self.skt.recv_into(memoryview(self.buf)[self.end:])
+        if not more:
+            raise TransitClosed
+        self.end += more
 
     def read(self, count):
-        while len(self.buf) < count:
-            more = self.skt.recv(4096)
-            if not more:
-                raise TransitClosed
-            self.buf += more
-        rc = self.buf[:count]
-        self.buf = self.buf[count:]
+        while self.end - self.start < count:
+            self.fill(count)
+        rc = memoryview(self.buf)[self.start:self.start+count]
+        self.start += count
+        if self.start == self.end:
+            self.start = self.end = 0
         return rc
 
+# each record's nonce+ciphertext is this much bigger than its plaintext
+RECORD_OVERHEAD = SecretBox.NONCE_SIZE + SecretBox.MACBYTES
+# Plaintext record sizes. The wire format allows up to 4GB (it has a 4-byte
+# length prefix), but a few records of each size are held in memory at once.
+MIN_RECORD_SIZE = 16*1024
+INITIAL_RECORD_SIZE = 64*1024
+MAX_RECORD_SIZE = 4*1024*1024
+# The fixed size senders used before records were sized adaptively. Older
+# receivers never say which sizes they take, and get slow on bigger records,
+# so we don't grow past this for them.
+LEGACY_RECORD_SIZE = 64*1024
+
+def tcp_rtt(skt):
+    # the kernel's smoothed round-trip time for a TCP socket, in seconds, or
+    # None where TCP_INFO isn't available (it is Linux-only)
+    if not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = skt.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except (socket.error, AttributeError):
+        return None
+    if len(info) < 72:
+        return None
+    # struct tcp_info: 8 one-byte fields, then u32s, of which tcpi_rtt (in
+    # microseconds) is the 16th
+    (rtt,) = struct.unpack_from("I", info, 8 + 15*4)
+    return rtt / 1e6
+
+class RecordSizer:
+    # The sender asks me how big its next record should be, and tells me how
+    # long each send took. I aim for records that take about TARGET seconds
+    # (or a few round trips, if that's longer) to go out: big ones on fast
+    # links, where the per-record Python overhead would otherwise limit us,
+    # and small ones on slow links, so progress doesn't stall. The size
+    # changes by at most a factor of two per record, and stays between
+    # MIN_RECORD_SIZE and the max_size we told the receiver about.
+    TARGET = 0.05
+    RTTS = 4
+
+    def __init__(self, max_size=None, initial=INITIAL_RECORD_SIZE, skt=None):
+        self.max_size = max_size or MAX_RECORD_SIZE
+        self.size = min(initial, self.max_size)
+        self.skt = skt
+        self._rate = None # bytes per second, smoothed
+
+    def sent(self, size, elapsed):
+        rate = size / max(elapsed, 1e-6)
+        if self._rate is None:
+            self._rate = rate
+        else:
+            self._rate = 0.7*self._rate + 0.3*rate
+        target = self.TARGET
+        rtt = tcp_rtt(self.skt) if self.skt else None
+        if rtt:
+            target = max(target, self.RTTS*rtt)
+        wanted = int(self._rate * target)
+        wanted = max(self.size // 2, min(wanted, self.size * 2))
+        self.size = min(max(MIN_RECORD_SIZE, wanted), self.max_size)
+
 class RecordPipe:
-    def __init__(self, skt, send_key, receive_key):
+    def __init__(self, skt, send_key, receive_key, leftover=b"",
+                 recv_size=RECV_SIZE, max_record_size=None):
         self.skt = skt
+        self.send_key = send_key
         self.send_box = SecretBox(send_key)
         self.send_nonce = 0
-        self.receive_buf = ReceiveBuffer(self.skt)
+        # if the sender told us how big its records can get, we refuse
+        # bigger ones, and start with a buffer that holds the biggest
+        self.max_record_size = max_record_size
+        if max_record_size:
+            recv_size = max(recv_size, 4 + RECORD_OVERHEAD + max_record_size)
+        self.receive_buf = ReceiveBuffer(self.skt, leftover, recv_size)
         self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
 
-    def send_record(self, record):
-        if not isinstance(record, type(b"")): raise UsageError
+    # Sending and receiving are each split in two (seal_record() +
+    # send_sealed(), receive_sealed() + open_record()), so the crypto and the
+    # socket I/O can run in different threads, see pipeline.py. Each half
+    # must only be used from one thread at a time, and in order.
+
+    def seal_record(self, record):
+        # returns the 4-byte length header and the nonce+ciphertext, which
+        # can go out together in one sendmsg(). 'record' may also be a
+        # memoryview, which is encrypted where it is.
+        if not isinstance(record, (type(b""), memoryview)): raise UsageError
         assert SecretBox.NONCE_SIZE == 24
-        assert self.send_nonce < 2**(8*24)
         assert len(record) < 2**(8*4)
-        nonce = unhexlify("%048x" % self.send_nonce) # big-endian
+        nonce = make_nonce(self.send_nonce)
         self.send_nonce += 1
-        encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
-        send_to(self.skt, length)
-        send_to(self.skt, encrypted)
+        if _lib:
+            encrypted = bytearray(RECORD_OVERHEAD + len(record))
+            encrypted[:SecretBox.NONCE_SIZE] = nonce
+            rc = _lib.crypto_secretbox_easy(
+                _ffi.from_buffer(encrypted) + SecretBox.NONCE_SIZE,
+                _ffi.from_buffer(record), len(record), nonce, self.send_key)
+            if rc != 0:
+                raise TransitError("unable to encrypt")
+        else:
+            if isinstance(record, memoryview):
+                record = record.tobytes()
+            encrypted = self.send_box.encrypt(record, nonce)
+        return struct.pack(">L", len(encrypted)), encrypted
 
-    def receive_record(self):
-        length_buf = self.receive_buf.read(4)
-        length = int(hexlify(length_buf), 16)
-        encrypted = self.receive_buf.read(length)
+    def send_sealed(self, sealed):
+        send_vectored(self.skt, sealed)
+
+    def send_record(self, record):
+        self.send_sealed(self.seal_record(record))
+
+    def send_records(self, records):
+        # several (small) records in one syscall
+        buffers = []
+        for record in records:
+            buffers.extend(self.seal_record(record))
+        send_vectored(self.skt, buffers)
+
+    def receive_sealed(self):
+        # the nonce+ciphertext of the next record, copied out of our buffer
+        # (nacl wants bytes anyway)
+        (length,) = struct.unpack(">L", self.receive_buf.read(4).tobytes())
+        if (self.max_record_size
+            and length > self.max_record_size + RECORD_OVERHEAD):
+            raise TransitError("record of %d bytes exceeds the %d we agreed"
+                               % (length - RECORD_OVERHEAD,
+                                  self.max_record_size))
+        return self.receive_buf.read(length).tobytes()
+
+    def open_record(self, encrypted):
         nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
-        if nonce != self.next_receive_nonce:
+        if nonce_buf != make_nonce(self.next_receive_nonce):
             raise BadNonce("received out-of-order record")
         self.next_receive_nonce += 1
-        record = self.receive_box.decrypt(encrypted)
-        return record
+        return self.receive_box.decrypt(encrypted)
+
+    def receive_record(self):
+        return self.open_record(self.receive_sealed())
 
     def close(self):
         self.skt.close()
 
-class Common:
-    def __init__(self, transit_relay):
-        self._transit_relay = transit_relay
-        self.winning = threading.Event()
-        self._negotiation_check_lock = threading.Lock()
-        self._have_transit_key = threading.Condition()
-        self._transit_key = None
-        self._start_server()
-
-    def _start_server(self):
-        server = MyTCPServer(("", 0), None)
-        _, port = server.server_address
-        self.my_direct_hints = ["tcp:%s:%d" % (addr, port)
-                                for addr in ipaddrs.find_addresses()]
-        server.owner = self
-        server_thread = threading.Thread(target=server.serve_forever)
-        server_thread.daemon = True
-        server_thread.start()
-        self.listener = server
-
-    def get_direct_hints(self):
-        return self.my_direct_hints
-    def get_relay_hints(self):
-        return [self._transit_relay]
-
-    def add_their_direct_hints(self, hints):
-        self._their_direct_hints = [str(h) for h in hints]
-    def add_their_relay_hints(self, hints):
-        self._their_relay_hints = [str(h) for h in hints]
-
-    def _send_this(self):
-        if self.is_sender:
-            return build_sender_handshake(self._transit_key)
-        else:
-            return build_receiver_handshake(self._transit_key)
+def nonce_counter(encrypted):
+    return struct.unpack(">Q", encrypted[16:SecretBox.NONCE_SIZE])[0]
 
-    def _expect_this(self):
-        if self.is_sender:
-            return build_receiver_handshake(self._transit_key)
-        else:
-            return build_sender_handshake(self._transit_key) + b"go\n"
+# Striping: with several streams, each record goes out on whichever stream
+# can take it first, so a slow path gets fewer of them. There is still just
+# one sequence of nonces in each direction (which is what lets the records
+# be sealed before we know where they'll go), and the receiver puts the
+# records back in nonce order.
+#
+# To survive losing a stream, the sender keeps each record until it is
+# acknowledged: every ACK_EVERY records, the receiver says how many it has
+# received in order, with a frame of its own (a zero length, which no record
+# can have, and then that count as 8 bytes). When a stream fails, or stops
+# making progress for TIMEOUT while we wait for acks, whatever was sent on
+# it and not yet acknowledged goes out again on the others. The receiver
+# ignores records it has already seen.
 
-    def _sender_record_key(self):
-        if self.is_sender:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_sender_key")
-        else:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_receiver_key")
+ACK_EVERY = 16
+ACK_LENGTH = 4+8
+# the most we send before hearing that it arrived, which is also about the
+# most a receiver holds while waiting for a record that's late
+MAX_UNACKED = 64*1024*1024
 
-    def _receiver_record_key(self):
-        if self.is_sender:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_receiver_key")
-        else:
-            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
-                        CTXinfo=b"transit_record_sender_key")
-
-    def set_transit_key(self, key):
-        # This _have_transit_key condition/lock protects us against the race
-        # where the sender knows the hints and the key, and connects to the
-        # receiver's transit socket before the receiver gets relay message
-        # (and thus the key).
-        self._have_transit_key.acquire()
-        self._transit_key = key
-        self.handler_send_handshake = self._send_this() # no "go"
-        self.handler_expected_handshake = self._expect_this()
-        self._have_transit_key.notify_all()
-        self._have_transit_key.release()
-
-    def _start_outbound(self):
-        self._active_connectors = set(self._their_direct_hints)
-        for hint in self._their_direct_hints:
-            self._start_connector(hint)
-        if not self._their_direct_hints:
-            self._start_relay_connectors()
-
-    def _start_connector(self, hint, is_relay=False):
-        description = "->%s" % (hint,)
-        if is_relay:
-            description = "->relay:%s" % (hint,)
-        args = (self, hint, description,
-                self._send_this(), self._expect_this())
-        if is_relay:
-            args = args + (build_relay_handshake(self._transit_key),)
-        t = threading.Thread(target=connector, args=args)
-        t.daemon = True
-        t.start()
+class _Stream:
+    def __init__(self, skt, receive_buf):
+        self.skt = skt
+        self.receive_buf = receive_buf
+        self.wanted = 4 # bytes we need before we can parse the next frame
+        self.unacked = [] # (nonce counter, size, sealed) sent on this one
+        self.records = 0
+
+class StripedPipe(RecordPipe):
+    # A RecordPipe over several sockets. streams=[(skt, leftover)], with
+    # stream 0 first.
+    def __init__(self, streams, send_key, receive_key, recv_size=RECV_SIZE,
+                 max_record_size=None):
+        RecordPipe.__init__(self, streams[0][0], send_key, receive_key,
+                            streams[0][1], recv_size, max_record_size)
+        recv_size = len(self.receive_buf.buf)
+        self.streams = [_Stream(self.skt, self.receive_buf)]
+        for (skt, leftover) in streams[1:]:
+            self.streams.append(_Stream(skt, ReceiveBuffer(skt, leftover,
+                                                           recv_size)))
+        # both selectors watch every socket: one for reading, and one for
+        # writing as well
+        self.readers = selectors.DefaultSelector()
+        self.writers = selectors.DefaultSelector()
+        for stream in self.streams:
+            self.readers.register(stream.skt, selectors.EVENT_READ, stream)
+            self.writers.register(stream.skt, selectors.EVENT_READ
+                                  | selectors.EVENT_WRITE, stream)
+        self.next_stream = 0 # round robin, among those that are ready
+        self.outbox = [] # sealed records waiting for a stream
+        self.unacked_bytes = 0
+        self.received = {} # nonce counter -> record, waiting for its turn
+        self.next_out = 0 # the next record receive_sealed() returns
+        self.acked_out = 0 # how many of those we've told them about
+        self.lost = 0
+
+    def send_sealed(self, sealed):
+        self.outbox.append((nonce_counter(sealed[1]), sealed))
+        self._flush()
+
+    def send_records(self, records):
+        for record in records:
+            self.send_record(record)
+
+    def _flush(self):
+        while self.outbox:
+            if self.unacked_bytes >= MAX_UNACKED:
+                # wait for acks, and only for acks
+                events = self.readers.select(TIMEOUT)
+            else:
+                events = self.writers.select(TIMEOUT)
+            if not events:
+                self._stalled()
+                continue
+            ready = []
+            for (key, mask) in events:
+                stream = key.data
+                if mask & selectors.EVENT_READ:
+                    self._read_from(stream)
+                if mask & selectors.EVENT_WRITE and stream in self.streams:
+                    ready.append(stream)
+            if ready and self.outbox and self.unacked_bytes < MAX_UNACKED:
+                self._send_on(ready)
+
+    def _send_on(self, ready):
+        # the next ready one after the last we used
+        n = self.next_stream
+        stream = [s for s in self.streams[n:] + self.streams[:n]
+                  if s in ready][0]
+        self.next_stream = (self.streams.index(stream) + 1) % len(self.streams)
+        (counter, sealed) = self.outbox.pop(0)
+        try:
+            send_vectored(stream.skt, sealed)
+        except socket.error as e:
+            debug("stream lost sending: %s" % (e,))
+            self.outbox.insert(0, (counter, sealed))
+            self._lose(stream)
+            return
+        size = len(sealed[0]) + len(sealed[1])
+        stream.unacked.append((counter, size, sealed))
+        stream.records += 1
+        self.unacked_bytes += size
 
-    def _start_relay_connectors(self):
-        self._active_connectors.update(self._their_direct_hints)
-        for hint in self._their_relay_hints:
-            self._start_connector(hint, is_relay=True)
+    def _stalled(self):
+        # TIMEOUT without an event: if a stream is holding things up, give
+        # up on it, otherwise on everything
+        oldest = [(s.unacked[0][0], i) for (i, s) in enumerate(self.streams)
+                  if s.unacked]
+        if len(self.streams) < 2 or not oldest:
+            raise TransitError("timed out")
+        self._lose(self.streams[min(oldest)[1]])
 
-    def establish_socket(self):
+    def _lose(self, stream):
+        self.readers.unregister(stream.skt)
+        self.writers.unregister(stream.skt)
+        stream.skt.close()
+        self.streams.remove(stream)
+        self.next_stream = 0
+        self.lost += 1
+        if not self.streams:
+            raise TransitClosed
+        # send it all again, in order, ahead of anything new
+        self.unacked_bytes -= sum(size for (_, size, _) in stream.unacked)
+        resend = [(counter, sealed) for (counter, _, sealed)
+                  in stream.unacked]
+        self.outbox = sorted(resend + self.outbox, key=lambda e: e[0])
+
+    def _acked(self, count):
+        for stream in self.streams:
+            keep = [e for e in stream.unacked if e[0] >= count]
+            self.unacked_bytes -= sum(e[1] for e in stream.unacked
+                                      if e[0] < count)
+            stream.unacked = keep
+
+    def _read_from(self, stream):
+        try:
+            stream.receive_buf.fill(stream.wanted)
+        except (socket.error, TransitClosed) as e:
+            debug("stream lost reading: %s" % (e,))
+            self._lose(stream)
+            return
+        buf = stream.receive_buf
+        while buf.available() >= 4:
+            (length,) = struct.unpack(">L", buf.peek(4).tobytes())
+            if length == 0:
+                stream.wanted = ACK_LENGTH
+            elif (self.max_record_size
+                  and length > self.max_record_size + RECORD_OVERHEAD):
+                raise TransitError("record of %d bytes exceeds the %d we "
+                                   "agreed" % (length - RECORD_OVERHEAD,
+                                               self.max_record_size))
+            else:
+                stream.wanted = 4 + length
+            if buf.available() < stream.wanted:
+                return
+            frame = buf.read(stream.wanted)
+            stream.wanted = 4
+            if length == 0:
+                self._acked(struct.unpack(">Q", frame[4:].tobytes())[0])
+                continue
+            encrypted = frame[4:].tobytes()
+            counter = nonce_counter(encrypted)
+            if counter >= self.next_out: # else we've had it already
+                self.received.setdefault(counter, encrypted)
+
+    def receive_sealed(self):
+        while self.next_out not in self.received:
+            # we can't do anything about a stream that has gone quiet (only
+            # the sender can), so we wait longer than the sender does
+            events = self.readers.select(2*TIMEOUT)
+            if not events:
+                raise TransitError("timed out")
+            try:
+                for (key, mask) in events:
+                    if key.data in self.streams:
+                        self._read_from(key.data)
+                # a stream we lost may have left records to send again
+                self._flush()
+            except TransitClosed:
+                # when they're done, they hang up on every stream, maybe
+                # before we've heard that our last records arrived. That's
+                # only a problem if we're still missing what they sent.
+                if self.next_out not in self.received:
+                    raise
+        encrypted = self.received.pop(self.next_out)
+        self.next_out += 1
+        if self.next_out - self.acked_out >= ACK_EVERY:
+            self._send_ack()
+        return encrypted
+
+    def _send_ack(self):
+        self.acked_out = self.next_out
+        ack = struct.pack(">LQ", 0, self.next_out)
+        while self.streams:
+            stream = self.streams[0]
+            try:
+                send_to(stream.skt, ack)
+                return
+            except socket.error:
+                self._lose(stream)
+
+    def close(self):
+        # We shut down our side of each stream, and wait (for up to
+        # STREAM_WAIT) for them to do the same, before closing. Closing
+        # outright could end one stream while our last record is still
+        # arriving on another, which they would take for a lost stream.
+        for stream in self.streams:
+            try:
+                stream.skt.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+        give_up = time.time() + STREAM_WAIT
+        waiting = set(self.streams)
+        while waiting and time.time() < give_up:
+            for (key, mask) in self.readers.select(give_up - time.time()):
+                try:
+                    more = key.fileobj.recv(RECV_SIZE)
+                except socket.error:
+                    more = b""
+                if not more:
+                    self.readers.unregister(key.fileobj)
+                    waiting.discard(key.data)
+        for stream in self.streams:
+            stream.skt.close()
+        self.readers.close()
+        self.writers.close()
+
+class Common(TransitCommon):
+    def establish_socket(self, streams=1):
+        # With streams > 1, self.winning_streams also lists the (socket,
+        # leftover) of each other stream we got, which may be fewer.
         start = time.time()
         self.winning_skt = None
         self.winning_skt_description = None
-        self._start_outbound()
-
+        self.winning_leftover = b""
+        self.winning_streams = []
+        self.relay_limits = None
+        racer = Racer(self)
+        racer.add_listener(self.listener)
+        self.listener = None # the racer closes it
+        racer.start_outbound(self.my_addresses)
         # we sit here until one of our inbound or outbound sockets succeeds
-        flag = self.winning.wait(2*TIMEOUT)
-        debug("wait returned at %.1f" % (since(start),))
+        try:
+            winner = racer.run(start + 2*TIMEOUT)
+            if winner:
+                self._won(winner)
+                if streams > 1:
+                    self._more_streams(racer, winner, streams)
+        finally:
+            racer.close()
+        debug("race finished at %.1f" % (since(start),))
+        if not winner:
+            raise TransitError
+        self.winning_skt = winner.skt
+        self.winning_skt_description = winner.description
+        # the relay's limits, if we're going through one
+        self.relay_limits = winner.relay_limits
+        # the start of the first record, if it came with the "go"
+        self.winning_leftover = self.winning_streams[0][1]
+        return winner.skt
 
-        if not flag:
-            # timeout: self.winning_skt will not be set. ish. race.
-            pass
-        if self.listener:
-            self.listener.shutdown() # TODO: waits up to 0.5s. push to thread
-        if self.winning_skt:
-            return self.winning_skt
-        raise TransitError
+    def _won(self, attempt):
+        skt = attempt.skt
+        skt.setblocking(True)
+        skt.settimeout(TIMEOUT)
+        if self.is_sender:
+            # the first one wins and gets a "go". The rest were closed.
+            send_to(skt, b"go\n")
+        self.winning_streams.append((skt, attempt.reader.leftover()))
+
+    def _more_streams(self, racer, winner, streams):
+        # we carry on with whichever of the others are up by STREAM_WAIT
+        racer.start_streams(winner, range(1, streams))
+        deadline = time.time() + STREAM_WAIT
+        while len(self.winning_streams) < streams:
+            attempt = racer.run(deadline)
+            if not attempt:
+                break
+            self._won(attempt)
 
     def describe(self):
         if not self.winning_skt_description:
             return "not yet established"
+        if len(self.winning_streams) > 1:
+            return "%s, %d streams" % (self.winning_skt_description,
+                                       len(self.winning_streams))
         return self.winning_skt_description
 
-    def _connector_failed(self, hint):
-        debug("- failed connector %s" % hint)
-        # XXX this was .remove, and occasionally got KeyError
-        self._active_connectors.discard(hint)
-        if not self._active_connectors:
-            self._start_relay_connectors()
-
-    def _negotiation_finished(self, skt, description):
-        # inbound/outbound sockets call this when they finish negotiation.
-        # The first one wins and gets a "go". Any subsequent ones lose and
-        # get a "nevermind" before being closed.
-
-        with self._negotiation_check_lock:
-            if self.winning_skt:
-                is_winner = False
-            else:
-                is_winner = True
-                self.winning_skt = skt
-                self.winning_skt_description = description
-
-        if is_winner:
-            if self.is_sender:
-                send_to(skt, b"go\n")
-            self.winning.set()
-        else:
-            if self.is_sender:
-                send_to(skt, b"nevermind\n")
-            skt.close()
-
-    def connect(self):
-        skt = self.establish_socket()
+    def connect(self, max_record_size=None, streams=1):
+        skt = self.establish_socket(streams)
+        if len(self.winning_streams) > 1:
+            return StripedPipe(self.winning_streams,
+                               self._sender_record_key(),
+                               self._receiver_record_key(),
+                               max_record_size=max_record_size)
         return RecordPipe(skt, self._sender_record_key(),
-                          self._receiver_record_key())
+                          self._receiver_record_key(), self.winning_leftover,
+                          max_record_size=max_record_size)
 
 class TransitSender(Common):
     is_sender = True
@@ -0,0 +1,129 @@
+from __future__ import print_function
+import os, sys, errno, threading
+import six
+from six.moves import queue
+from .pipeline import DEPTH, POLL
+
+# A FileWriter writes received data into a file on a thread of its own, so a
+# slow disk doesn't stall the receive+decrypt loop until DEPTH writes are
+# waiting. Every write carries its offset (os.pwrite), so writes may arrive
+# in any order. Since we know the final size up front, the file is
+# preallocated, which saves the filesystem from growing it (and updating its
+# metadata) a record at a time, and gives it the chance to lay it out in one
+# piece. If 'sync_every' is set, the data is fdatasync()ed each time that
+# many more bytes have been written, so a crash loses at most that much,
+# and the page cache doesn't fill up with dirty pages. If we give up
+# part-way, abort() truncates the file to the end of what was written, so a
+# later attempt to resume doesn't mistake the preallocated tail for data.
+
+def preallocate(fd, size):
+    # posix_fallocate() is py3.3+ and not everywhere, and some filesystems
+    # don't support it: all of that just means we go without. A full disk,
+    # however, is better found out now than after we've received most of
+    # the file.
+    if not hasattr(os, "posix_fallocate") or size <= 0:
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno in (errno.ENOSPC, errno.EFBIG):
+            raise
+        return False
+    return True
+
+class _End:
+    pass
+
+class FileWriter:
+    def __init__(self, f, filesize, sync_every=None, offset=0, depth=DEPTH):
+        self.f = f
+        self.fd = f.fileno()
+        self.sync_every = sync_every
+        self.preallocated = preallocate(self.fd, filesize)
+        self.offset = offset # where write() goes next
+        self.written = 0
+        self.end = offset # the end of what's in the file
+        self.syncs = 0
+        self._q = queue.Queue(depth)
+        self._failed = None
+        self._stopping = threading.Event()
+        self._t = threading.Thread(target=self._run)
+        self._t.daemon = True
+        self._t.start()
+
+    def _check(self):
+        if self._failed:
+            six.reraise(*self._failed)
+
+    def _put(self, item):
+        while True:
+            self._check()
+            try:
+                self._q.put(item, timeout=POLL)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        self.write_at(self.offset, data)
+        self.offset += len(data)
+
+    def write_at(self, offset, data):
+        self._put((offset, data))
+
+    def close(self):
+        # waits for everything to be written (and synced), and raises
+        # whatever went wrong
+        self._put(_End)
+        self._t.join()
+        self._check()
+
+    def abort(self):
+        self._stopping.set()
+        self._t.join()
+        try:
+            os.ftruncate(self.fd, self.end)
+        except EnvironmentError:
+            pass # we're already failing: leave it as it is
+
+    def _pwrite(self, offset, data):
+        if not hasattr(os, "pwrite"): # py2, windows
+            self.f.seek(offset)
+            self.f.write(data)
+            self.f.flush()
+            return
+        data = memoryview(data)
+        while data:
+            written = os.pwrite(self.fd, data, offset)
+            data = data[written:]
+            offset += written
+
+    def _sync(self):
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
+        self.syncs += 1
+
+    def _run(self):
+        unsynced = 0
+        try:
+            while not self._stopping.is_set():
+                try:
+                    item = self._q.get(timeout=POLL)
+                except queue.Empty:
+                    continue
+                if item is _End:
+                    if self.sync_every and unsynced:
+                        self._sync()
+                    return
+                (offset, data) = item
+                self._pwrite(offset, data)
+                self.written += len(data)
+                self.end = max(self.end, offset + len(data))
+                unsynced += len(data)
+                if self.sync_every and unsynced >= self.sync_every:
+                    self._sync()
+                    unsynced = 0
+        except BaseException:
+            self._failed = sys.exc_info()
@@ -9,6 +9,12 @@ def get_schema(version):
     schema_bytes = resource_string("wormhole", "db-schemas/v%d.sql" % version)
     return schema_bytes.decode("utf-8")
 
+def get_upgrader(new_version):
+    schema_bytes = resource_string("wormhole",
+                                   "db-schemas/upgrade-to-v%d.sql"
+                                   % new_version)
+    return schema_bytes.decode("utf-8")
+
 def get_db(dbfile, stderr=sys.stderr):
     """Open or create the given db file. The parent directory must exist.
     Returns the db connection object, or raises DBError.
@@ -21,7 +27,7 @@ def get_db(dbfile, stderr=sys.stderr):
         raise DBError("Unable to create/open db file %s: %s" % (dbfile, e))
     db.row_factory = sqlite3.Row
 
-    VERSION = 1
+    VERSION = 2
     if must_create:
         schema = get_schema(VERSION)
         db.executescript(schema)
@@ -35,6 +41,12 @@ def get_db(dbfile, stderr=sys.stderr):
         # Perhaps it was created with an old version, or it might be junk.
         raise DBError("db file is unusable: %s" % e)
 
+    while version < VERSION:
+        # upgrade old DBs one step at a time
+        version += 1
+        db.executescript(get_upgrader(version))
+        db.commit()
+
     if version != VERSION:
         raise DBError("Unable to handle db version %s" % version)
 
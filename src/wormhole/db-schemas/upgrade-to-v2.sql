@@ -0,0 +1,6 @@
+
+-- v2 adds an index on when each message arrived, which is the order the
+-- relay loads them in at startup, and what expiring old channels looks at
+
+CREATE INDEX `messages_when_idx` ON `messages` (`when`);
+UPDATE `version` SET `version`=2;
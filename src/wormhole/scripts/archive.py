@@ -0,0 +1,177 @@
+from __future__ import print_function
+import os, stat, shutil, tarfile
+import six
+
+# Directories are sent as a tar stream, generated while we walk the tree and
+# unpacked as it arrives, so neither side ever writes the archive to disk.
+# Zip would need its central directory at the end, tar doesn't.
+#
+# We lay the stream out ourselves (with TarInfo.tobuf(), as tarfile would),
+# which lets us know its exact size before sending a byte: the offer tells
+# the receiver how much to expect, just like it does for a single file. If a
+# file changes size after we've looked at it, the transfer fails rather than
+# sending something other than what we announced.
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+NUL = b"\0"
+FORMAT = tarfile.PAX_FORMAT # long names, big files, unicode
+ENCODING = "utf-8"
+ERRORS = "surrogateescape" if six.PY3 else "strict"
+
+class ArchiveError(Exception):
+    pass
+
+def _padded(size):
+    return size + (-size % BLOCKSIZE)
+
+class Archive:
+    def __init__(self, root):
+        # 'root' itself is not in the archive, just what's below it
+        self.root = root
+        self.members = [] # (path, TarInfo)
+        self.skipped = [] # symlinks, devices, etc, which we don't send
+        self.numfiles = 0
+        self.numbytes = 0 # just the file contents
+        self.size = 2*BLOCKSIZE # the whole stream, ending with two zeros
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                self._add(os.path.join(dirpath, name))
+
+    def _add(self, path):
+        s = os.lstat(path)
+        name = os.path.relpath(path, self.root).replace(os.sep, "/")
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mode = stat.S_IMODE(s.st_mode)
+        tarinfo.mtime = int(s.st_mtime)
+        if stat.S_ISDIR(s.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISREG(s.st_mode):
+            tarinfo.size = s.st_size
+            self.numfiles += 1
+            self.numbytes += s.st_size
+        else:
+            self.skipped.append(path)
+            return
+        self.members.append((path, tarinfo))
+        self.size += len(self._header(tarinfo)) + _padded(tarinfo.size)
+
+    def _header(self, tarinfo):
+        return tarinfo.tobuf(FORMAT, ENCODING, ERRORS)
+
+    def chunks(self, sizer):
+        # yields the tar stream in pieces of sizer.size (except the last)
+        buf = bytearray()
+        for (path, tarinfo) in self.members:
+            buf += self._header(tarinfo)
+            if tarinfo.isreg():
+                with open(path, "rb") as f:
+                    remaining = tarinfo.size
+                    while remaining:
+                        data = f.read(min(sizer.size, remaining))
+                        if not data:
+                            raise ArchiveError("%s shrank while we were "
+                                               "sending it" % path)
+                        buf += data
+                        remaining -= len(data)
+                        while len(buf) >= sizer.size:
+                            chunk = bytes(buf[:sizer.size])
+                            del buf[:len(chunk)]
+                            yield chunk
+                buf += NUL * (-tarinfo.size % BLOCKSIZE)
+            while len(buf) >= sizer.size:
+                chunk = bytes(buf[:sizer.size])
+                del buf[:len(chunk)]
+                yield chunk
+        buf += NUL * 2*BLOCKSIZE
+        while buf:
+            chunk = bytes(buf[:sizer.size])
+            del buf[:len(chunk)]
+            yield chunk
+
+class ChunkReader:
+    # a read()-able file over an iterator of bytes, for tarfile. tarfile
+    # makes many small reads, so we keep our place in the current chunk
+    # instead of slicing off what's left of it each time.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+        self.pos = 0 # how much of buf has been read
+
+    def read(self, size=-1):
+        pieces = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self.pos == len(self.buf):
+                try:
+                    self.buf = next(self.chunks)
+                except StopIteration:
+                    break
+                self.pos = 0
+            end = len(self.buf)
+            if size >= 0:
+                end = min(end, self.pos + wanted)
+                wanted -= end - self.pos
+            pieces.append(self.buf[self.pos:end])
+            self.pos = end
+        return b"".join(pieces)
+
+    def drain(self):
+        # what's left after the end-of-archive marker
+        self.buf = b""
+        self.pos = 0
+        for chunk in self.chunks:
+            pass
+
+def safe_path(destdir, name):
+    # Only plain relative names stay inside 'destdir'. We refuse the rest
+    # rather than quietly fixing them up: our sender never makes them.
+    parts = name.rstrip("/").split("/")
+    for part in parts:
+        if (part in ("", ".", "..")
+            or os.sep in part or (os.altsep and os.altsep in part)
+            or ":" in part and os.name == "nt"):
+            raise ArchiveError("unsafe name in archive: %r" % (name,))
+    return os.path.join(destdir, *parts)
+
+def _extract_member(tar, member, path):
+    # returns the number of files it made
+    if member.isdir():
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # we'll be writing into it
+        os.chmod(path, (member.mode & 0o755) | 0o700)
+        return 0
+    if member.isreg():
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        src = tar.extractfile(member)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(src, f, 1024*1024)
+        os.chmod(path, (member.mode & 0o755) | 0o600)
+        os.utime(path, (member.mtime, member.mtime))
+        return 1
+    raise ArchiveError("%r is neither a file nor a directory"
+                       % (member.name,))
+
+def extract(chunks, destdir):
+    # Unpack the tar stream from 'chunks' into 'destdir' as it arrives. Only
+    # directories and regular files are accepted (so no symlink can lead a
+    # later member outside 'destdir'), and modes are limited to rwxr-xr-x.
+    # Returns the number of files.
+    reader = ChunkReader(chunks)
+    numfiles = 0
+    tar = tarfile.open(fileobj=reader, mode="r|",
+                       encoding=ENCODING, errors=ERRORS)
+    for member in tar:
+        path = safe_path(destdir, member.name)
+        try:
+            numfiles += _extract_member(tar, member, path)
+        except EnvironmentError as e:
+            # e.g. a file where an earlier member made a directory, or the
+            # other way around
+            raise ArchiveError("unable to extract %r: %s" % (member.name, e))
+    tar.close()
+    reader.drain()
+    return numfiles
@@ -1,14 +1,21 @@
 from __future__ import print_function
-import os, sys, json, binascii, six
-from ..errors import handle_server_error
+import os, sys, json, shutil, binascii, six
+from ..errors import handle_server_error, WrongPasswordError
 
 APPID = b"lothar.com/wormhole/text-or-file-xfer"
 
 @handle_server_error
 def receive(args):
     # we're receiving text, or a file
-    from ..blocking.transcribe import Wormhole, WrongPasswordError
-    from ..blocking.transit import TransitReceiver, TransitError
+    from ..blocking.transcribe import Wormhole
+    from ..blocking.transit import (TransitReceiver, TransitError,
+                                    RECORD_OVERHEAD, MAX_RECORD_SIZE,
+                                    MAX_STREAMS)
+    from ..blocking.pipeline import pipelined
+    from ..blocking.writer import FileWriter
+    from .manifest import partial_hashes
+    from .archive import extract, ArchiveError
+    from .compression import choose_codec, Decompressor, DecompressionError
     from .progress import start_progress, update_progress, finish_progress
 
     w = Wormhole(APPID, args.relay_url)
@@ -44,7 +51,7 @@ def receive(args):
         w.close()
         return 0
 
-    if not "file" in them_d:
+    if not "file" in them_d and not "directory" in them_d:
         print("I don't know what they're offering\n")
         print(them_d)
         w.close()
@@ -55,11 +62,36 @@ def receive(args):
         w.close()
         return 1
 
-    file_data = them_d["file"]
-    # the basename() is intended to protect us against
-    # "~/.ssh/authorized_keys" and other attacks
-    filename = os.path.basename(file_data["filename"]) # unicode
-    filesize = file_data["filesize"]
+    if "directory" in them_d:
+        file_data = them_d["directory"]
+        if file_data.get("mode") != "tar":
+            print("Error: unknown directory mode %r"
+                  % (file_data.get("mode"),))
+            data = json.dumps({"error": "unknown directory mode"}
+                              ).encode("utf-8")
+            w.send_data(data)
+            w.close()
+            return 1
+        filename = os.path.basename(file_data["dirname"]) # unicode
+        # we transfer the archive, and count progress in it
+        filesize = file_data["archive_size"]
+    else:
+        file_data = them_d["file"]
+        # the basename() is intended to protect us against
+        # "~/.ssh/authorized_keys" and other attacks
+        filename = os.path.basename(file_data["filename"]) # unicode
+        filesize = file_data["filesize"]
+    receiving_directory = "directory" in them_d
+
+    # older senders don't say, but their records are small
+    max_record_size = file_data.get("max_record_size")
+    if max_record_size and max_record_size > MAX_RECORD_SIZE:
+        print("Error: sender wants %d-byte records, but we only accept %d"
+              % (max_record_size, MAX_RECORD_SIZE))
+        data = json.dumps({"error": "records too large"}).encode("utf-8")
+        w.send_data(data)
+        w.close()
+        return 1
 
     # get confirmation from the user before writing to the local directory
     if os.path.exists(filename):
@@ -69,7 +101,22 @@ def receive(args):
         w.close()
         return 1
 
-    print("Receiving file (%d bytes) into: %s" % (filesize, filename))
+    # A file's .tmp may be what an earlier attempt left behind, which we
+    # resume from. A directory can't be resumed, and one we find isn't
+    # necessarily ours to remove, so a directory's .tmp must not exist yet.
+    tmp = filename + ".tmp"
+    if os.path.lexists(tmp) and (receiving_directory or os.path.isdir(tmp)):
+        print("Error: refusing to overwrite existing file %s" % (tmp,))
+        data = json.dumps({"error": "file already exists"}).encode("utf-8")
+        w.send_data(data)
+        w.close()
+        return 1
+
+    if receiving_directory:
+        print("Receiving directory (%d files, %d bytes) into: %s"
+              % (file_data["numfiles"], file_data["numbytes"], filename))
+    else:
+        print("Receiving file (%d bytes) into: %s" % (filesize, filename))
     while True and not args.accept_file:
         ok = six.moves.input("ok? (y/n): ")
         if ok.lower().startswith("y"):
@@ -80,44 +127,166 @@ def receive(args):
         w.close()
         return 1
 
+    # if an earlier attempt left part of this file behind, we send the
+    # hashes of what we have, and the sender tells us how much of it to keep
+    resume_hashes = []
+    resume = file_data.get("resume")
+    if resume and not receiving_directory and os.path.isfile(tmp):
+        with open(tmp, "rb") as f:
+            resume_hashes = partial_hashes(f, filesize, resume)
+
+    codec = choose_codec(file_data.get("compression"))
+
+    # the sender may ask to stripe the data across several connections
+    tdata = them_d["transit"]
+    try:
+        streams = max(1, min(int(tdata.get("streams", 1)), MAX_STREAMS))
+    except (TypeError, ValueError):
+        streams = 1
+
     transit_receiver = TransitReceiver(args.transit_helper)
-    data = json.dumps({
+    answer = {
         "file_ack": "ok",
+        "compression": codec,
+        # we take records up to the size the sender offered
+        "max_record_size": max_record_size,
         "transit": {
             "direct_connection_hints": transit_receiver.get_direct_hints(),
             "relay_connection_hints": transit_receiver.get_relay_hints(),
+            "streams": streams,
             },
-        }).encode("utf-8")
+        }
+    if resume_hashes:
+        answer["resume_hashes"] = resume_hashes
+    data = json.dumps(answer).encode("utf-8")
     w.send_data(data)
     w.close()
 
     # now receive the rest of the owl
-    tdata = them_d["transit"]
     transit_key = w.derive_key(APPID+b"/transit-key")
     transit_receiver.set_transit_key(transit_key)
     transit_receiver.add_their_direct_hints(tdata["direct_connection_hints"])
     transit_receiver.add_their_relay_hints(tdata["relay_connection_hints"])
-    record_pipe = transit_receiver.connect()
+    record_pipe = transit_receiver.connect(max_record_size, streams)
+
+    offset = 0
+    if resume_hashes:
+        # the sender's first record says how much of the .tmp matched
+        try:
+            resumed = json.loads(record_pipe.receive_record().decode("utf-8"))
+        except TransitError:
+            print("Connection dropped before the transfer started")
+            record_pipe.close()
+            return 1
+        except ValueError:
+            resumed = None
+        offset = None
+        if isinstance(resumed, dict):
+            offset = resumed.get("resume_offset")
+        chunk_size = int(resume["chunk_size"])
+        if (not isinstance(offset, six.integer_types) or offset < 0
+            or offset > min(filesize, len(resume_hashes) * chunk_size)
+            or (offset % chunk_size and offset != filesize)):
+            print("Error: the sender wants to resume at %r" % (offset,))
+            record_pipe.close()
+            return 1
+        if offset:
+            print("Resuming: %d bytes were received earlier" % offset)
 
     print("Receiving %d bytes for '%s' (%s).." % (filesize, filename,
                                                   transit_receiver.describe()))
-    tmp = filename + ".tmp"
-    with open(tmp, "wb") as f:
-        received = 0
+    def _sealed_records():
+        # stop after the last record, since the sender then waits for our ack
+        expected = offset
+        while expected < filesize:
+            encrypted = record_pipe.receive_sealed()
+            expected += len(encrypted) - RECORD_OVERHEAD
+            yield encrypted
+    def _compressed_records():
+        # these end with an empty one
+        while True:
+            encrypted = record_pipe.receive_sealed()
+            if len(encrypted) == RECORD_OVERHEAD:
+                return
+            yield encrypted
+    if codec:
+        decompressor = Decompressor(codec, max_record_size or MAX_RECORD_SIZE)
+        # a thread receives, another decrypts, another decompresses
+        plaintexts = pipelined(_compressed_records(),
+                               [record_pipe.open_record,
+                                decompressor.unframe])
+    else:
+        # a thread receives, another decrypts
+        plaintexts = pipelined(_sealed_records(), [record_pipe.open_record])
+
+    if receiving_directory:
+        # unpack as it arrives. If we fail, what we made is removed again.
+        os.mkdir(tmp)
+        progress = {"received": 0, "next_update": start_progress(filesize)}
+        def _counted():
+            for plaintext in plaintexts:
+                yield plaintext
+                progress["received"] += len(plaintext)
+                progress["next_update"] = update_progress(
+                    progress["next_update"], progress["received"], filesize)
+        try:
+            extract(_counted(), tmp)
+        except TransitError:
+            print()
+            print("Connection dropped before full directory received")
+            print("got %d bytes, wanted %d" % (progress["received"], filesize))
+            shutil.rmtree(tmp)
+            record_pipe.close()
+            return 1
+        except (ArchiveError, DecompressionError) as e:
+            print()
+            print("Error: %s" % e)
+            shutil.rmtree(tmp)
+            record_pipe.close()
+            return 1
+        finish_progress(filesize)
+        os.rename(tmp, filename)
+        print("Received directory written to %s" % filename)
+        record_pipe.send_record(b"ok\n")
+        record_pipe.close()
+        return 0
+
+    with open(tmp, "r+b" if offset else "wb") as f:
+        writer = FileWriter(f, filesize, args.sync_every, offset)
+        received = offset
         next_update = start_progress(filesize)
-        while received < filesize:
-            try:
-                plaintext = record_pipe.receive_record()
-            except TransitError:
-                print()
-                print("Connection dropped before full file received")
-                print("got %d bytes, wanted %d" % (received, filesize))
-                return 1
-            f.write(plaintext)
-            received += len(plaintext)
-            next_update = update_progress(next_update, received, filesize)
+        try:
+            # we hand the plaintext to the writer's thread
+            for plaintext in plaintexts:
+                writer.write(plaintext)
+                received += len(plaintext)
+                next_update = update_progress(next_update, received,
+                                              filesize)
+        except TransitError:
+            writer.abort()
+            print()
+            print("Connection dropped before full file received")
+            print("got %d bytes, wanted %d" % (received, filesize))
+            print("(kept in %s: receive it again to resume)" % tmp)
+            record_pipe.close()
+            return 1
+        except DecompressionError as e:
+            writer.abort()
+            print()
+            print("Error: %s" % e)
+            record_pipe.close()
+            return 1
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        # in case what we resumed was longer
+        f.truncate(filesize)
         finish_progress(filesize)
-        assert received == filesize
+        if received != filesize:
+            print("Error: got %d bytes, wanted %d" % (received, filesize))
+            record_pipe.close()
+            return 1
 
     os.rename(tmp, filename)
 
@@ -1,15 +1,80 @@
 from __future__ import print_function
-import os, sys, json, binascii, six
-from ..errors import handle_server_error
+import os, sys, stat, time, mmap, json, binascii, six
+from ..errors import handle_server_error, WrongPasswordError
 
 APPID = b"lothar.com/wormhole/text-or-file-xfer"
 
+def read_chunks(f, filesize, sizer, offset=0):
+    if offset:
+        f.seek(offset)
+    sent = offset
+    while sent < filesize:
+        plaintext = f.read(sizer.size)
+        if not plaintext:
+            break # the file shrank
+        sent += len(plaintext)
+        yield plaintext
+
+# map_chunks() maps this much of the file at a time. Each window is unmapped
+# once the last record sliced from it has been encrypted, so only a window or
+# two counts against our RSS, however big the file is.
+MAP_WINDOW = 16*1024*1024
+
+def map_chunks(f, filesize, sizer, offset=0, window=MAP_WINDOW):
+    # Like read_chunks(), but yields memoryview slices of the mapped file,
+    # which seal_record() encrypts where they are: no read() into a buffer
+    # of our own first. The file must not shrink while we're sending it:
+    # that would be a SIGBUS.
+    sent = offset
+    start = end = 0 # the part of the file in 'view'
+    view = None
+    while sent < filesize:
+        size = min(sizer.size, filesize - sent)
+        if view is None or sent + size > end:
+            start = sent - sent % mmap.ALLOCATIONGRANULARITY
+            end = min(start + max(window, sent - start + size), filesize)
+            m = mmap.mmap(f.fileno(), end - start, access=mmap.ACCESS_READ,
+                          offset=start)
+            if hasattr(m, "madvise"):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            # the slices keep the mapping alive, so we don't close() it
+            view = memoryview(m)
+        yield view[sent-start:sent-start+size]
+        sent += size
+
+def file_chunks(f, filesize, sizer, offset=0):
+    # pipes, devices, and files on filesystems that can't be mapped get
+    # buffered reads
+    try:
+        mappable = (stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+                    and filesize > 0)
+    except (AttributeError, OSError, ValueError):
+        mappable = False
+    if mappable:
+        try:
+            probe = mmap.mmap(f.fileno(), 1, access=mmap.ACCESS_READ)
+            try:
+                memoryview(probe) # py2's mmap doesn't offer one
+            finally:
+                probe.close()
+        except (mmap.error, OSError, ValueError, TypeError):
+            mappable = False
+    if mappable:
+        return map_chunks(f, filesize, sizer, offset)
+    return read_chunks(f, filesize, sizer, offset)
+
 @handle_server_error
 def send(args):
     # we're sending text, or a file
-    from ..blocking.transcribe import Wormhole, WrongPasswordError
-    from ..blocking.transit import TransitSender
+    from ..blocking.transcribe import Wormhole
+    from ..blocking.transit import (TransitSender, RecordSizer,
+                                    RECORD_OVERHEAD, MIN_RECORD_SIZE,
+                                    MAX_RECORD_SIZE, LEGACY_RECORD_SIZE)
+    from ..blocking.pipeline import pipelined
     from .progress import start_progress, update_progress, finish_progress
+    from .manifest import resume_offer, verified_prefix
+    from .archive import Archive, ArchiveError
+    from .compression import available_codecs, Compressor, CODECS
 
     text = args.text
     if not text and not args.what:
@@ -21,12 +86,35 @@ def send(args):
         phase1 = {
             "message": text,
             }
+    elif os.path.isdir(args.what):
+        # we're sending a directory, as a tar stream
+        sending_message = False
+        archive = Archive(args.what)
+        filesize = archive.size
+        basename = os.path.basename(os.path.abspath(args.what))
+        print("Sending directory '%s' (%d files, %d bytes)"
+              % (basename, archive.numfiles, archive.numbytes))
+        if archive.skipped:
+            print("(skipping %d symlinks and special files)"
+                  % len(archive.skipped))
+        transit_sender = TransitSender(args.transit_helper)
+        phase1 = {
+            "directory": {
+                "mode": "tar",
+                "dirname": basename,
+                "archive_size": archive.size,
+                "numfiles": archive.numfiles,
+                "numbytes": archive.numbytes,
+                "max_record_size": MAX_RECORD_SIZE,
+                },
+            }
     else:
         if not os.path.isfile(args.what):
             print("Cannot send: no file named '%s'" % args.what)
             return 1
         # we're sending a file
         sending_message = False
+        archive = None
         filesize = os.stat(args.what).st_size
         basename = os.path.basename(args.what)
         print("Sending %d byte file named '%s'" % (filesize, basename))
@@ -35,12 +123,23 @@ def send(args):
             "file": {
                 "filename": basename,
                 "filesize": filesize,
-                },
-            "transit": {
-                "direct_connection_hints": transit_sender.get_direct_hints(),
-                "relay_connection_hints": transit_sender.get_relay_hints(),
+                # our records will be no bigger than this
+                "max_record_size": MAX_RECORD_SIZE,
+                # lets a receiver with part of the file already ask for the
+                # rest
+                "resume": resume_offer(filesize),
                 },
             }
+    if not sending_message:
+        offer = phase1.get("file") or phase1.get("directory")
+        if args.compress:
+            offer["compression"] = available_codecs()
+        phase1["transit"] = {
+            "direct_connection_hints": transit_sender.get_direct_hints(),
+            "relay_connection_hints": transit_sender.get_relay_hints(),
+            }
+        if args.streams > 1:
+            phase1["transit"]["streams"] = args.streams
 
     w = Wormhole(APPID, args.relay_url)
     if args.zeromode:
@@ -107,27 +206,129 @@ def send(args):
         return 1
     w.close()
 
+    # a receiver with part of the file from an earlier attempt sends the
+    # hashes of the chunks it has. Older receivers don't resume.
+    their_hashes = None
+    if not archive:
+        their_hashes = them_phase1.get("resume_hashes")
+        if not isinstance(their_hashes, list):
+            their_hashes = None
+
+    # the receiver picked one of our codecs, or none
+    codec = them_phase1.get("compression")
+    if codec not in CODECS or not args.compress:
+        codec = None
+
+    # only receivers which echo max_record_size get records bigger than
+    # older senders made
+    max_record_size = LEGACY_RECORD_SIZE
+    agreed = them_phase1.get("max_record_size")
+    if isinstance(agreed, six.integer_types) and agreed > 0:
+        max_record_size = min(agreed, MAX_RECORD_SIZE)
+
     tdata = them_phase1["transit"]
     transit_key = w.derive_key(APPID+b"/transit-key")
     transit_sender.set_transit_key(transit_key)
     transit_sender.add_their_direct_hints(tdata["direct_connection_hints"])
     transit_sender.add_their_relay_hints(tdata["relay_connection_hints"])
-    record_pipe = transit_sender.connect()
+    # the receiver says how many streams it will take (older ones don't)
+    streams = min(args.streams, tdata.get("streams", 1))
+    record_pipe = transit_sender.connect(streams=streams)
 
     print("Sending (%s).." % transit_sender.describe())
 
-    CHUNKSIZE = 64*1024
-    with open(args.what, "rb") as f:
-        sent = 0
+    offset = 0
+    if their_hashes is not None:
+        # Only now do we read (and hash) as much of the file as they have.
+        # Before any data, we tell them how much of it matched, which is
+        # where we start.
+        chunk_size = phase1["file"]["resume"]["chunk_size"]
+        with open(args.what, "rb") as f:
+            offset = verified_prefix(f, filesize, chunk_size, their_hashes)
+        record_pipe.send_record(json.dumps({"resume_offset": offset})
+                                .encode("utf-8"))
+        if offset:
+            print("Resuming: the receiver already has %d bytes" % offset)
+
+    limits = transit_sender.relay_limits
+    if limits:
+        # each record adds a 4-byte length, a 24-byte nonce, and a 16-byte
+        # MAC. Records may shrink to MIN_RECORD_SIZE, so assume the worst.
+        # With compression, there's a flag byte in each, and a last empty
+        # record, but we can't count on the data getting any smaller.
+        remaining = filesize - offset
+        records = (remaining + MIN_RECORD_SIZE - 1) // MIN_RECORD_SIZE
+        wire_size = remaining + records * (4+RECORD_OVERHEAD)
+        if codec:
+            wire_size += records + 4+RECORD_OVERHEAD
+        max_bytes = limits.get("max-bytes")
+        if max_bytes and wire_size > max_bytes:
+            print("Transit relay only allows %d bytes, but this file needs %d"
+                  % (max_bytes, wire_size))
+            print("transfer abandoned")
+            record_pipe.close()
+            return 1
+        max_rate = limits.get("max-rate")
+        max_seconds = limits.get("max-seconds")
+        if max_rate and max_seconds and wire_size > max_rate * max_seconds:
+            print("Transit relay only allows %d seconds at %d bytes/s, which"
+                  " is not enough for %d bytes"
+                  % (max_seconds, max_rate, wire_size))
+            print("transfer abandoned")
+            record_pipe.close()
+            return 1
+    def _seal(plaintext):
+        return len(plaintext), record_pipe.seal_record(plaintext)
+    stages = [_seal]
+    compressor = None
+    if codec:
+        # a thread of its own, so it can overlap with the encryption
+        compressor = Compressor(codec)
+        def _compress(plaintext):
+            # remember how much of the file this was, for progress
+            return len(plaintext), compressor.frame(plaintext)
+        def _seal_compressed(framed):
+            (size, record) = framed
+            return size, record_pipe.seal_record(record)
+        stages = [_compress, _seal_compressed]
+    # the flag byte counts against the record size we promised
+    sizer = RecordSizer(max_record_size - (1 if codec else 0),
+                        skt=record_pipe.skt)
+    f = None
+    if archive:
+        chunks = archive.chunks(sizer)
+    else:
+        f = open(args.what, "rb")
+        chunks = file_chunks(f, filesize, sizer, offset)
+    try:
+        sent = offset
         next_update = start_progress(filesize)
-        while sent < filesize:
-            plaintext = f.read(CHUNKSIZE)
-            record_pipe.send_record(plaintext)
-            sent += len(plaintext)
+        # a thread reads, another compresses, another encrypts, and we send
+        for (size, sealed) in pipelined(chunks, stages):
+            started = time.time()
+            record_pipe.send_sealed(sealed)
+            sizer.sent(size, time.time() - started)
+            sent += size
             next_update = update_progress(next_update, sent, filesize)
+        if compressor:
+            record_pipe.send_record(b"") # the end
         finish_progress(filesize)
+        if compressor and compressor.bytes_in:
+            print("Compressed with %s to %d%%"
+                  % (codec, 100 * compressor.bytes_out
+                     // compressor.bytes_in))
+    except ArchiveError as e:
+        print()
+        print("Error: %s" % e)
+        print("transfer abandoned")
+        record_pipe.close()
+        return 1
+    finally:
+        if f:
+            f.close()
 
-    print("File sent.. waiting for confirmation")
+    print("%s sent.. waiting for confirmation"
+          % ("Directory" if archive else "File"))
     ack = record_pipe.receive_record()
     if ack == b"ok\n":
         print("Confirmation received. Transfer complete.")
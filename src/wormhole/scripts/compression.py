@@ -0,0 +1,148 @@
+from __future__ import print_function
+import zlib
+
+# Records can be compressed before they are encrypted. The sender's offer
+# lists the codecs it has (best first), the receiver's answer names the one
+# it picked (if any), and from then on each record's plaintext starts with a
+# flag byte saying whether the rest of it is compressed. That lets the
+# sender send data that doesn't compress (media, archives, encrypted
+# things) as it is, and stop spending CPU on trying: after a few records
+# that didn't shrink, it only tries one record in PROBE_EVERY, in case the
+# data changes.
+#
+# Since the receiver can no longer tell from the record lengths when the
+# file is complete, a compressed transfer ends with an empty record (which
+# otherwise can't happen: every record has its flag byte).
+
+RAW = b"\x00"
+COMPRESSED = b"\x01"
+
+class DecompressionError(Exception):
+    pass
+
+class Codec:
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        # decompress(data, max_size) must refuse to produce more than
+        # max_size bytes: a small record could otherwise expand to gigabytes
+        self.decompress = decompress
+
+def _zlib_ended(d):
+    # whether decompressobj 'd' has seen the end of its stream. py2's has
+    # no .eof, but there, anything after the end lands in unused_data.
+    if hasattr(d, "eof"):
+        return d.eof
+    if d.unused_data:
+        return True
+    try:
+        d.decompress(b"\x00")
+    except zlib.error:
+        return False
+    return bool(d.unused_data)
+
+def _zlib_decompress(data, max_size):
+    d = zlib.decompressobj()
+    out = d.decompress(data, max_size)
+    if d.unconsumed_tail or not _zlib_ended(d):
+        raise DecompressionError("record is too big, or truncated")
+    return out
+
+CODECS = {"zlib": Codec("zlib", lambda data: zlib.compress(data, 1),
+                        _zlib_decompress)}
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    def _zstd_decompress(data, max_size):
+        size = zstandard.frame_content_size(data)
+        if size < 0 or size > max_size:
+            raise DecompressionError("record has a bad size")
+        return zstandard.ZstdDecompressor().decompress(data)
+    # only ever used by the one thread that compresses
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    CODECS["zstd"] = Codec("zstd", _zstd_compressor.compress,
+                           _zstd_decompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    def _lz4_decompress(data, max_size):
+        size = lz4.frame.get_frame_info(data).get("content_size")
+        if not size or size > max_size: # we always record it
+            raise DecompressionError("record has a bad size")
+        return lz4.frame.decompress(data)
+    CODECS["lz4"] = Codec("lz4",
+                          lambda data: lz4.frame.compress(
+                              data, store_size=True),
+                          _lz4_decompress)
+
+# fast and good first
+PREFERENCE = ["zstd", "lz4", "zlib"]
+
+def available_codecs():
+    return [name for name in PREFERENCE if name in CODECS]
+
+def choose_codec(offered):
+    # the receiver takes the sender's favourite among those it also has
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return None
+
+class Compressor:
+    GOOD_RATIO = 0.9 # a record must shrink to this to be worth compressing
+    GIVE_UP_AFTER = 4
+    PROBE_EVERY = 16
+
+    def __init__(self, name):
+        self.codec = CODECS[name]
+        self.misses = 0 # records in a row that didn't shrink
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _worth_trying(self):
+        if self.misses < self.GIVE_UP_AFTER:
+            return True
+        self.skipped += 1
+        if self.skipped >= self.PROBE_EVERY:
+            self.skipped = 0
+            return True
+        return False
+
+    def frame(self, data):
+        # returns the flag byte and either the compressed or the original
+        # data
+        self.bytes_in += len(data)
+        if self._worth_trying():
+            compressed = self.codec.compress(data)
+            if len(compressed) <= len(data) * self.GOOD_RATIO:
+                self.misses = 0
+                self.bytes_out += 1 + len(compressed)
+                return COMPRESSED + compressed
+            self.misses += 1
+        self.bytes_out += 1 + len(data)
+        return RAW + data
+
+class Decompressor:
+    def __init__(self, name, max_size):
+        self.codec = CODECS[name]
+        self.max_size = max_size
+
+    def unframe(self, record):
+        flag, data = record[:1], record[1:]
+        if flag == RAW:
+            return data
+        if flag == COMPRESSED:
+            try:
+                return self.codec.decompress(data, self.max_size)
+            except DecompressionError:
+                raise
+            except Exception as e:
+                raise DecompressionError(str(e))
+        raise DecompressionError("unknown record flag %r" % (flag,))
@@ -0,0 +1,68 @@
+from __future__ import print_function
+import hashlib
+
+# To resume an interrupted file transfer, the sender's offer says how it
+# would hash the file: SHA-256, in chunks of 'chunk_size' bytes. That costs
+# nothing up front. A receiver that still has the .tmp file from last time
+# hashes the whole chunks it holds, and sends those hashes back with its
+# answer. Only then does the sender read (and hash) that much of its own
+# file. It tells the receiver, in the first transit record, how many bytes
+# at the start matched (always a whole number of chunks), and starts
+# sending there. Both answers travel through the (encrypted) rendezvous
+# channel, so chunks are made big enough to keep them under MAX_HASHES
+# hashes.
+
+MIN_CHUNK_SIZE = 1024*1024
+MAX_HASHES = 1024
+READ_SIZE = 256*1024
+
+def chunk_size_for(filesize):
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size * MAX_HASHES < filesize:
+        chunk_size *= 2
+    return chunk_size
+
+def hash_chunks(f, filesize, chunk_size):
+    # yields the hex hash of each chunk from the start of 'f', stopping early
+    # if the file is shorter than 'filesize'
+    f.seek(0)
+    remaining = filesize
+    while remaining > 0:
+        h = hashlib.sha256()
+        wanted = min(chunk_size, remaining)
+        got = 0
+        while got < wanted:
+            data = f.read(min(READ_SIZE, wanted - got))
+            if not data:
+                return
+            h.update(data)
+            got += len(data)
+        remaining -= wanted
+        yield h.hexdigest()
+
+def resume_offer(filesize):
+    return {"hash": "sha256",
+            "chunk_size": chunk_size_for(filesize),
+            }
+
+def partial_hashes(f, filesize, offer):
+    # the receiver's side: hashes of the whole chunks at the start of 'f'.
+    # An offer we don't understand gets nothing.
+    try:
+        chunk_size = int(offer["chunk_size"])
+        if offer.get("hash") != "sha256" or chunk_size <= 0:
+            return []
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return []
+    return list(hash_chunks(f, filesize, chunk_size))
+
+def verified_prefix(f, filesize, chunk_size, hashes):
+    # the sender's side: how many bytes at the start of 'f' match the
+    # receiver's hashes
+    verified = 0
+    for (ours, theirs) in zip(hash_chunks(f, filesize, chunk_size),
+                              hashes[:MAX_HASHES]):
+        if ours != theirs:
+            break
+        verified = min(verified + chunk_size, filesize)
+    return verified
@@ -40,6 +40,23 @@ sp_start.add_argument("--transit", default="tcp:3001", metavar="tcp:PORT",
                       help="endpoint specification for the transit-relay port")
 sp_start.add_argument("--advertise-version", metavar="VERSION",
                       help="version to recommend to clients")
+sp_start.add_argument("--transit-max-bytes", type=int, metavar="BYTES",
+                      help="drop relayed connections after this many bytes"
+                      " (per side, default 0: no limit)")
+sp_start.add_argument("--transit-max-seconds", type=int, metavar="SECONDS",
+                      help="drop relayed connections after this long"
+                      " (default 0: no limit)")
+sp_start.add_argument("--transit-max-rate", type=int, metavar="BYTES/SEC",
+                      help="throttle each side of a relayed connection"
+                      " (default 0: no limit)")
+sp_start.add_argument("--transit-forwarding",
+                      choices=["reactor", "splice", "buffer"],
+                      help="how to forward relayed data: through the reactor"
+                      " (default), or in threads with os.splice() or a"
+                      " reused buffer")
+sp_start.add_argument("--workers", type=int, default=1, metavar="N",
+                      help="run N relay processes sharing the ports"
+                      " (tcp:PORT endpoints only)")
 sp_start.add_argument("-n", "--no-daemon", action="store_true")
 #sp_start.add_argument("twistd_args", nargs="*", default=None,
 #                      metavar="[TWISTD-ARGS..]",
@@ -60,19 +77,43 @@ sp_restart.add_argument("--transit", default="tcp:3001", metavar="tcp:PORT",
                         help="endpoint specification for the transit-relay port")
 sp_restart.add_argument("--advertise-version", metavar="VERSION",
                         help="version to recommend to clients")
+sp_restart.add_argument("--transit-max-bytes", type=int, metavar="BYTES",
+                        help="drop relayed connections after this many bytes"
+                        " (per side, default 0: no limit)")
+sp_restart.add_argument("--transit-max-seconds", type=int, metavar="SECONDS",
+                        help="drop relayed connections after this long"
+                        " (default 0: no limit)")
+sp_restart.add_argument("--transit-max-rate", type=int, metavar="BYTES/SEC",
+                        help="throttle each side of a relayed connection"
+                        " (default 0: no limit)")
+sp_restart.add_argument("--transit-forwarding",
+                        choices=["reactor", "splice", "buffer"],
+                        help="how to forward relayed data: through the reactor"
+                        " (default), or in threads with os.splice() or a"
+                        " reused buffer")
+sp_restart.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="run N relay processes sharing the ports"
+                        " (tcp:PORT endpoints only)")
 sp_restart.set_defaults(func=cmd_server.restart_server)
 
 # CLI: send
 p = subparsers.add_parser("send",
-                          description="Send text message or file",
+                          description="Send text message, file, or directory",
                           usage="wormhole send [FILENAME]")
 p.add_argument("--text", metavar="MESSAGE",
                help="text message to send, instead of a file")
 p.add_argument("--code", metavar="CODE", help="human-generated code phrase")
 p.add_argument("-0", dest="zeromode", action="store_true",
                help="enable no-code anything-goes mode")
+p.add_argument("--no-compress", dest="compress", action="store_false",
+               help="don't offer to compress the file on the way")
+p.add_argument("--streams", type=int, default=1, metavar="N",
+               help=dedent("""\
+               Send the file over N connections at once (if the receiver
+               agrees), which can help on fast links with long round
+               trips."""))
 p.add_argument("what", nargs="?", default=None, metavar="[FILENAME]",
-               help="the file to send")
+               help="the file or directory to send")
 p.set_defaults(func=cmd_send.send)
 
 # CLI: receive
@@ -90,6 +131,12 @@ p.add_argument("-o", "--output-file", default=None, metavar="FILENAME",
                The file to create, overriding the filename suggested by the
                sender."""),
                )
+p.add_argument("--sync-every", type=int, default=None, metavar="BYTES",
+               help=dedent("""\
+               Flush the received file to disk (fdatasync) each time this many
+               more bytes have been written. By default, this is left to the
+               operating system."""),
+               )
 p.add_argument("code", nargs="?", default=None, metavar="[CODE]",
                help=dedent("""\
                The magic-wormhole code, from the sender. If omitted, the
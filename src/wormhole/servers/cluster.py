@@ -0,0 +1,450 @@
+from __future__ import print_function
+import os, sys, json, errno, socket, struct, hashlib
+from collections import deque
+from zope.interface import implementer
+from twisted.python import log
+from twisted.internet import reactor, defer, protocol, interfaces
+from twisted.protocols import basic
+from twisted.application import service
+
+# "wormhole server start --workers N" runs N worker processes, each with its
+# own reactor and its own RelayServer, under a Supervisor in the original
+# (twistd) process. The pieces are:
+#
+# * listening: every worker binds its own socket to the rendezvous and
+#   transit ports with SO_REUSEPORT, and the kernel spreads new connections
+#   across them. The supervisor holds a bound (but not listening) socket on
+#   each port, which reserves it and resolves "tcp:0".
+# * channel state: every worker keeps a full in-memory copy of the channels.
+#   A worker that changes one (allocate, message, deallocate, expire) applies
+#   it locally, persists it to the shared sqlite DB (in WAL mode, so workers
+#   don't block each other's readers), and publishes it to the supervisor's
+#   hub as a JSON line. The hub copies it to every other worker, which
+#   applies it without persisting, and pushes new messages to its own
+#   event-stream subscribers. Channel-ids are partitioned (cid % N == worker)
+#   so two workers never allocate the same one.
+# * transit: each token belongs to one worker (a hash of the token, mod N).
+#   A worker that reads a request for somebody else's token passes the
+#   connection's file descriptor, along with the request line, to the owner
+#   over a unix datagram socket (SCM_RIGHTS), so both halves of a pair always
+#   meet in the same process, which then forwards them as usual.
+#
+# Replication is asynchronous: a GET that lands on a different worker than
+# the POST before it may briefly miss that message, but event-stream
+# subscribers (which is what clients use) always get it.
+
+MB = 1000*1000
+HUB_FD = 3 # in the worker: connection to the supervisor's hub
+HANDOFF_IN_FD = 4 # in the worker: transit connections handed to us
+HANDOFF_OUT_FD = 5 # in the worker: 5+i sends connections to worker i
+RESPAWN_DELAY = 1.0
+# connections waiting for a slow worker to take them, before we give up on
+# new ones
+MAX_HANDOFF_QUEUE = 1000
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+def check_platform():
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("--workers needs SO_REUSEPORT, which this platform"
+                         " does not have")
+    if not hasattr(socket.socket, "sendmsg"):
+        # py2 can't pass descriptors between processes
+        raise ValueError("--workers needs python 3.3 or newer")
+
+def parse_tcp_endpoint(description):
+    # "tcp:PORT" or "tcp:PORT:interface=ADDR", as accepted by --rendezvous
+    parts = description.split(":")
+    if parts[0] != "tcp" or len(parts) < 2:
+        raise ValueError("--workers needs tcp:PORT endpoints, not '%s'"
+                         % description)
+    interface = ""
+    for option in parts[2:]:
+        (name, _, value) = option.partition("=")
+        if name != "interface":
+            raise ValueError("unsupported option '%s' in '%s'"
+                             % (option, description))
+        interface = value
+    return (interface, int(parts[1]))
+
+def reuseport_socket(interface, port):
+    check_platform()
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    skt = socket.socket(family, socket.SOCK_STREAM)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    skt.bind((interface, port))
+    return skt
+
+def token_owner(token, workers):
+    # must agree across processes, so hash() (which is salted) won't do
+    digest = hashlib.sha256(token).digest()
+    return struct.unpack(">L", digest[:4])[0] % workers
+
+@implementer(interfaces.IStreamServerEndpoint)
+class ReusePortEndpoint:
+    def __init__(self, interface, port, reactor=reactor):
+        self.interface = interface
+        self.port = port
+        self.reactor = reactor
+
+    def listen(self, factory):
+        try:
+            skt = reuseport_socket(self.interface, self.port)
+        except Exception:
+            return defer.fail()
+        try:
+            skt.listen(50)
+            skt.setblocking(False)
+            # adoptStreamPort() dups the descriptor, so we close ours
+            port = self.reactor.adoptStreamPort(skt.fileno(), skt.family,
+                                                factory)
+        except Exception:
+            return defer.fail()
+        finally:
+            skt.close()
+        return defer.succeed(port)
+
+class HubClient(basic.LineOnlyReceiver):
+    # the worker's end of the hub connection: events from the other workers
+    delimiter = b"\n"
+    MAX_LENGTH = 16*MB
+
+    def __init__(self, relay, lost):
+        self.relay = relay
+        self.lost = lost
+
+    def publish(self, event):
+        self.sendLine(json.dumps(event).encode("utf-8"))
+
+    def lineReceived(self, line):
+        self.relay.apply_event(json.loads(line.decode("utf-8")))
+
+    def connectionLost(self, reason):
+        self.lost()
+
+@implementer(interfaces.IReadDescriptor)
+class HandoffReader:
+    # receives transit connections (descriptor + request line) from other
+    # workers, and adopts them as if they had connected to us directly
+    def __init__(self, skt, transit, reactor=reactor):
+        self.skt = skt
+        self.skt.setblocking(False)
+        self.transit = transit
+        self.reactor = reactor
+
+    def fileno(self):
+        return self.skt.fileno()
+
+    def logPrefix(self):
+        return "HandoffReader"
+
+    def doRead(self):
+        while True:
+            try:
+                (data, ancdata, flags, addr) = self.skt.recvmsg(
+                    1024, socket.CMSG_SPACE(struct.calcsize("i")))
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in _WOULD_BLOCK:
+                    return
+                raise
+            for (level, type, fds) in ancdata:
+                if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                    (fd,) = struct.unpack("i", fds[:struct.calcsize("i")])
+                    self.adopt(fd, data)
+
+    def adopt(self, fd, data):
+        (family, request) = data.split(b" ", 1)
+        try:
+            t = self.reactor.adoptStreamConnection(fd, int(family),
+                                                   self.transit)
+        except Exception:
+            log.err(None, "unable to adopt a handed-off transit connection")
+            return
+        finally:
+            os.close(fd) # adoptStreamConnection() dups it
+        if t:
+            t.protocol.dataReceived(request)
+
+    def connectionLost(self, reason):
+        pass
+
+def forget_connection(p):
+    # Another worker has its own reference to p's connection now, so we
+    # just close our descriptor. loseConnection() would shut the connection
+    # down, and abortConnection() sets SO_LINGER, which would make the new
+    # owner's eventual close() send a RST and discard any unsent data.
+    p.transport.stopReading()
+    p.transport.stopWriting()
+    p.transport.getHandle().close()
+
+@implementer(interfaces.IWriteDescriptor)
+class HandoffWriter:
+    # sends transit connections (descriptor + request line) to one other
+    # worker. The socket is non-blocking: when that worker falls behind,
+    # connections wait here (not being read) until it catches up, rather
+    # than stalling our reactor.
+    def __init__(self, skt, index, reactor=reactor):
+        self.skt = skt
+        self.skt.setblocking(False)
+        self.index = index
+        self.reactor = reactor
+        self.queue = deque() # (TransitConnection, message)
+
+    def fileno(self):
+        return self.skt.fileno()
+
+    def logPrefix(self):
+        return "HandoffWriter"
+
+    def send(self, p, message):
+        if len(self.queue) >= MAX_HANDOFF_QUEUE:
+            log.msg("worker %d is not taking transit connections"
+                    % self.index)
+            p.transport.loseConnection()
+            return
+        self.queue.append((p, message))
+        if len(self.queue) == 1:
+            self.doWrite()
+
+    def doWrite(self):
+        while self.queue:
+            (p, message) = self.queue[0]
+            fd = struct.pack("i", p.transport.getHandle().fileno())
+            try:
+                self.skt.sendmsg([message],
+                                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fd)])
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if e.args[0] in _WOULD_BLOCK:
+                    self.reactor.addWriter(self)
+                    return
+                self.queue.popleft()
+                log.msg("unable to hand transit connection to worker %d: %s"
+                        % (self.index, e))
+                p.transport.loseConnection()
+                continue
+            self.queue.popleft()
+            forget_connection(p)
+        self.reactor.removeWriter(self)
+
+    def connectionLost(self, reason):
+        pass
+
+class WorkerLink:
+    # What a worker's RelayServer uses to cooperate with the other workers.
+    # The descriptors were set up for us by the Supervisor.
+    def __init__(self, index, workers, hub_fd=HUB_FD,
+                 handoff_in_fd=HANDOFF_IN_FD, handoff_out_fd=HANDOFF_OUT_FD,
+                 hub_lost=lambda: None, reactor=reactor):
+        self.index = index
+        self.hub_lost = hub_lost
+        self.workers = workers
+        self.reactor = reactor
+        self._hub_fd = hub_fd
+        self._handoff_in = socket.fromfd(handoff_in_fd, socket.AF_UNIX,
+                                         socket.SOCK_DGRAM)
+        os.close(handoff_in_fd)
+        self._handoff_out = []
+        for i in range(workers):
+            fd = handoff_out_fd + i
+            skt = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_DGRAM)
+            os.close(fd)
+            self._handoff_out.append(HandoffWriter(skt, i, reactor))
+        self._hub = None
+
+    def endpoint(self, description):
+        (interface, port) = parse_tcp_endpoint(description)
+        return ReusePortEndpoint(interface, port, self.reactor)
+
+    def connect(self, relay, transit=None):
+        self._hub = HubClient(relay, self.hub_lost)
+        f = protocol.Factory()
+        f.buildProtocol = lambda addr: self._hub
+        self.reactor.adoptStreamConnection(self._hub_fd, socket.AF_UNIX, f)
+        os.close(self._hub_fd)
+        if transit:
+            self.reactor.addReader(HandoffReader(self._handoff_in, transit,
+                                                 self.reactor))
+
+    def publish(self, event):
+        self._hub.publish(event)
+
+    def owns_token(self, token):
+        return token_owner(token, self.workers) == self.index
+
+    def hand_off(self, p, token, request):
+        owner = token_owner(token, self.workers)
+        p.transport.stopReading()
+        family = ("%d " % p.transport.getHandle().family).encode("ascii")
+        self._handoff_out[owner].send(p, family + request)
+
+class HubConnection(basic.LineOnlyReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = 16*MB
+
+    def connectionMade(self):
+        self.factory.hub.connections.add(self)
+
+    def lineReceived(self, line):
+        self.factory.hub.broadcast(line, self)
+
+    def connectionLost(self, reason):
+        self.factory.hub.connections.discard(self)
+
+class Hub:
+    def __init__(self):
+        self.connections = set()
+        self.factory = protocol.Factory.forProtocol(HubConnection)
+        self.factory.hub = self
+
+    def broadcast(self, line, origin):
+        for c in self.connections:
+            if c is not origin:
+                c.sendLine(line)
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.exited = defer.Deferred()
+        self._partial = {1: b"", 2: b""}
+
+    def childDataReceived(self, childFD, data):
+        # relay the worker's log lines into ours
+        lines = (self._partial.get(childFD, b"") + data).split(b"\n")
+        self._partial[childFD] = lines.pop()
+        for line in lines:
+            log.msg("[worker %d] %s" % (self.index,
+                                        line.decode("utf-8", "replace")))
+
+    def processEnded(self, reason):
+        self.exited.callback(None)
+        self.supervisor.worker_exited(self.index, reason)
+
+class Supervisor(service.MultiService):
+    # I run in the twistd process, in place of a RelayServer, and keep
+    # 'workers' RelayServer processes running.
+    def __init__(self, workers, relayport, transitport, advertise_version,
+                 db_url=":memory:", transit_options=None, reactor=reactor):
+        service.MultiService.__init__(self)
+        self.workers = workers
+        self.relayport = relayport
+        self.transitport = transitport
+        self.advertise_version = advertise_version
+        self.db_url = db_url
+        self.transit_options = transit_options or {}
+        self.reactor = reactor
+        self.hub = Hub()
+        self.processes = {} # index -> WorkerProcess
+        self._reserved = []
+        self._handoff = [] # (recv, send) socketpair for each worker
+        self._stopping = False
+
+    def _reserve(self, description):
+        (interface, port) = parse_tcp_endpoint(description)
+        skt = reuseport_socket(interface, port)
+        self._reserved.append(skt)
+        port = skt.getsockname()[1]
+        if interface:
+            return "tcp:%d:interface=%s" % (port, interface)
+        return "tcp:%d" % port
+
+    def startService(self):
+        service.MultiService.startService(self)
+        self.relayport = self._reserve(self.relayport)
+        if self.transitport:
+            self.transitport = self._reserve(self.transitport)
+        if self.db_url != ":memory:":
+            # create the schema once, and switch to WAL (which is sticky),
+            # before several processes start using the file
+            from ..database import get_db
+            db = get_db(self.db_url)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.close()
+        for i in range(self.workers):
+            self._handoff.append(socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_DGRAM))
+        for i in range(self.workers):
+            self._spawn(i)
+
+    def _spawn(self, i):
+        (hub_ours, hub_theirs) = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_STREAM)
+        child_fds = {0: "w", 1: "r", 2: "r",
+                     HUB_FD: hub_theirs.fileno(),
+                     HANDOFF_IN_FD: self._handoff[i][0].fileno()}
+        for (j, (recv, send)) in enumerate(self._handoff):
+            child_fds[HANDOFF_OUT_FD + j] = send.fileno()
+        config = {"index": i, "workers": self.workers,
+                  "relayport": self.relayport,
+                  "transitport": self.transitport,
+                  "advertise_version": self.advertise_version,
+                  "db_url": self.db_url,
+                  "transit_options": self.transit_options}
+        p = WorkerProcess(self, i)
+        argv = [sys.executable, "-m", "wormhole.servers.cluster",
+                json.dumps(config)]
+        self.reactor.spawnProcess(p, sys.executable, argv, env=os.environ,
+                                  childFDs=child_fds)
+        self.processes[i] = p
+        hub_theirs.close()
+        hub_ours.setblocking(False)
+        self.reactor.adoptStreamConnection(hub_ours.fileno(), socket.AF_UNIX,
+                                           self.hub.factory)
+        hub_ours.close()
+
+    def worker_exited(self, i, reason):
+        if self.processes.get(i) is not None:
+            del self.processes[i]
+        if self._stopping:
+            return
+        log.msg("worker %d exited (%s), restarting" % (i, reason.value))
+        self.reactor.callLater(RESPAWN_DELAY, self._respawn, i)
+
+    def _respawn(self, i):
+        if not self._stopping and i not in self.processes:
+            self._spawn(i)
+
+    def stopService(self):
+        self._stopping = True
+        exits = []
+        for p in list(self.processes.values()):
+            exits.append(p.exited)
+            try:
+                p.transport.signalProcess("TERM")
+            except Exception:
+                pass
+        d = defer.DeferredList(exits)
+        def _stopped(_):
+            for skt in self._reserved:
+                skt.close()
+            for (recv, send) in self._handoff:
+                recv.close()
+                send.close()
+            for c in list(self.hub.connections):
+                c.transport.loseConnection()
+            return service.MultiService.stopService(self)
+        d.addCallback(_stopped)
+        return d
+
+def run_worker(config):
+    from .server import RelayServer
+    log.startLogging(sys.stdout)
+    def orphaned():
+        # the supervisor is gone: don't linger
+        log.msg("lost the connection to the supervisor, shutting down")
+        if reactor.running:
+            reactor.stop()
+    link = WorkerLink(config["index"], config["workers"], hub_lost=orphaned)
+    s = RelayServer(config["relayport"], config["transitport"],
+                    config["advertise_version"], config["db_url"],
+                    config["transit_options"], cluster=link)
+    s.startService()
+    reactor.addSystemEventTrigger("before", "shutdown", s.stopService)
+    reactor.run()
+
+if __name__ == "__main__":
+    run_worker(json.loads(sys.argv[1]))
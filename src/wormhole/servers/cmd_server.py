@@ -9,11 +9,40 @@ class MyPlugin:
         # delay this import as late as possible, to allow twistd's code to
         # accept --reactor= selection
         from .server import RelayServer
+        transit_options = {}
+        if self.args.transit_max_bytes is not None:
+            transit_options["max_length"] = self.args.transit_max_bytes
+        if self.args.transit_max_seconds is not None:
+            transit_options["max_time"] = self.args.transit_max_seconds
+        if self.args.transit_max_rate is not None:
+            transit_options["max_rate"] = self.args.transit_max_rate
+        if self.args.transit_forwarding is not None:
+            transit_options["forwarding"] = self.args.transit_forwarding
+        if self.args.workers > 1:
+            from .cluster import Supervisor
+            return Supervisor(self.args.workers,
+                              self.args.rendezvous, self.args.transit,
+                              self.args.advertise_version,
+                              "relay.sqlite", transit_options)
         return RelayServer(self.args.rendezvous, self.args.transit,
                            self.args.advertise_version,
-                           "relay.sqlite")
+                           "relay.sqlite", transit_options)
+
+def check_workers(args):
+    # refuse --workers up front where it can't work, rather than from
+    # inside the daemon
+    if args.workers > 1:
+        from .cluster import check_platform
+        try:
+            check_platform()
+        except ValueError as e:
+            print("Error: %s" % (e,))
+            return False
+    return True
 
 def start_server(args):
+    if not check_workers(args):
+        return 1
     from twisted.python import usage
     from twisted.scripts import twistd
 
@@ -49,6 +78,8 @@ def stop_server(args):
     return kill_server()
 
 def restart_server(args):
+    if not check_workers(args):
+        return 1
     kill_server()
     time.sleep(0.1)
     timeout = 0
@@ -0,0 +1,125 @@
+from __future__ import print_function
+import time
+from twisted.internet import reactor
+from twisted.application import internet
+from twisted.web import resource
+
+# Metrics for the relay server, rendered in the Prometheus text format
+# (https://prometheus.io/docs/instrumenting/exposition_formats/). The hot
+# paths only ever do an attribute increment: anything that would need a
+# walk over all channels or connections is a Gauge, computed at scrape time.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0)
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return "%d" % value
+
+class Counter:
+    kind = "counter"
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+    def inc(self, amount=1):
+        self.value += amount
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge:
+    kind = "gauge"
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+    def samples(self):
+        return [(self.name, self.function())]
+
+class Histogram:
+    kind = "histogram"
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets) # not cumulative
+        self.count = 0
+        self.sum = 0.0
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+    def time(self, started):
+        self.observe(time.time() - started)
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets, self.counts):
+            cumulative += count
+            samples.append(('%s_bucket{le="%s"}' % (self.name,
+                                                    format_value(bound)),
+                            cumulative))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, self.count))
+        samples.append(("%s_sum" % self.name, self.sum))
+        samples.append(("%s_count" % self.name, self.count))
+        return samples
+
+class Metrics:
+    def __init__(self):
+        self._metrics = [] # in registration order
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, function):
+        return self._add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for m in self._metrics:
+            lines.append("# HELP %s %s" % (m.name, m.help))
+            lines.append("# TYPE %s %s" % (m.name, m.kind))
+            for (name, value) in m.samples():
+                lines.append("%s %s" % (name, format_value(value)))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+    def __init__(self, metrics):
+        resource.Resource.__init__(self)
+        self.metrics = metrics
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return self.metrics.render()
+
+class ReactorLagMonitor(internet.TimerService):
+    # How late a timer fires is how long the reactor was busy with something
+    # else: if this grows along with traffic, the reactor is the bottleneck.
+    INTERVAL = 1.0
+
+    def __init__(self, metrics, clock=reactor):
+        internet.TimerService.__init__(self, self.INTERVAL, self._tick)
+        self.clock = clock
+        self._lag = metrics.histogram("wormhole_relay_reactor_lag_seconds",
+                                      "how late a 1s reactor timer fires")
+        self._expected = None
+
+    def _tick(self):
+        now = self.clock.seconds()
+        if self._expected is not None:
+            self._lag.observe(max(0.0, now - self._expected))
+        self._expected = now + self.INTERVAL
@@ -1,8 +1,10 @@
 from __future__ import print_function
-import re, json, time, random
+import re, json, time, random, heapq, sqlite3
 from twisted.python import log
+from twisted.internet import reactor
 from twisted.application import service, internet
 from twisted.web import server, resource, http
+from .metrics import Metrics, MetricsResource
 
 SECONDS = 1.0
 MINUTE = 60*SECONDS
@@ -12,6 +14,110 @@ MB = 1000*1000
 
 CHANNEL_EXPIRATION_TIME = 3*DAY
 EXPIRATION_CHECK_PERIOD = 2*HOUR
+# each reactor turn of a prune examines at most this many channels
+PRUNE_SLICE = 100
+# queued DB writes are committed at least this often, or as soon as this many
+# statements are waiting
+FLUSH_PERIOD = 1*SECONDS
+FLUSH_THRESHOLD = 100
+
+class WriteBehind(service.Service):
+    # The in-memory Channel objects are the source of truth while we're
+    # running. I persist their changes to the sqlite DB in batches, so that
+    # request handlers never wait for a commit (and its fsync). A crash loses
+    # at most FLUSH_PERIOD worth of changes. A batch the DB refuses (e.g.
+    # "database is locked", or a full disk) is rolled back and tried again
+    # FLUSH_PERIOD later, ahead of whatever was queued since.
+
+    def __init__(self, db, flush_period=FLUSH_PERIOD,
+                 flush_threshold=FLUSH_THRESHOLD, clock=reactor, metrics=None):
+        self.db = db
+        self.flush_period = flush_period
+        self.flush_threshold = flush_threshold
+        self._clock = clock
+        self._pending = [] # (sql, args)
+        self._timer = None
+        self._early_flush = False
+        metrics = metrics or Metrics()
+        self._flush_time = metrics.histogram(
+            "wormhole_relay_db_flush_seconds",
+            "time taken to execute and commit one batch of DB writes")
+        self._flushed = metrics.counter(
+            "wormhole_relay_db_statements_total",
+            "DB statements executed by the write-behind queue")
+        self._failures = metrics.counter(
+            "wormhole_relay_db_flush_failures_total",
+            "batches of DB writes that failed, to be tried again")
+        metrics.gauge("wormhole_relay_db_pending_statements",
+                      "DB statements waiting for the next flush",
+                      lambda: len(self._pending))
+
+    def execute(self, sql, args=()):
+        self._pending.append((sql, args))
+        if len(self._pending) >= self.flush_threshold:
+            # flush on the next reactor turn, not in the middle of a request
+            if not self._early_flush:
+                self._early_flush = True
+                self._cancel_timer()
+                self._timer = self._clock.callLater(0, self.flush)
+        elif not self._timer:
+            self._timer = self._clock.callLater(self.flush_period, self.flush)
+
+    def _cancel_timer(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def flush(self):
+        self._cancel_timer()
+        self._early_flush = False
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        started = time.time()
+        try:
+            for (sql, args) in pending:
+                self.db.execute(sql, args)
+            self.db.commit()
+        except sqlite3.Error:
+            log.err(None, "DB flush of %d statements failed, will retry"
+                    % len(pending))
+            self._failures.inc()
+            try:
+                self.db.rollback()
+            except sqlite3.Error:
+                pass
+            self._pending = pending + self._pending
+            if not self._timer:
+                self._timer = self._clock.callLater(self.flush_period,
+                                                    self.flush)
+            return
+        self._flush_time.time(started)
+        self._flushed.inc(len(pending))
+
+    def stopService(self):
+        self.flush()
+        return service.Service.stopService(self)
+
+def frame_event(data, name=None, id=None, retry=None):
+    # Build the complete text/event-stream framing for one event, so it can
+    # be handed to the transport (or to many transports) in a single write.
+    if isinstance(data, type(u"")):
+        data = data.encode("utf-8")
+    parts = []
+    if name:
+        # e.g. if name=foo, then the client web page should do:
+        # (new EventSource(url)).addEventListener("foo", handlerfunc)
+        # Note that this basically defaults to "message".
+        parts.append(b"event: " + name.encode("utf-8") + b"\n\n")
+    if id:
+        parts.append(b"id: " + id.encode("utf-8") + b"\n\n")
+    if retry:
+        parts.append(b"retry: " + retry + b"\n\n") # milliseconds
+    for line in data.splitlines():
+        parts.append(b"data: " + line + b"\n")
+    parts.append(b"\n")
+    return b"".join(parts)
 
 class EventsProtocol:
     def __init__(self, request):
@@ -25,21 +131,11 @@ class EventsProtocol:
         self.request.write(b": " + comment + b"\n\n")
 
     def sendEvent(self, data, name=None, id=None, retry=None):
-        if name:
-            self.request.write(b"event: " + name.encode("utf-8") + b"\n")
-            # e.g. if name=foo, then the client web page should do:
-            # (new EventSource(url)).addEventListener("foo", handlerfunc)
-            # Note that this basically defaults to "message".
-            self.request.write(b"\n")
-        if id:
-            self.request.write(b"id: " + id.encode("utf-8") + b"\n")
-            self.request.write(b"\n")
-        if retry:
-            self.request.write(b"retry: " + retry + b"\n") # milliseconds
-            self.request.write(b"\n")
-        for line in data.splitlines():
-            self.request.write(b"data: " + line.encode("utf-8") + b"\n")
-        self.request.write(b"\n")
+        self.request.write(frame_event(data, name, id, retry))
+
+    def sendFramedEvents(self, framed):
+        # 'framed' is the output of one or more frame_event() calls
+        self.request.write(framed)
 
     def stop(self):
         self.request.finish()
@@ -57,49 +153,101 @@ class EventsProtocol:
 # all JSON responses include a "welcome:{..}" key
 
 class Channel(resource.Resource):
-    def __init__(self, channel_id, relay, db, welcome):
+    def __init__(self, channel_id, relay, writer, welcome):
         resource.Resource.__init__(self)
         self.channel_id = channel_id
         self.relay = relay
-        self.db = db
+        self.writer = writer
         self.welcome = welcome
+        self.encoded_welcome = json.dumps(welcome).encode("utf-8")
+        self.framed_welcome = frame_event(self.encoded_welcome, name="welcome")
+        self.sides = set()
+        self.messages = [] # (phase, body), in arrival order
+        # each message is JSON-encoded just once, when it arrives, and the
+        # get_messages() response is only rebuilt after a new one is added
+        self.encoded_messages = [] # UTF-8 bytes, same order as .messages
+        self._encoded_response = None
+        self.last_message_time = None
+        self.expiry_key = None # of our entry in Relay._expiry
         self.event_channels = set() # ep
         self.putChild(b"deallocate", Deallocator(self.channel_id, self.relay))
 
+    def add_side(self, side, persist=True):
+        if side in self.sides:
+            return False
+        self.sides.add(side)
+        self.relay.allocator.claim(self.channel_id)
+        if persist:
+            self.writer.execute("INSERT INTO `allocations`"
+                                " (`channel_id`, `side`)"
+                                " VALUES (?,?)",
+                                (self.channel_id, side))
+            self.relay.publish({"event": "add-side",
+                                "channel-id": self.channel_id,
+                                "side": side})
+        return True
+
+    def remove_side(self, side, persist=True):
+        self.sides.discard(side)
+        if persist:
+            self.writer.execute("DELETE FROM `allocations`"
+                                " WHERE `channel_id`=? AND `side`=?",
+                                (self.channel_id, side))
+            self.relay.publish({"event": "remove-side",
+                                "channel-id": self.channel_id,
+                                "side": side})
+
+    def add_message(self, side, phase, body, when, persist=True):
+        encoded = json.dumps({"phase": phase, "body": body}).encode("utf-8")
+        self.messages.append((phase, body))
+        self.encoded_messages.append(encoded)
+        self._encoded_response = None
+        self.last_message_time = when
+        if persist:
+            self.writer.execute("INSERT INTO `messages`"
+                                " (`channel_id`, `side`, `phase`, `body`,"
+                                "  `when`)"
+                                " VALUES (?,?,?,?,?)",
+                                (self.channel_id, side, phase, body, when))
+            self.relay.publish({"event": "add-message",
+                                "channel-id": self.channel_id,
+                                "side": side, "phase": phase, "body": body,
+                                "when": when})
+        return encoded
+
     def get_messages(self, request):
         request.setHeader(b"content-type", b"application/json; charset=utf-8")
-        messages = []
-        for row in self.db.execute("SELECT * FROM `messages`"
-                                   " WHERE `channel_id`=?"
-                                   " ORDER BY `when` ASC",
-                                   (self.channel_id,)).fetchall():
-            messages.append({"phase": row["phase"], "body": row["body"]})
-        data = {"welcome": self.welcome, "messages": messages}
-        return (json.dumps(data)+"\n").encode("utf-8")
+        if self._encoded_response is None:
+            # same as json.dumps({"welcome":.., "messages": [..]})+"\n"
+            self._encoded_response = (b'{"welcome": ' + self.encoded_welcome
+                                      + b', "messages": ['
+                                      + b", ".join(self.encoded_messages)
+                                      + b']}\n')
+        return self._encoded_response
 
     def render_GET(self, request):
         if b"text/event-stream" not in (request.getHeader(b"accept") or b""):
+            self.relay.get_count.inc()
             return self.get_messages(request)
+        self.relay.subscribe_count.inc()
         request.setHeader(b"content-type", b"text/event-stream; charset=utf-8")
         ep = EventsProtocol(request)
-        ep.sendEvent(json.dumps(self.welcome), name="welcome")
         self.event_channels.add(ep)
         request.notifyFinish().addErrback(lambda f:
                                           self.event_channels.discard(ep))
-        for row in self.db.execute("SELECT * FROM `messages`"
-                                   " WHERE `channel_id`=?"
-                                   " ORDER BY `when` ASC",
-                                   (self.channel_id,)).fetchall():
-            data = json.dumps({"phase": row["phase"], "body": row["body"]})
-            ep.sendEvent(data)
+        # the welcome and the backlog go out in a single write
+        backlog = [frame_event(encoded) for encoded in self.encoded_messages]
+        ep.sendFramedEvents(b"".join([self.framed_welcome] + backlog))
         return server.NOT_DONE_YET
 
-    def broadcast_message(self, phase, body):
-        data = json.dumps({"phase": phase, "body": body})
+    def broadcast_message(self, encoded):
+        # frame once, then every subscriber gets the same buffer
+        framed = frame_event(encoded)
         for ep in self.event_channels:
-            ep.sendEvent(data)
+            ep.sendFramedEvents(framed)
 
     def render_POST(self, request):
+        started = time.time()
         #data = json.load(request.content, encoding="utf-8")
         content = request.content.read()
         data = json.loads(content.decode("utf-8"))
@@ -110,17 +258,13 @@ class Channel(resource.Resource):
             raise TypeError("phase must be string, not %s" % type(phase))
         body = data["body"]
 
-        self.db.execute("INSERT INTO `messages`"
-                        " (`channel_id`, `side`, `phase`, `body`, `when`)"
-                        " VALUES (?,?,?,?,?)",
-                        (self.channel_id, side, phase, body, time.time()))
-        self.db.execute("INSERT INTO `allocations`"
-                        " (`channel_id`, `side`)"
-                        " VALUES (?,?)",
-                        (self.channel_id, side))
-        self.db.commit()
-        self.broadcast_message(phase, body)
-        return self.get_messages(request)
+        encoded = self.add_message(side, phase, body, time.time())
+        self.add_side(side)
+        self.broadcast_message(encoded)
+        self.relay.post_count.inc()
+        response = self.get_messages(request)
+        self.relay.post_time.time(started)
+        return response
 
 class Deallocator(resource.Resource):
     def __init__(self, channel_id, relay):
@@ -137,122 +281,309 @@ class Deallocator(resource.Resource):
             resp = {"status": "deleted"}
         return json.dumps(resp).encode("utf-8")
 
-def get_allocated(db):
-    c = db.execute("SELECT DISTINCT `channel_id` FROM `allocations`")
-    return set([row["channel_id"] for row in c.fetchall()])
+class ChannelIdAllocator:
+    # I keep track of which channel-ids are in use, so that allocating one
+    # costs the same no matter how many channels are live. Short ids
+    # (1-999, which make for short codes) are tracked in a bitmap, plus a
+    # free list for each size (1-9, 10-99, 100-999) with an index of where
+    # each id sits in it, so claiming, releasing, and picking a random free
+    # id are all O(1). Larger ids are found by random probing against a set.
+    SHORT_SIZES = 3
+    SHORT_LIMIT = 10**SHORT_SIZES
+    LONG_LIMIT = 1000*1000
 
-class Allocator(resource.Resource):
-    def __init__(self, db, welcome):
-        resource.Resource.__init__(self)
-        self.db = db
-        self.welcome = welcome
+    #
+    # With several workers (see cluster.py), each one only allocates the ids
+    # where cid % workers == worker, but still tracks everybody's claims.
+
+    def __init__(self, worker=0, workers=1):
+        self.worker = worker
+        self.workers = workers
+        self._short_in_use = bytearray(self.SHORT_LIMIT) # bitmap, by cid
+        self._position = [None] * self.SHORT_LIMIT # cid -> index in free list
+        self._free = [] # one list of free ids per size
+        for size in range(1, self.SHORT_SIZES+1):
+            free = [cid for cid in range(10**(size-1), 10**size)
+                    if cid % workers == worker]
+            for (i, cid) in enumerate(free):
+                self._position[cid] = i
+            self._free.append(free)
+        self._long_in_use = set()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, cid):
+        if 0 < cid < self.SHORT_LIMIT:
+            return bool(self._short_in_use[cid])
+        return cid in self._long_in_use
+
+    def allocated(self):
+        in_use = set(self._long_in_use)
+        in_use.update([cid for cid in range(1, self.SHORT_LIMIT)
+                       if self._short_in_use[cid]])
+        return in_use
+
+    def _size_of(self, cid):
+        return len(str(cid)) - 1
 
-    def allocate_channel_id(self):
-        allocated = get_allocated(self.db)
-        for size in range(1,4): # stick to 1-999 for now
-            available = set()
-            for cid in range(10**(size-1), 10**size):
-                if cid not in allocated:
-                    available.add(cid)
-            if available:
-                return random.choice(list(available))
+    def claim(self, cid):
+        if cid in self:
+            return
+        self._count += 1
+        if not (0 < cid < self.SHORT_LIMIT):
+            self._long_in_use.add(cid)
+            return
+        self._short_in_use[cid] = 1
+        i = self._position[cid]
+        if i is None:
+            return # another worker's id
+        # swap the last free id into this one's slot, then shrink the list
+        free = self._free[self._size_of(cid)]
+        last = free.pop()
+        if last != cid:
+            free[i] = last
+            self._position[last] = i
+        self._position[cid] = None
+
+    def release(self, cid):
+        if cid not in self:
+            return
+        self._count -= 1
+        if not (0 < cid < self.SHORT_LIMIT):
+            self._long_in_use.discard(cid)
+            return
+        self._short_in_use[cid] = 0
+        if cid % self.workers != self.worker:
+            return
+        free = self._free[self._size_of(cid)]
+        self._position[cid] = len(free)
+        free.append(cid)
+
+    def allocate(self):
+        for free in self._free: # stick to 1-999 for now
+            if free:
+                cid = random.choice(free)
+                self.claim(cid)
+                return cid
         # ouch, 999 currently allocated. Try random ones for a while.
         for tries in range(1000):
-            cid = random.randrange(1000, 1000*1000)
-            if cid not in allocated:
+            cid = random.randrange(self.SHORT_LIMIT, self.LONG_LIMIT)
+            cid += (self.worker - cid) % self.workers
+            if cid < self.LONG_LIMIT and cid not in self._long_in_use:
+                self.claim(cid)
                 return cid
         raise ValueError("unable to find a free channel-id")
 
+class Allocator(resource.Resource):
+    def __init__(self, relay, welcome):
+        resource.Resource.__init__(self)
+        self.relay = relay
+        self.welcome = welcome
+
     def render_POST(self, request):
         content = request.content.read()
         data = json.loads(content.decode("utf-8"))
         side = data["side"]
         if not isinstance(side, type(u"")):
             raise TypeError("side must be string, not '%s'" % type(side))
-        channel_id = self.allocate_channel_id()
-        self.db.execute("INSERT INTO `allocations` VALUES (?,?)",
-                        (channel_id, side))
-        self.db.commit()
+        channel_id = self.relay.allocator.allocate()
+        self.relay.get_channel(channel_id).add_side(side)
+        self.relay.allocate_count.inc()
         log.msg("allocated #%d, now have %d DB channels" %
-                (channel_id, len(get_allocated(self.db))))
+                (channel_id, len(self.relay.allocator)))
         request.setHeader(b"content-type", b"application/json; charset=utf-8")
         data = {"welcome": self.welcome,
                 "channel-id": channel_id}
         return (json.dumps(data)+"\n").encode("utf-8")
 
 class ChannelList(resource.Resource):
-    def __init__(self, db, welcome):
+    def __init__(self, relay, welcome):
         resource.Resource.__init__(self)
-        self.db = db
+        self.relay = relay
         self.welcome = welcome
     def render_GET(self, request):
-        c = self.db.execute("SELECT DISTINCT `channel_id` FROM `allocations`")
-        allocated = sorted(set([row["channel_id"] for row in c.fetchall()]))
+        allocated = sorted(self.relay.get_allocated())
         request.setHeader(b"content-type", b"application/json; charset=utf-8")
         data = {"welcome": self.welcome,
                 "channel-ids": allocated}
         return (json.dumps(data)+"\n").encode("utf-8")
 
 class Relay(resource.Resource, service.MultiService):
-    def __init__(self, db, welcome):
+    def __init__(self, db, welcome, metrics=None, cluster=None,
+                 clock=reactor):
         resource.Resource.__init__(self)
         service.MultiService.__init__(self)
         self.db = db
         self.welcome = welcome
+        self.metrics = metrics or Metrics()
+        self.writer = WriteBehind(db, metrics=self.metrics)
+        self.writer.setServiceParent(self)
+        self.cluster = cluster # a cluster.WorkerLink, for --workers
+        self.clock = clock
         self.channels = {}
+        # A heap of (last activity, channel_id), with one live entry per
+        # channel, so pruning only looks at channels which might be stale.
+        # New messages don't touch the heap: when an entry comes up and its
+        # channel turns out to have been active since, it is pushed back
+        # with the newer time. Entries whose key no longer matches their
+        # channel's expiry_key (because the channel was freed, or re-pushed)
+        # are dropped when they reach the top.
+        self._expiry = []
+        self._prune_call = None
+        if cluster:
+            self.allocator = ChannelIdAllocator(cluster.index, cluster.workers)
+        else:
+            self.allocator = ChannelIdAllocator()
+        self._add_metrics(self.metrics)
+        self.load_channels()
         t = internet.TimerService(EXPIRATION_CHECK_PERIOD,
                                   self.prune_old_channels)
         t.setServiceParent(self)
 
+    def _add_metrics(self, metrics):
+        metrics.gauge("wormhole_relay_allocated_channels",
+                      "channel-ids currently allocated",
+                      lambda: len(self.allocator))
+        metrics.gauge("wormhole_relay_live_channels",
+                      "channels currently held in memory",
+                      lambda: len(self.channels))
+        metrics.gauge("wormhole_relay_subscribers",
+                      "open event-stream (GET) connections",
+                      lambda: sum([len(c.event_channels)
+                                   for c in self.channels.values()]))
+        self.allocate_count = metrics.counter(
+            "wormhole_relay_allocate_total", "channel-ids allocated")
+        self.post_count = metrics.counter(
+            "wormhole_relay_messages_total", "messages POSTed to channels")
+        self.get_count = metrics.counter(
+            "wormhole_relay_get_total", "non-streaming channel GETs")
+        self.subscribe_count = metrics.counter(
+            "wormhole_relay_subscribe_total", "event-stream channel GETs")
+        self.post_time = metrics.histogram(
+            "wormhole_relay_post_seconds",
+            "time taken to handle one message POST")
+
+    def load_channels(self):
+        # rebuild the in-memory state from whatever the DB remembers
+        for row in self.db.execute("SELECT * FROM `allocations`").fetchall():
+            self.get_channel(row["channel_id"]).add_side(row["side"],
+                                                         persist=False)
+        for row in self.db.execute("SELECT * FROM `messages`"
+                                   " ORDER BY `when` ASC").fetchall():
+            channel = self.get_channel(row["channel_id"])
+            channel.add_message(row["side"], row["phase"], row["body"],
+                                row["when"], persist=False)
+        if self.channels:
+            log.msg("loaded %d channels from DB" % len(self.channels))
+
+    def publish(self, event):
+        # tell the other workers about a change we just made
+        if self.cluster:
+            self.cluster.publish(event)
+
+    def apply_event(self, event):
+        # a change made (and persisted) by another worker
+        channel_id = event["channel-id"]
+        what = event["event"]
+        if what == "add-side":
+            self.get_channel(channel_id).add_side(event["side"],
+                                                  persist=False)
+        elif what == "add-message":
+            channel = self.get_channel(channel_id)
+            encoded = channel.add_message(event["side"], event["phase"],
+                                          event["body"], event["when"],
+                                          persist=False)
+            channel.broadcast_message(encoded)
+        elif what == "remove-side":
+            if channel_id in self.channels:
+                self.channels[channel_id].remove_side(event["side"],
+                                                      persist=False)
+        elif what == "free":
+            self.free_child(channel_id, persist=False)
+
+    def get_allocated(self):
+        return self.allocator.allocated()
+
+    def get_channel(self, channel_id):
+        if not channel_id in self.channels:
+            log.msg("spawning #%d" % channel_id)
+            channel = Channel(channel_id, self, self.writer, self.welcome)
+            self.channels[channel_id] = channel
+            self._schedule_expiry(channel, 0)
+        return self.channels[channel_id]
 
     def getChild(self, path, request):
         if path == b"allocate":
-            return Allocator(self.db, self.welcome)
+            return Allocator(self, self.welcome)
         if path == b"list":
-            return ChannelList(self.db, self.welcome)
+            return ChannelList(self, self.welcome)
+        if path == b"metrics":
+            return MetricsResource(self.metrics)
         if not re.search(br'^\d+$', path):
             return resource.ErrorPage(http.BAD_REQUEST,
                                       "invalid channel id",
                                       "invalid channel id")
         channel_id = int(path)
-        if not channel_id in self.channels:
-            log.msg("spawning #%d" % channel_id)
-            self.channels[channel_id] = Channel(channel_id, self, self.db,
-                                                self.welcome)
-        return self.channels[channel_id]
+        return self.get_channel(channel_id)
 
     def maybe_free_child(self, channel_id, side):
-        self.db.execute("DELETE FROM `allocations`"
-                        " WHERE `channel_id`=? AND `side`=?",
-                        (channel_id, side))
-        self.db.commit()
-        remaining = self.db.execute("SELECT COUNT(*) FROM `allocations`"
-                                    " WHERE `channel_id`=?",
-                                    (channel_id,)).fetchone()[0]
-        if remaining:
-            return False
+        channel = self.channels.get(channel_id)
+        if channel:
+            channel.remove_side(side)
+            if channel.sides:
+                return False
         self.free_child(channel_id)
         return True
 
-    def free_child(self, channel_id):
-        self.db.execute("DELETE FROM `allocations` WHERE `channel_id`=?",
-                        (channel_id,))
-        self.db.execute("DELETE FROM `messages` WHERE `channel_id`=?",
-                        (channel_id,))
-        self.db.commit()
+    def free_child(self, channel_id, persist=True):
+        if persist:
+            self.writer.execute("DELETE FROM `allocations`"
+                                " WHERE `channel_id`=?", (channel_id,))
+            self.writer.execute("DELETE FROM `messages` WHERE `channel_id`=?",
+                                (channel_id,))
+            self.publish({"event": "free", "channel-id": channel_id})
         if channel_id in self.channels:
             self.channels.pop(channel_id)
+        self.allocator.release(channel_id)
         log.msg("freed+killed #%d, now have %d DB channels, %d live" %
-                (channel_id, len(get_allocated(self.db)), len(self.channels)))
-
-    def prune_old_channels(self):
-        old = time.time() - CHANNEL_EXPIRATION_TIME
-        for channel_id in get_allocated(self.db):
-            c = self.db.execute("SELECT `when` FROM `messages`"
-                                " WHERE `channel_id`=?"
-                                " ORDER BY `when` DESC LIMIT 1", (channel_id,))
-            rows = c.fetchall()
-            if not rows or (rows[0]["when"] < old):
-                log.msg("expiring %d" % channel_id)
-                self.free_child(channel_id)
+                (channel_id, len(self.allocator), len(self.channels)))
+
+    def _schedule_expiry(self, channel, key):
+        channel.expiry_key = key
+        heapq.heappush(self._expiry, (key, channel.channel_id))
+
+    def prune_old_channels(self, now=None):
+        # channels with no messages at all are expired too
+        if self._prune_call:
+            return # the previous prune is still going
+        old = (now or time.time()) - CHANNEL_EXPIRATION_TIME
+        self._prune_slice(old)
+
+    def _prune_slice(self, old):
+        self._prune_call = None
+        examined = 0
+        while self._expiry and self._expiry[0][0] < old:
+            if examined >= PRUNE_SLICE:
+                # let other work run, then carry on where we left off
+                self._prune_call = self.clock.callLater(0, self._prune_slice,
+                                                        old)
+                return
+            (key, channel_id) = heapq.heappop(self._expiry)
+            examined += 1
+            channel = self.channels.get(channel_id)
+            if not channel or channel.expiry_key != key:
+                continue # stale entry
+            last = channel.last_message_time or 0
+            if last >= old:
+                self._schedule_expiry(channel, last)
+                continue
+            log.msg("expiring %d" % channel_id)
+            self.free_child(channel_id)
 
+    def stopService(self):
+        if self._prune_call:
+            self._prune_call.cancel()
+            self._prune_call = None
+        return service.MultiService.stopService(self)
@@ -7,6 +7,7 @@ from .. import __version__
 from ..database import get_db
 from .relay_server import Relay
 from .transit_server import Transit
+from .metrics import Metrics, ReactorLagMonitor
 
 class Root(resource.Resource):
     # child_FOO is a nevow thing, not a twisted.web.resource thing
@@ -16,9 +17,14 @@ class Root(resource.Resource):
 
 class RelayServer(service.MultiService):
     def __init__(self, relayport, transitport, advertise_version,
-                 db_url=":memory:"):
+                 db_url=":memory:", transit_options=None, cluster=None):
         service.MultiService.__init__(self)
+        if transit_options is None:
+            transit_options = {}
         self.db = get_db(db_url)
+        if cluster:
+            # we are one of several workers, see cluster.py
+            self.db.execute("PRAGMA journal_mode=WAL")
         welcome = {
             "current_version": __version__,
             # adding .motd will cause all clients to display the message,
@@ -32,14 +38,29 @@ class RelayServer(service.MultiService):
             welcome["current_version"] = advertise_version
         self.root = Root()
         site = server.Site(self.root)
-        r = endpoints.serverFromString(reactor, relayport)
+        if cluster:
+            r = cluster.endpoint(relayport)
+        else:
+            r = endpoints.serverFromString(reactor, relayport)
         self.relayport_service = ServerEndpointService(r, site)
         self.relayport_service.setServiceParent(self)
-        self.relay = Relay(self.db, welcome) # accessible from tests
+        self.metrics = Metrics() # served at /wormhole-relay/metrics
+        ReactorLagMonitor(self.metrics).setServiceParent(self)
+        self.relay = Relay(self.db, welcome, self.metrics,
+                           cluster) # accessible from tests
+        self.relay.setServiceParent(self) # for the timers
         self.root.putChild(b"wormhole-relay", self.relay)
         if transitport:
-            self.transit = Transit()
+            # transit_options is a dict of Transit() keyword arguments,
+            # e.g. max_length=, max_time=, max_rate=, forwarding=
+            self.transit = Transit(metrics=self.metrics, cluster=cluster,
+                                   **transit_options)
             self.transit.setServiceParent(self) # for the timer
-            t = endpoints.serverFromString(reactor, transitport)
+            if cluster:
+                t = cluster.endpoint(transitport)
+            else:
+                t = endpoints.serverFromString(reactor, transitport)
             self.transport_service = ServerEndpointService(t, self.transit)
             self.transport_service.setServiceParent(self)
+        if cluster:
+            cluster.connect(self.relay, self.transit if transitport else None)
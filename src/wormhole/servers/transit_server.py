@@ -1,7 +1,10 @@
 from __future__ import print_function
-import re
-from twisted.internet import protocol
+import os, re, time, socket, threading
+from zope.interface import implementer
+from twisted.python import log
+from twisted.internet import protocol, interfaces, reactor
 from twisted.application import service
+from .metrics import Metrics, DURATION_BUCKETS
 
 SECONDS = 1.0
 MINUTE = 60*SECONDS
@@ -9,6 +12,164 @@ HOUR = 60*MINUTE
 DAY = 24*HOUR
 MB = 1000*1000
 
+# The longest request line we'll wait for: the token plus " with-limits".
+MAX_REQUEST_LENGTH = 100
+
+# How matched pairs are forwarded:
+#  "reactor": dataReceived() -> buddy.transport.write(), the portable default
+#  "splice": a thread per direction moves bytes socket->pipe->socket with
+#            os.splice(), so they never enter Python (Linux, py3.10+)
+#  "buffer": a thread per direction does recv_into() a reused bytearray
+#            and sendall() from it, so no per-chunk bytes objects are made
+# "splice" falls back to "buffer", which falls back to "reactor", when the
+# platform or the transport can't support it.
+FORWARDING_MODES = ["reactor", "splice", "buffer"]
+SPLICE_CHUNK = 1024*1024
+
+class _TooLong(Exception):
+    pass
+
+def get_forwarding_mode(mode):
+    if mode == "splice" and not hasattr(os, "splice"):
+        mode = "buffer"
+    return mode
+
+class Splicer:
+    # I forward both directions of a matched pair in my own threads, taking
+    # their sockets away from the reactor until both directions are done.
+    # Limits are enforced here too: MAXLENGTH and MAXRATE in the threads,
+    # MAXTIME by the Transit's timer calling stop(). As in the reactor mode,
+    # a read that takes a side past MAXLENGTH isn't forwarded: the pair is
+    # dropped, and counted as a failure.
+
+    def __init__(self, a, b, mode, max_length, max_rate, clock=reactor):
+        self._conns = (a, b)
+        self._mode = mode
+        self._max_length = max_length
+        self._max_rate = max_rate
+        self._clock = clock
+        self._running = 0
+
+    def start(self, ok_lines):
+        skts = []
+        for (p, ok) in zip(self._conns, ok_lines):
+            self._clock.removeReader(p.transport)
+            self._clock.removeWriter(p.transport)
+            skt = p.transport.getHandle()
+            skt.setblocking(True)
+            # nothing else has been written to these connections, so this
+            # can't get stuck behind anything in the transport's buffer
+            skt.sendall(ok)
+            skts.append(skt)
+        (a, b) = self._conns
+        for (src, dst, src_skt, dst_skt) in [(a, b, skts[0], skts[1]),
+                                             (b, a, skts[1], skts[0])]:
+            t = threading.Thread(target=self._forward,
+                                 args=(src, src_skt, dst_skt))
+            t.daemon = True
+            self._running += 1
+            t.start()
+
+    def stop(self):
+        # wake up both threads: their blocked reads and writes fail, and
+        # they report back via _direction_done()
+        for p in self._conns:
+            try:
+                p.transport.getHandle().shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _forward(self, src, src_skt, dst_skt):
+        # runs in a thread
+        total = 0
+        too_long = False
+        try:
+            if self._mode == "splice":
+                forwarder = self._splice_chunks(src_skt, dst_skt)
+            else:
+                forwarder = self._copy_chunks(src_skt, dst_skt)
+            allowance = self._max_rate
+            last = time.time()
+            for count in forwarder:
+                total += count
+                src.total_sent = total
+                if self._max_rate:
+                    now = time.time()
+                    allowance = min(self._max_rate,
+                                    allowance + (now-last) * self._max_rate)
+                    last = now
+                    allowance -= count
+                    if allowance < 0:
+                        time.sleep(-allowance / self._max_rate)
+        except _TooLong:
+            too_long = True
+        except (socket.error, OSError):
+            pass
+        # not half-closeable: once either direction stops, so does the pair
+        self._clock.callFromThread(self._direction_done, src, too_long)
+
+    def _chunk_size(self, total):
+        size = SPLICE_CHUNK
+        if self._max_rate:
+            # small enough to throttle in ~0.1s steps
+            size = min(size, max(1, self._max_rate // 10))
+        if self._max_length:
+            # one byte more than is left, so we notice going over
+            size = min(size, self._max_length - total + 1)
+        return size
+
+    def _check_length(self, total):
+        if self._max_length and total > self._max_length:
+            raise _TooLong
+
+    def _splice_chunks(self, src_skt, dst_skt):
+        src_fd, dst_fd = src_skt.fileno(), dst_skt.fileno()
+        (pipe_r, pipe_w) = os.pipe()
+        try:
+            total = 0
+            while True:
+                count = os.splice(src_fd, pipe_w, self._chunk_size(total),
+                                  flags=os.SPLICE_F_MOVE)
+                if not count:
+                    return
+                # what's in the pipe is dropped with it
+                self._check_length(total + count)
+                pending = count
+                while pending:
+                    pending -= os.splice(pipe_r, dst_fd, pending,
+                                         flags=os.SPLICE_F_MOVE)
+                total += count
+                yield count
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+
+    def _copy_chunks(self, src_skt, dst_skt):
+        buf = bytearray(SPLICE_CHUNK)
+        view = memoryview(buf)
+        total = 0
+        while True:
+            count = src_skt.recv_into(buf, self._chunk_size(total))
+            if not count:
+                return
+            self._check_length(total + count)
+            dst_skt.sendall(view[:count])
+            total += count
+            yield count
+
+    def _direction_done(self, src, too_long):
+        if too_long:
+            log.msg("transit length limit exceeded %r" % src)
+            src.factory.transitFailed(src)
+        self._running -= 1
+        if self._running == 1:
+            self.stop()
+        if self._running == 0:
+            for p in self._conns:
+                p.transport.getHandle().setblocking(False)
+                p.transport.loseConnection()
+
+@implementer(interfaces.IPushProducer)
 class TransitConnection(protocol.Protocol):
     def __init__(self):
         self.got_token = False
@@ -16,60 +177,140 @@ class TransitConnection(protocol.Protocol):
         self.sent_ok = False
         self.buddy = None
         self.total_sent = 0
+        self.wants_limits = False
+        self.wait_timer = None # until our buddy shows up
+        self.pair_timer = None # until the pair has used up MAXTIME
+        self._buddy_paused = False
+        self._allowance = 0
+        self._last_refill = None
+        self._throttle_timer = None
+        self.splicer = None
+        self.paired_at = None
 
     def dataReceived(self, data):
         if self.sent_ok:
-            # TODO: connect as producer/consumer
-            self.total_sent += len(data)
-            self.buddy.transport.write(data)
+            self.forward(data)
             return
         if self.got_token: # but not yet sent_ok
-            self.transport.write("impatient\n")
+            self.transport.write(b"impatient\n")
             print("transit impatience failure")
             return self.disconnect() # impatience yields failure
-        # else this should be (part of) the token
+        # else this should be (part of) the request line
         self.token_buffer += data
         buf = self.token_buffer
-        wanted = len("please relay \n")+32*2
-        if len(buf) < wanted-1 and "\n" in buf:
-            self.transport.write("bad handshake\n")
-            print("transit handshake early failure")
-            return self.disconnect()
-        if len(buf) < wanted:
+        if b"\n" not in buf:
+            if len(buf) > MAX_REQUEST_LENGTH:
+                self.transport.write(b"bad handshake\n")
+                print("transit handshake failure")
+                return self.disconnect()
             return
-        if len(buf) > wanted:
-            self.transport.write("impatient\n")
+        if not buf.endswith(b"\n"):
+            self.transport.write(b"impatient\n")
             print("transit impatience failure")
             return self.disconnect() # impatience yields failure
-        mo = re.search(r"^please relay (\w{64})\n", buf, re.M)
+        # "please relay TOKEN\n" gets "ok\n". Clients which add
+        # " with-limits" get "ok max-bytes=.. max-seconds=.. max-rate=..\n"
+        # instead, so they can plan their transfer around our limits.
+        mo = re.search(br"^please relay (\w{64})( with-limits)?\n$", buf)
         if not mo:
-            self.transport.write("bad handshake\n")
+            self.transport.write(b"bad handshake\n")
             print("transit handshake failure")
             return self.disconnect() # incorrectness yields failure
         token = mo.group(1)
+        self.wants_limits = bool(mo.group(2))
 
         self.got_token = True
         self.factory.connection_got_token(token, self)
 
+    def forward(self, data):
+        max_length = self.factory.max_length
+        if max_length and self.total_sent + len(data) > max_length:
+            print("transit length limit exceeded %r" % self)
+            return self.disconnect()
+        self.total_sent += len(data)
+        self.buddy.transport.write(data)
+        max_rate = self.factory.max_rate
+        if max_rate:
+            # token bucket: we may send max_rate bytes per second, with
+            # bursts of up to one second's worth. When we overdraw, stop
+            # reading until the allowance has been earned back.
+            now = self.factory.clock.seconds()
+            self._allowance = min(max_rate,
+                                  self._allowance +
+                                  (now - self._last_refill) * max_rate)
+            self._last_refill = now
+            self._allowance -= len(data)
+            if self._allowance < 0 and not self._throttle_timer:
+                delay = -self._allowance / max_rate
+                self._throttle_timer = self.factory.clock.callLater(
+                    delay, self._unthrottle)
+                self._update_reading()
+
+    def _unthrottle(self):
+        self._throttle_timer = None
+        self._update_reading()
+
+    def _update_reading(self):
+        if self._buddy_paused or self._throttle_timer:
+            self.transport.pauseProducing()
+        else:
+            self.transport.resumeProducing()
+
+    # IPushProducer, on behalf of our buddy's transport
+    def pauseProducing(self):
+        self._buddy_paused = True
+        self._update_reading()
+    def resumeProducing(self):
+        self._buddy_paused = False
+        self._update_reading()
+    def stopProducing(self):
+        self.transport.loseConnection()
+
     def buddy_connected(self, them):
         self.buddy = them
-        self.transport.write(b"ok\n")
+        if self.wants_limits:
+            self.transport.write(self.factory.describe_limits())
+        else:
+            self.transport.write(b"ok\n")
         self.sent_ok = True
-        # TODO: connect as producer/consumer
+        self._allowance = self.factory.max_rate
+        self._last_refill = self.factory.clock.seconds()
+        # Everything we read is written to our buddy, so we act as a
+        # streaming producer for their transport: when their write buffer
+        # fills up, they pauseProducing() us, which stops reading from our
+        # socket until they've drained. The Transit calls buddy_connected()
+        # on both sides, so this sets up both directions.
+        them.transport.registerProducer(self, True)
 
     def buddy_disconnected(self):
         print("buddy_disconnected %r" % self)
         self.buddy = None
+        self.transport.unregisterProducer()
         self.transport.loseConnection()
 
+    def cancel_timers(self):
+        for timer in [self.wait_timer, self.pair_timer, self._throttle_timer]:
+            if timer and timer.active():
+                timer.cancel()
+        self.wait_timer = self.pair_timer = self._throttle_timer = None
+
     def connectionLost(self, reason):
         print("connectionLost %r %s" % (self, reason))
+        self.cancel_timers()
         if self.buddy:
             self.buddy.buddy_disconnected()
         self.factory.transitFinished(self, self.total_sent)
 
+    def can_splice(self):
+        # we need a real TCP socket to hand to the Splicer
+        return (interfaces.ITCPTransport.providedBy(self.transport)
+                and isinstance(self.transport.getHandle(), socket.socket))
+
     def disconnect(self):
-        self.transport.loseConnection()
+        if self.splicer:
+            self.splicer.stop() # it will close both connections
+        else:
+            self.transport.loseConnection()
         self.factory.transitFailed(self)
 
 class Transit(protocol.ServerFactory, service.MultiService):
@@ -82,10 +323,14 @@ class Transit(protocol.ServerFactory, service.MultiService):
     # You will not receive "ok\n" until the other side has also connected and
     # submitted a matching token. The token is the same for each side.
 
-    # In addition, the connections will be dropped after MAXLENGTH bytes have
-    # been sent by either side, or MAXTIME seconds have elapsed after the
-    # matching connections were established. A future API will reveal these
-    # limits to clients instead of causing mysterious spontaneous failures.
+    # In addition, operators can have the connections dropped after
+    # MAXLENGTH bytes have been sent by either side, or MAXTIME seconds have
+    # elapsed after the matching connections were established, and each
+    # side throttled to MAXRATE bytes per second. Each of these is 0 (no
+    # limit) unless it is configured. Clients which begin with "please relay
+    # TOKEN with-limits\n" are told these limits in their response, e.g. "ok
+    # max-bytes=10000000 max-seconds=60 max-rate=0\n", instead of causing
+    # mysterious spontaneous failures.
 
     # These relay connections are not half-closeable (unlike full TCP
     # connections, applications will not receive any data after half-closing
@@ -95,35 +340,130 @@ class Transit(protocol.ServerFactory, service.MultiService):
     # data in one direction can use close() as usual.
 
     MAX_WAIT_TIME = 30*SECONDS
-    MAXLENGTH = 10*MB
-    MAXTIME = 60*SECONDS
+    MAXLENGTH = 0 # bytes, e.g. 10*MB
+    MAXTIME = 0 # seconds, e.g. 60*SECONDS
+    MAXRATE = 0 # bytes per second
     protocol = TransitConnection
 
-    def __init__(self):
+    def __init__(self, max_wait_time=MAX_WAIT_TIME, max_length=MAXLENGTH,
+                 max_time=MAXTIME, max_rate=MAXRATE, forwarding="reactor",
+                 clock=reactor, metrics=None, cluster=None):
         service.MultiService.__init__(self)
+        self.max_wait_time = max_wait_time
+        self.max_length = max_length
+        self.max_time = max_time
+        self.max_rate = max_rate
+        if forwarding not in FORWARDING_MODES:
+            raise ValueError("unknown forwarding mode '%s'" % (forwarding,))
+        self.forwarding = get_forwarding_mode(forwarding)
+        self.clock = clock
+        self.cluster = cluster # a cluster.WorkerLink, for --workers
         self.pending_requests = {} # token -> TransitConnection
         self.active_connections = set() # TransitConnection
+        self._add_metrics(metrics or Metrics())
+
+    def _add_metrics(self, metrics):
+        metrics.gauge("wormhole_transit_pending_connections",
+                      "transit connections waiting for their buddy",
+                      lambda: len(self.pending_requests))
+        metrics.gauge("wormhole_transit_active_connections",
+                      "transit connections currently being forwarded",
+                      lambda: len(self.active_connections))
+        metrics.gauge("wormhole_transit_active_bytes",
+                      "bytes forwarded so far by the active connections",
+                      lambda: sum([p.total_sent
+                                   for p in self.active_connections]))
+        self._pairs = metrics.counter("wormhole_transit_pairs_total",
+                                      "transit connections paired up")
+        self._bytes = metrics.counter(
+            "wormhole_transit_bytes_total",
+            "bytes forwarded by transit connections that have finished")
+        self._failures = metrics.counter(
+            "wormhole_transit_failures_total",
+            "transit connections dropped for expiring or breaking a limit")
+        self._pair_time = metrics.histogram(
+            "wormhole_transit_pair_seconds",
+            "how long each pair of transit connections lasted",
+            DURATION_BUCKETS)
+
+    def describe_limits(self):
+        # bytes can't be %-formatted before py3.5
+        line = ("ok max-bytes=%d max-seconds=%d max-rate=%d\n"
+                % (self.max_length, self.max_time, self.max_rate))
+        return line.encode("ascii")
 
     def connection_got_token(self, token, p):
+        if self.cluster and not self.cluster.owns_token(token):
+            # our buddy will be sent to the same worker
+            request = b"please relay " + token
+            if p.wants_limits:
+                request += b" with-limits"
+            self.cluster.hand_off(p, token, request + b"\n")
+            return
         if token in self.pending_requests:
             print("transit relay 2: %r" % token)
             buddy = self.pending_requests.pop(token)
+            buddy.cancel_timers()
+            self._pairs.inc()
+            p.paired_at = buddy.paired_at = self.clock.seconds()
             self.active_connections.add(p)
             self.active_connections.add(buddy)
-            p.buddy_connected(buddy)
-            buddy.buddy_connected(p)
+            if (self.forwarding != "reactor"
+                and p.can_splice() and buddy.can_splice()):
+                self.splice(p, buddy)
+            else:
+                p.buddy_connected(buddy)
+                buddy.buddy_connected(p)
+            if self.max_time:
+                p.pair_timer = self.clock.callLater(self.max_time,
+                                                    self._pair_expired, p)
         else:
             self.pending_requests[token] = p
             print("transit relay 1: %r" % token)
-            # TODO: timer
+            if self.max_wait_time:
+                p.wait_timer = self.clock.callLater(self.max_wait_time,
+                                                    self._request_expired,
+                                                    token, p)
+
+    def splice(self, p, buddy):
+        s = Splicer(p, buddy, self.forwarding, self.max_length,
+                    self.max_rate, self.clock)
+        ok_lines = []
+        for (us, them) in [(p, buddy), (buddy, p)]:
+            us.buddy = them
+            us.sent_ok = True
+            us.splicer = s
+            if us.wants_limits:
+                ok_lines.append(self.describe_limits())
+            else:
+                ok_lines.append(b"ok\n")
+        s.start(ok_lines)
+
+    def _request_expired(self, token, p):
+        p.wait_timer = None
+        if self.pending_requests.get(token) is p:
+            del self.pending_requests[token]
+        print("transit request expired %r" % p)
+        p.disconnect()
+
+    def _pair_expired(self, p):
+        p.pair_timer = None
+        print("transit time limit exceeded %r" % p)
+        p.disconnect() # the buddy follows, via buddy_disconnected()
+
     def transitFinished(self, p, total_sent):
         print("transitFinished (%dB) %r" % (total_sent, p))
-        for token,tc in self.pending_requests.items():
+        for token,tc in list(self.pending_requests.items()):
             if tc is p:
                 del self.pending_requests[token]
                 break
-        self.active_connections.discard(p)
+        if p in self.active_connections:
+            self.active_connections.discard(p)
+            self._bytes.inc(total_sent)
+            if p.buddy not in self.active_connections:
+                # the last of the pair to go
+                self._pair_time.observe(self.clock.seconds() - p.paired_at)
 
     def transitFailed(self, p):
         print("transitFailed %r" % p)
-        pass
+        self._failures.inc()
@@ -0,0 +1,186 @@
+import sys, time
+from twisted.trial import unittest
+from twisted.internet.defer import gatherResults
+from twisted.internet.threads import deferToThread
+from ..blocking.transcribe import Wormhole as BlockingWormhole
+from ..blocking import transit as blocking_transit
+from ..errors import UsageError
+from .common import ServerBase
+from .test_transit import legacy_relay
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from ..aio import transcribe, transit
+else:
+    transcribe = transit = None
+
+def in_loop(*steps):
+    # Each step is called (with no arguments) for a coroutine, which is run
+    # to completion on an event loop of its own, in a thread (Twisted runs
+    # the server in this one). Fires with a list of their results.
+    def _run():
+        loop = asyncio.new_event_loop()
+        try:
+            return [loop.run_until_complete(step()) for step in steps]
+        finally:
+            loop.close()
+    return deferToThread(_run)
+
+class AsyncWormhole(ServerBase, unittest.TestCase):
+    if not transcribe:
+        skip = "wormhole.aio needs python 3.5 or newer"
+
+    def test_basic(self):
+        appid = b"appid"
+        w1 = transcribe.Wormhole(appid, self.relayurl)
+        w2 = transcribe.Wormhole(appid, self.relayurl)
+        d = in_loop(w1.get_code)
+        def _got_code(res):
+            w2.set_code(res[0])
+            return gatherResults([
+                in_loop(w1.get_verifier, lambda: w1.send_data(b"data1"),
+                        w1.get_data, w1.close),
+                in_loop(w2.get_verifier, lambda: w2.send_data(b"data2"),
+                        w2.get_data, w2.close),
+                ], True)
+        d.addCallback(_got_code)
+        def _done(res):
+            ((v1, _, dataX, _), (v2, _, dataY, _)) = res
+            self.failUnlessEqual(type(v1), type(b""))
+            self.failUnlessEqual(v1, v2)
+            self.failUnlessEqual(dataX, b"data2")
+            self.failUnlessEqual(dataY, b"data1")
+        d.addCallback(_done)
+        return d
+
+    def test_blocking_peer(self):
+        # the same protocol as the blocking client
+        appid = b"appid"
+        w1 = transcribe.Wormhole(appid, self.relayurl)
+        w2 = BlockingWormhole(appid, self.relayurl)
+        d = in_loop(w1.get_code)
+        def _got_code(res):
+            w2.set_code(res[0])
+            def _blocking():
+                w2.send_data(b"data2")
+                data = w2.get_data()
+                w2.close()
+                return data
+            return gatherResults([
+                in_loop(lambda: w1.send_data(b"data1"), w1.get_data,
+                        w1.close),
+                deferToThread(_blocking),
+                ], True)
+        d.addCallback(_got_code)
+        def _done(res):
+            ((_, dataX, _), dataY) = res
+            self.failUnlessEqual(dataX, b"data2")
+            self.failUnlessEqual(dataY, b"data1")
+        d.addCallback(_done)
+        return d
+
+    def test_errors(self):
+        appid = b"appid"
+        w1 = transcribe.Wormhole(appid, self.relayurl)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        run = loop.run_until_complete
+        self.assertRaises(UsageError, run, w1.get_verifier())
+        self.assertRaises(UsageError, run, w1.get_data())
+        self.assertRaises(UsageError, run, w1.send_data(b"data"))
+        w1.set_code("123-purple-elephant")
+        self.assertRaises(UsageError, w1.set_code, "123-nope")
+        self.assertRaises(UsageError, run, w1.get_code())
+        return in_loop(w1.close)
+
+def aio_side(t, record):
+    # connect, send 'record', and return what the other side sent
+    loop = asyncio.new_event_loop()
+    try:
+        pipe = loop.run_until_complete(t.connect())
+        loop.run_until_complete(pipe.send_record(record))
+        got = loop.run_until_complete(pipe.receive_record())
+        pipe.close()
+        loop.run_until_complete(asyncio.sleep(0)) # let it close
+        return got
+    finally:
+        loop.close()
+
+def blocking_side(t, record):
+    pipe = t.connect()
+    pipe.send_record(record)
+    got = pipe.receive_record()
+    pipe.close()
+    return got
+
+class AsyncTransit(ServerBase, unittest.TestCase):
+    if not transit:
+        skip = "wormhole.aio needs python 3.5 or newer"
+
+    def introduce(self, s, r, direct=True):
+        for (us, them) in [(s, r), (r, s)]:
+            us.set_transit_key(b"k"*32)
+            us.add_their_direct_hints(them.get_direct_hints() if direct
+                                      else [])
+            us.add_their_relay_hints(them.get_relay_hints())
+
+    def test_direct(self):
+        s = transit.TransitSender(self.transit)
+        r = transit.TransitReceiver(self.transit)
+        self.introduce(s, r)
+        d = gatherResults([deferToThread(aio_side, s, b"to r"),
+                           deferToThread(aio_side, r, b"to s")], True)
+        def _done(res):
+            self.failUnlessEqual(res, [b"to s", b"to r"])
+            self.failUnlessIn("tcp:", s.describe())
+        d.addCallback(_done)
+        return d
+
+    def test_blocking_peer(self):
+        # the same handshakes and records as blocking/transit.py
+        s = transit.TransitSender(self.transit)
+        r = blocking_transit.TransitReceiver(self.transit)
+        self.introduce(s, r)
+        d = gatherResults([deferToThread(aio_side, s, b"to r"),
+                           deferToThread(blocking_side, r, b"to s")], True)
+        d.addCallback(self.failUnlessEqual, [b"to s", b"to r"])
+        return d
+
+    def test_relay(self):
+        s = blocking_transit.TransitSender(self.transit)
+        r = transit.TransitReceiver(self.transit)
+        self.introduce(s, r, direct=False)
+        d = gatherResults([deferToThread(blocking_side, s, b"to r"),
+                           deferToThread(aio_side, r, b"to s")], True)
+        def _done(res):
+            self.failUnlessEqual(res, [b"to s", b"to r"])
+            self.failUnlessIn("relay", r.describe())
+            self.failUnlessEqual(r.relay_limits["max-seconds"], 0)
+        d.addCallback(_done)
+        return d
+
+    def test_legacy_relay(self):
+        legacy_relay(self)
+        s = transit.TransitSender(self.transit)
+        r = blocking_transit.TransitReceiver(self.transit)
+        self.introduce(s, r, direct=False)
+        d = gatherResults([deferToThread(aio_side, s, b"to r"),
+                           deferToThread(blocking_side, r, b"to s")], True)
+        def _done(res):
+            self.failUnlessEqual(res, [b"to s", b"to r"])
+            self.failUnlessEqual(s.relay_limits, {})
+        d.addCallback(_done)
+        return d
+
+    def test_fail(self):
+        s = transit.TransitSender("tcp:127.0.0.1:1")
+        s.add_their_direct_hints(["tcp:127.0.0.1:1"])
+        s.add_their_relay_hints(["tcp:127.0.0.1:1"])
+        s.set_transit_key(b"k"*32)
+        self.patch(transit, "INBOUND_GRACE", 0.2)
+        started = time.time()
+        d = self.assertFailure(in_loop(s.connect),
+                               blocking_transit.TransitError)
+        d.addCallback(lambda _: self.failUnless(time.time() - started
+                                                < transit.TIMEOUT))
+        return d
@@ -0,0 +1,256 @@
+from __future__ import print_function
+import os, json, socket, struct, time
+import requests
+from twisted.trial import unittest
+from twisted.internet.threads import deferToThread
+from .. import __version__
+from ..database import get_db
+from ..servers.relay_server import Relay, ChannelIdAllocator
+from ..servers import cluster
+
+class Helpers(unittest.TestCase):
+    def test_parse_tcp_endpoint(self):
+        p = cluster.parse_tcp_endpoint
+        self.failUnlessEqual(p("tcp:3000"), ("", 3000))
+        self.failUnlessEqual(p("tcp:0:interface=127.0.0.1"),
+                             ("127.0.0.1", 0))
+        self.failUnlessRaises(ValueError, p, "unix:/tmp/relay")
+        self.failUnlessRaises(ValueError, p, "tcp:3000:backlog=5")
+
+    def test_token_owner(self):
+        owners = set()
+        for i in range(50):
+            token = (u"%064x" % i).encode("ascii")
+            owner = cluster.token_owner(token, 4)
+            self.failUnlessEqual(owner, cluster.token_owner(token, 4))
+            owners.add(owner)
+        self.failUnlessEqual(owners, set([0, 1, 2, 3]))
+
+    def test_partitioned_allocator(self):
+        a = ChannelIdAllocator(worker=1, workers=3)
+        cids = set([a.allocate() for i in range(200)])
+        self.failUnlessEqual(len(cids), 200)
+        self.failUnless(all([cid % 3 == 1 for cid in cids]))
+        # other workers' ids are tracked, but never handed out by us
+        a.claim(3)
+        self.failUnless(3 in a)
+        a.release(3)
+        self.failIf(3 in a)
+        self.failUnless(all([a.allocate() % 3 == 1 for i in range(200)]))
+
+class FakeTransport:
+    def __init__(self, skt):
+        self.skt = skt
+        self.lost = False
+    def getHandle(self):
+        return self.skt
+    def stopReading(self):
+        pass
+    def stopWriting(self):
+        pass
+    def loseConnection(self):
+        self.lost = True
+
+class FakeConnection:
+    def __init__(self, skt):
+        self.transport = FakeTransport(skt)
+
+class FakeReactor:
+    def __init__(self):
+        self.writers = set()
+    def addWriter(self, writer):
+        self.writers.add(writer)
+    def removeWriter(self, writer):
+        self.writers.discard(writer)
+
+class Handoff(unittest.TestCase):
+    def setUp(self):
+        if not hasattr(socket.socket, "sendmsg"):
+            raise unittest.SkipTest("needs sendmsg()")
+
+    def socketpair(self, type=socket.SOCK_STREAM):
+        pair = socket.socketpair(socket.AF_UNIX, type)
+        for skt in pair:
+            self.addCleanup(skt.close)
+        return pair
+
+    def test_queued(self):
+        (out, inbound) = self.socketpair(socket.SOCK_DGRAM)
+        inbound.setblocking(False)
+        r = FakeReactor()
+        w = cluster.HandoffWriter(out, 1, r)
+        # fill the datagram socket, like a worker that has fallen behind
+        while True:
+            try:
+                out.send(b"x")
+            except socket.error:
+                break
+        (ours, client) = self.socketpair()
+        p = FakeConnection(ours)
+        w.send(p, b"1 please relay\n")
+        # it waits for the socket to drain, without blocking us
+        self.failUnlessEqual(len(w.queue), 1)
+        self.failUnlessEqual(r.writers, set([w]))
+        self.failIfEqual(ours.fileno(), -1)
+        while True:
+            try:
+                inbound.recv(10)
+            except socket.error:
+                break
+        w.doWrite()
+        self.failUnlessEqual(len(w.queue), 0)
+        self.failUnlessEqual(r.writers, set())
+        self.failIf(p.transport.lost)
+        # our descriptor is closed, without shutting the connection down
+        self.failUnlessEqual(ours.fileno(), -1)
+        (data, ancdata, _, _) = inbound.recvmsg(
+            100, socket.CMSG_SPACE(struct.calcsize("i")))
+        self.failUnlessEqual(data, b"1 please relay\n")
+        (fd,) = struct.unpack("i", ancdata[0][2][:struct.calcsize("i")])
+        os.write(fd, b"still here")
+        os.close(fd)
+        self.failUnlessEqual(client.recv(10), b"still here")
+
+class FakeLink:
+    # delivers each published event straight to the other Relays
+    def __init__(self, index, workers):
+        self.index = index
+        self.workers = workers
+        self.peers = []
+    def publish(self, event):
+        for relay in self.peers:
+            relay.apply_event(json.loads(json.dumps(event)))
+
+class Subscriber:
+    def __init__(self):
+        self.framed = []
+    def sendFramedEvents(self, framed):
+        self.framed.append(framed)
+
+class Replication(unittest.TestCase):
+    def test_apply_events(self):
+        welcome = {"current_version": __version__}
+        links = [FakeLink(0, 2), FakeLink(1, 2)]
+        db = get_db(":memory:") # the workers share one DB
+        relays = [Relay(db, welcome, cluster=link) for link in links]
+        links[0].peers.append(relays[1])
+        links[1].peers.append(relays[0])
+        r0, r1 = relays
+
+        cid = r0.allocator.allocate()
+        self.failUnlessEqual(cid % 2, 0)
+        r0.get_channel(cid).add_side(u"abc")
+        self.failUnlessEqual(r1.get_allocated(), set([cid]))
+        self.failUnlessEqual(r1.channels[cid].sides, set([u"abc"]))
+
+        sub = Subscriber()
+        r1.channels[cid].event_channels.add(sub)
+        r0.channels[cid].add_message(u"abc", u"1", u"msg1A", 1.0)
+        self.failUnlessEqual(r1.channels[cid].messages, [(u"1", u"msg1A")])
+        self.failUnlessEqual(len(sub.framed), 1)
+        self.failUnlessIn(b"msg1A", sub.framed[0])
+
+        r1.channels[cid].add_side(u"def")
+        self.failUnlessEqual(r0.channels[cid].sides, set([u"abc", u"def"]))
+        self.failUnlessEqual(r0.maybe_free_child(cid, u"abc"), False)
+        self.failUnlessEqual(r1.channels[cid].sides, set([u"def"]))
+        self.failUnlessEqual(r1.maybe_free_child(cid, u"def"), True)
+        self.failUnlessEqual(r0.get_allocated(), set())
+        self.failIf(cid in r0.channels)
+
+        # each change was persisted once, by the worker that made it
+        r0.writer.flush()
+        count = "SELECT COUNT(*) FROM `%s`"
+        self.failUnlessEqual(db.execute(count % "messages").fetchone()[0], 1)
+        r1.writer.flush()
+        self.failUnlessEqual(db.execute(count % "messages").fetchone()[0], 0)
+        self.failUnlessEqual(db.execute(count % "allocations").fetchone()[0],
+                             0)
+
+def wait_for_port(port, timeout=20):
+    give_up = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except socket.error:
+            if time.time() > give_up:
+                raise
+            time.sleep(0.1)
+
+def relay_pair(port, token):
+    request = b"please relay " + token + b"\n"
+    skts = [socket.create_connection(("127.0.0.1", port)) for i in range(2)]
+    try:
+        for skt in skts:
+            skt.settimeout(10)
+            skt.sendall(request)
+        for skt in skts:
+            if skt.recv(3) != b"ok\n":
+                return False
+        # once one side hangs up, the other still gets everything it sent
+        # (no RST), whichever worker's descriptor is closed last
+        data = b"hello" * 200*1000
+        skts[0].sendall(data)
+        skts[0].close()
+        time.sleep(0.2) # so the relay closes its side with data unread
+        got = []
+        while True:
+            more = skts[1].recv(65536)
+            if not more:
+                break
+            got.append(more)
+        return b"".join(got) == data
+    finally:
+        for skt in skts:
+            skt.close()
+
+class Workers(unittest.TestCase):
+    timeout = 60
+
+    def setUp(self):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise unittest.SkipTest("needs SO_REUSEPORT")
+        self.s = cluster.Supervisor(2, "tcp:0:interface=127.0.0.1",
+                                    "tcp:0:interface=127.0.0.1", None)
+        self.s.startService()
+        self.relay_port = cluster.parse_tcp_endpoint(self.s.relayport)[1]
+        self.transit_port = cluster.parse_tcp_endpoint(self.s.transitport)[1]
+        url = "http://127.0.0.1:%d/wormhole-relay/" % self.relay_port
+        self.url = url
+        return deferToThread(wait_for_port, self.transit_port)
+
+    def tearDown(self):
+        return self.s.stopService()
+
+    def test_shared_state(self):
+        def _run():
+            # every request is a new connection, so they are spread across
+            # the workers
+            cids = set()
+            for i in range(10):
+                r = requests.post(self.url + "allocate",
+                                  data=json.dumps({"side": "abc"}))
+                cids.add(r.json()["channel-id"])
+            give_up = time.time() + 10
+            while True:
+                lists = [set(requests.get(self.url + "list")
+                             .json()["channel-ids"]) for i in range(10)]
+                if all([l == cids for l in lists]):
+                    break
+                if time.time() > give_up:
+                    raise AssertionError("%r != %r" % (lists, cids))
+                time.sleep(0.1)
+            return len(cids)
+        d = deferToThread(_run)
+        d.addCallback(self.failUnlessEqual, 10)
+        return d
+
+    def test_transit(self):
+        def _run():
+            return [relay_pair(self.transit_port,
+                               (u"%064x" % i).encode("ascii"))
+                    for i in range(8)]
+        d = deferToThread(_run)
+        d.addCallback(self.failUnlessEqual, [True]*8)
+        return d
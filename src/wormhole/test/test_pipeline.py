@@ -0,0 +1,56 @@
+import time, threading
+from twisted.trial import unittest
+from ..blocking.pipeline import pipelined
+
+class Oops(Exception):
+    pass
+
+class Pipeline(unittest.TestCase):
+    def test_order(self):
+        out = list(pipelined(iter(range(100)),
+                             [lambda x: x*2, lambda x: x+1], depth=2))
+        self.failUnlessEqual(out, [x*2+1 for x in range(100)])
+
+    def test_no_functions(self):
+        self.failUnlessEqual(list(pipelined([1, 2, 3])), [1, 2, 3])
+        self.failUnlessEqual(list(pipelined([])), [])
+
+    def test_source_error(self):
+        def source():
+            yield 1
+            yield 2
+            raise Oops("disk on fire")
+        got = []
+        def _consume():
+            for item in pipelined(source(), [lambda x: x*10]):
+                got.append(item)
+        self.failUnlessRaises(Oops, _consume)
+        self.failUnlessEqual(got, [10, 20])
+
+    def test_function_error(self):
+        def f(x):
+            if x == 3:
+                raise Oops("bad record")
+            return x
+        got = []
+        def _consume():
+            for item in pipelined(iter(range(10)), [f]):
+                got.append(item)
+        self.failUnlessRaises(Oops, _consume)
+        self.failUnlessEqual(got, [0, 1, 2])
+
+    def test_consumer_stops(self):
+        before = threading.active_count()
+        def endless():
+            i = 0
+            while True:
+                yield i
+                i += 1
+        p = pipelined(endless(), [lambda x: x], depth=2)
+        self.failUnlessEqual(next(p), 0)
+        p.close()
+        # the threads notice within a poll period or two
+        give_up = time.time() + 5
+        while threading.active_count() > before and time.time() < give_up:
+            time.sleep(0.05)
+        self.failUnlessEqual(threading.active_count(), before)
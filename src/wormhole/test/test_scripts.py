@@ -1,9 +1,11 @@
-import os, sys
+import os, sys, io, zlib, tarfile
 from twisted.trial import unittest
 from twisted.python import procutils, log
+from twisted.internet.defer import gatherResults
 from twisted.internet.utils import getProcessOutputAndValue
 from .. import __version__
 from .common import ServerBase
+from ..scripts import cmd_send, manifest, archive, compression
 
 class ScriptsBase:
     def find_executable(self):
@@ -178,3 +180,290 @@ class Scripts(ServerBase, ScriptsBase, unittest.TestCase):
                 self.failUnlessEqual(f.read(), message)
         d1.addCallback(_check_receiver)
         return d1
+
+    def test_receive_directory_tmp_exists(self):
+        # a directory.tmp we didn't make isn't ours to replace
+        code = "1-abc"
+        send_dir = self.mktemp()
+        os.makedirs(os.path.join(send_dir, "testdir"))
+        with open(os.path.join(send_dir, "testdir", "a.txt"), "w") as f:
+            f.write("new")
+        receive_dir = self.mktemp()
+        os.makedirs(os.path.join(receive_dir, "testdir.tmp"))
+        precious = os.path.join(receive_dir, "testdir.tmp", "precious.txt")
+        with open(precious, "w") as f:
+            f.write("old")
+
+        wormhole = self.find_executable()
+        server_args = ["--relay-url", self.relayurl]
+        d1 = getProcessOutputAndValue(wormhole, server_args + [
+            "send", "--code", code, "testdir"], path=send_dir)
+        d2 = getProcessOutputAndValue(wormhole, server_args + [
+            "receive", "--accept-file", code], path=receive_dir)
+        d = gatherResults([d1, d2], True)
+        def _check(res):
+            out, err, rc = res[1]
+            self.failUnlessIn("refusing to overwrite existing file",
+                              out.decode("utf-8"))
+            self.failUnlessEqual(rc, 1)
+            with open(precious, "r") as f:
+                self.failUnlessEqual(f.read(), "old")
+            self.failIf(os.path.exists(os.path.join(receive_dir, "testdir")))
+        d.addCallback(_check)
+        return d
+
+class FixedSizer:
+    def __init__(self, size):
+        self.size = size
+
+class Chunks(unittest.TestCase):
+    def make_file(self, data):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(data)
+        return fn
+
+    def test_read_chunks(self):
+        data = b"abc"*1000
+        fn = self.make_file(data)
+        with open(fn, "rb") as f:
+            chunks = list(cmd_send.read_chunks(f, len(data),
+                                               FixedSizer(1000)))
+        self.failUnlessEqual(chunks, [data[:1000], data[1000:2000],
+                                      data[2000:]])
+        # resuming skips what the receiver already has
+        with open(fn, "rb") as f:
+            chunks = list(cmd_send.read_chunks(f, len(data),
+                                               FixedSizer(1000), 2500))
+        self.failUnlessEqual(chunks, [data[2500:]])
+
+    def test_map_chunks(self):
+        data = os.urandom(300*1000)
+        fn = self.make_file(data)
+        sizer = FixedSizer(7000)
+        with open(fn, "rb") as f:
+            # a small window, so records straddle window boundaries
+            chunks = list(cmd_send.map_chunks(f, len(data), sizer,
+                                              window=50*1000))
+            resumed = list(cmd_send.map_chunks(f, len(data), sizer, 70001,
+                                               window=50*1000))
+        self.failUnless(all([isinstance(c, memoryview) for c in chunks]))
+        self.failUnlessEqual(set([len(c) for c in chunks[:-1]]),
+                             set([7000]))
+        self.failUnlessEqual(b"".join([c.tobytes() for c in chunks]), data)
+        self.failUnlessEqual(b"".join([c.tobytes() for c in resumed]),
+                             data[70001:])
+
+    def test_file_chunks(self):
+        data = b"abc"*1000
+        fn = self.make_file(data)
+        with open(fn, "rb") as f:
+            chunks = list(cmd_send.file_chunks(f, len(data),
+                                               FixedSizer(1000)))
+        if sys.version_info[0] >= 3: # py2's mmap doesn't offer a view
+            self.failUnlessEqual([type(c) for c in chunks], [memoryview]*3)
+        self.failUnlessEqual(b"".join([bytes(c) for c in chunks]), data)
+        # a pipe can't be mapped, so it gets read
+        r, w = os.pipe()
+        os.write(w, data)
+        os.close(w)
+        with os.fdopen(r, "rb") as f:
+            chunks = list(cmd_send.file_chunks(f, len(data),
+                                               FixedSizer(1000)))
+        self.failUnlessEqual([type(c) for c in chunks], [bytes]*3)
+        self.failUnlessEqual(b"".join(chunks), data)
+
+class Manifest(unittest.TestCase):
+    def test_chunk_size(self):
+        self.failUnlessEqual(manifest.chunk_size_for(0),
+                             manifest.MIN_CHUNK_SIZE)
+        for filesize in [10**6, 10**9, 10**10, 10**12]:
+            size = manifest.chunk_size_for(filesize)
+            self.failUnless(size >= manifest.MIN_CHUNK_SIZE)
+            self.failUnless(size * manifest.MAX_HASHES >= filesize)
+
+    def test_resume(self):
+        chunk = manifest.MIN_CHUNK_SIZE
+        data = os.urandom(3*chunk + 1000)
+        offer = manifest.resume_offer(len(data))
+        self.failUnlessEqual(offer, {"hash": "sha256", "chunk_size": chunk})
+        def prefix(partial):
+            # what the receiver has, checked by the sender
+            hashes = manifest.partial_hashes(io.BytesIO(partial), len(data),
+                                             offer)
+            return manifest.verified_prefix(io.BytesIO(data), len(data),
+                                            chunk, hashes)
+        self.failUnlessEqual(prefix(b""), 0)
+        self.failUnlessEqual(prefix(data[:chunk-1]), 0)
+        # a preallocated file is full of zeros past what was received
+        partial = data[:2*chunk+5] + b"\0"*(len(data)-2*chunk-5)
+        self.failUnlessEqual(prefix(partial), 2*chunk)
+        self.failUnlessEqual(prefix(data), len(data))
+        self.failUnlessEqual(prefix(data + b"extra"), len(data))
+        corrupt = bytearray(data)
+        corrupt[10] ^= 0xff
+        self.failUnlessEqual(prefix(bytes(corrupt)), 0)
+        # an offer we don't understand gets no hashes
+        self.failUnlessEqual(manifest.partial_hashes(io.BytesIO(data),
+                                                     len(data), {}), [])
+        self.failUnlessEqual(manifest.partial_hashes(io.BytesIO(data),
+                                                     len(data), "x"), [])
+
+class Archives(unittest.TestCase):
+    def make_tree(self):
+        root = self.mktemp()
+        os.makedirs(os.path.join(root, "sub", "empty"))
+        with open(os.path.join(root, "sub", "a" * 150), "wb") as f:
+            f.write(os.urandom(70000))
+        with open(os.path.join(root, "b.txt"), "wb") as f:
+            f.write(b"")
+        return root
+
+    def test_roundtrip(self):
+        root = self.make_tree()
+        a = archive.Archive(root)
+        self.failUnlessEqual((a.numfiles, a.numbytes), (2, 70000))
+        chunks = list(a.chunks(FixedSizer(3000)))
+        # the size we announce is exactly what we send
+        self.failUnlessEqual(sum([len(c) for c in chunks]), a.size)
+        dest = self.mktemp()
+        os.mkdir(dest)
+        self.failUnlessEqual(archive.extract(iter(chunks), dest), 2)
+        for name in [os.path.join("sub", "a" * 150), "b.txt"]:
+            with open(os.path.join(root, name), "rb") as f1:
+                with open(os.path.join(dest, name), "rb") as f2:
+                    self.failUnlessEqual(f1.read(), f2.read())
+        self.failUnless(os.path.isdir(os.path.join(dest, "sub", "empty")))
+
+    def test_chunk_reader(self):
+        r = archive.ChunkReader(iter([b"abcde", b"", b"fgh", b"ijklmnop"]))
+        self.failUnlessEqual(r.read(2), b"ab")
+        self.failUnlessEqual(r.read(2), b"cd")
+        self.failUnlessEqual(r.read(5), b"efghi")
+        self.failUnlessEqual(r.read(0), b"")
+        self.failUnlessEqual(r.read(), b"jklmnop")
+        self.failUnlessEqual(r.read(3), b"")
+
+    def test_shrank(self):
+        root = self.make_tree()
+        a = archive.Archive(root)
+        with open(os.path.join(root, "sub", "a" * 150), "wb") as f:
+            f.write(b"short")
+        self.failUnlessRaises(archive.ArchiveError, list,
+                              a.chunks(FixedSizer(3000)))
+
+    def extract_tar(self, add):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode="w")
+        add(tar)
+        tar.close()
+        dest = self.mktemp()
+        os.mkdir(dest)
+        return archive.extract(iter([buf.getvalue()]), dest)
+
+    def test_unsafe(self):
+        def _member(name, type=tarfile.REGTYPE):
+            def _add(tar):
+                info = tarfile.TarInfo(name)
+                info.type = type
+                info.linkname = "/etc/passwd"
+                tar.addfile(info, io.BytesIO(b""))
+            return _add
+        for name in ["../evil", "/etc/evil", "a/../../evil", "a//b"]:
+            self.failUnlessRaises(archive.ArchiveError, self.extract_tar,
+                                  _member(name))
+        self.failUnlessRaises(archive.ArchiveError, self.extract_tar,
+                              _member("link", tarfile.SYMTYPE))
+        self.failUnlessEqual(self.extract_tar(_member("fine")), 1)
+
+    def test_conflicting(self):
+        # a member that clashes with an earlier one is refused, not a crash
+        def _members(*members):
+            def _add(tar):
+                for (name, type) in members:
+                    info = tarfile.TarInfo(name)
+                    info.type = type
+                    tar.addfile(info, io.BytesIO(b""))
+            return _add
+        for members in [[("x", tarfile.REGTYPE), ("x/y", tarfile.REGTYPE)],
+                        [("x", tarfile.REGTYPE), ("x", tarfile.DIRTYPE)],
+                        [("x", tarfile.DIRTYPE), ("x", tarfile.REGTYPE)]]:
+            self.failUnlessRaises(archive.ArchiveError, self.extract_tar,
+                                  _members(*members))
+
+class Compression(unittest.TestCase):
+    def test_choose(self):
+        self.failUnlessEqual(compression.choose_codec(["bogus", "zlib"]),
+                             "zlib")
+        self.failUnlessEqual(compression.choose_codec(["bogus"]), None)
+        self.failUnlessEqual(compression.choose_codec(None), None)
+        self.failUnlessIn("zlib", compression.available_codecs())
+
+    def test_roundtrip(self):
+        text = b"2026-10-18 INFO all is well\n" * 10000
+        noise = os.urandom(50000)
+        for name in compression.available_codecs():
+            c = compression.Compressor(name)
+            d = compression.Decompressor(name, len(text))
+            framed = c.frame(text)
+            self.failUnlessEqual(framed[:1], compression.COMPRESSED)
+            self.failUnless(len(framed) < len(text) // 10)
+            self.failUnlessEqual(d.unframe(framed), text)
+            framed = c.frame(memoryview(noise))
+            self.failUnlessEqual(framed[:1], compression.RAW)
+            self.failUnlessEqual(d.unframe(framed), noise)
+            # more than we agreed to accept
+            small = compression.Decompressor(name, len(text) - 1)
+            self.failUnlessRaises(compression.DecompressionError,
+                                  small.unframe, c.frame(text))
+            self.failUnlessRaises(compression.DecompressionError,
+                                  d.unframe, b"\x07junk")
+
+    def test_zlib(self):
+        text = b"x" * 10000
+        compressed = compression.CODECS["zlib"].compress(text)
+        def check():
+            d = compression.Decompressor("zlib", len(text))
+            self.failUnlessEqual(d.unframe(compression.COMPRESSED
+                                           + compressed), text)
+            # with or without something after the end
+            self.failUnlessEqual(d.unframe(compression.COMPRESSED
+                                           + compressed + b"extra"), text)
+            for truncated in [compressed[:-1], compressed[:-4],
+                              compressed[:len(compressed)//2]]:
+                self.failUnlessRaises(compression.DecompressionError,
+                                      d.unframe,
+                                      compression.COMPRESSED + truncated)
+        check()
+        # py2's decompressobj has no .eof
+        real_decompressobj = zlib.decompressobj
+        class NoEof:
+            def __init__(self):
+                self.d = real_decompressobj()
+            def decompress(self, *args):
+                return self.d.decompress(*args)
+            def __getattr__(self, name):
+                if name == "eof":
+                    raise AttributeError(name)
+                return getattr(self.d, name)
+        self.patch(zlib, "decompressobj", NoEof)
+        check()
+
+    def test_backoff(self):
+        tried = []
+        c = compression.Compressor("zlib")
+        real = c.codec
+        class Counting:
+            def compress(self, data):
+                tried.append(data)
+                return real.compress(data)
+        c.codec = Counting()
+        noise = os.urandom(1000)
+        for i in range(100):
+            c.frame(noise)
+        # we stop trying after a few misses, then just probe now and then
+        self.failUnless(len(tried) < 4 + 100 // 16 + 2, len(tried))
+        text = b"a" * 1000
+        for i in range(20):
+            c.frame(text)
+        self.failUnless(c.misses == 0)
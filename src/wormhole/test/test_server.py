@@ -1,13 +1,21 @@
 from __future__ import print_function
-import sys, json
+import sys, json, socket, time, sqlite3
 import requests
 from twisted.trial import unittest
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task, protocol, endpoints
 from twisted.internet.threads import deferToThread
 from twisted.web.client import getPage, Agent, readBody
+from twisted.web.test.requesthelper import DummyRequest
 from .. import __version__
 from .common import ServerBase
 from ..twisted.eventsource_twisted import EventSource
+from ..database import get_db, get_schema
+from ..servers import relay_server
+from ..servers.relay_server import DAY
+from ..servers.relay_server import (Relay, WriteBehind,
+                                    ChannelIdAllocator, frame_event)
+from ..servers.transit_server import Transit as TransitFactory
+from ..servers.metrics import Metrics as MetricsRegistry
 
 class Reachable(ServerBase, unittest.TestCase):
 
@@ -249,6 +257,317 @@ class API(ServerBase, unittest.TestCase):
         d.addCallback(lambda _: self.o.wait_for_disconnection())
         return d
 
+    def test_metrics(self):
+        d = self.post("allocate", {"side": "abc"})
+        def _allocated(data):
+            return self.post("%d" % data["channel-id"],
+                             {"side": "abc", "phase": "1", "body": "msg1"})
+        d.addCallback(_allocated)
+        d.addCallback(lambda _: self.get("metrics", is_json=False))
+        def _check(data):
+            lines = data.decode("utf-8").splitlines()
+            self.failUnlessIn("# TYPE wormhole_relay_allocate_total counter",
+                              lines)
+            self.failUnlessIn("wormhole_relay_allocate_total 1", lines)
+            self.failUnlessIn("wormhole_relay_messages_total 1", lines)
+            self.failUnlessIn("wormhole_relay_live_channels 1", lines)
+            self.failUnlessIn("wormhole_relay_post_seconds_count 1", lines)
+            self.failUnlessIn("wormhole_transit_pairs_total 0", lines)
+        d.addCallback(_check)
+        return d
+
+class Metrics(unittest.TestCase):
+    def test_render(self):
+        m = MetricsRegistry()
+        c = m.counter("things_total", "things seen")
+        values = [3]
+        m.gauge("things_live", "things alive", lambda: values[0])
+        h = m.histogram("thing_seconds", "thing latency", [0.1, 1.0])
+        c.inc()
+        c.inc(2)
+        h.observe(0.05)
+        h.observe(0.5)
+        h.observe(5.0)
+        values[0] = 4
+        lines = m.render().decode("utf-8").splitlines()
+        self.failUnlessEqual(lines, [
+            "# HELP things_total things seen",
+            "# TYPE things_total counter",
+            "things_total 3",
+            "# HELP things_live things alive",
+            "# TYPE things_live gauge",
+            "things_live 4",
+            "# HELP thing_seconds thing latency",
+            "# TYPE thing_seconds histogram",
+            'thing_seconds_bucket{le="0.1"} 1',
+            'thing_seconds_bucket{le="1.0"} 2',
+            'thing_seconds_bucket{le="+Inf"} 3',
+            "thing_seconds_sum 5.55",
+            "thing_seconds_count 3",
+            ])
+
+    def test_write_behind(self):
+        m = MetricsRegistry()
+        clock = task.Clock()
+        w = WriteBehind(get_db(":memory:"), clock=clock, metrics=m)
+        w.execute("INSERT INTO `allocations` VALUES (?,?)", (1, "abc"))
+        self.failUnlessIn(b"wormhole_relay_db_pending_statements 1\n",
+                          m.render())
+        clock.advance(1.0)
+        out = m.render()
+        self.failUnlessIn(b"wormhole_relay_db_statements_total 1\n", out)
+        self.failUnlessIn(b"wormhole_relay_db_flush_seconds_count 1\n", out)
+
+class Persistence(unittest.TestCase):
+    def setUp(self):
+        self.db = get_db(":memory:")
+        self.welcome = {"current_version": __version__}
+
+    def count(self, table):
+        return self.db.execute("SELECT COUNT(*) FROM `%s`" % table).fetchone()[0]
+
+    def test_write_behind(self):
+        clock = task.Clock()
+        w = WriteBehind(self.db, flush_period=1.0, flush_threshold=3,
+                        clock=clock)
+        w.execute("INSERT INTO `allocations` VALUES (?,?)", (1, "abc"))
+        self.failUnlessEqual(self.count("allocations"), 0)
+        clock.advance(1.0)
+        self.failUnlessEqual(self.count("allocations"), 1)
+
+        # hitting the threshold flushes on the next turn, not immediately
+        for side in ["a", "b", "c"]:
+            w.execute("INSERT INTO `allocations` VALUES (?,?)", (2, side))
+        self.failUnlessEqual(self.count("allocations"), 1)
+        clock.advance(0)
+        self.failUnlessEqual(self.count("allocations"), 4)
+        self.failIf(clock.getDelayedCalls())
+
+    def test_write_behind_retry(self):
+        clock = task.Clock()
+        m = MetricsRegistry()
+        w = WriteBehind(self.db, flush_period=1.0, clock=clock, metrics=m)
+        class Locked:
+            # like another worker holding the lock, for the first commit
+            def __init__(self, db):
+                self.db = db
+                self.locked = True
+            def execute(self, sql, args):
+                return self.db.execute(sql, args)
+            def commit(self):
+                if self.locked:
+                    self.locked = False
+                    raise sqlite3.OperationalError("database is locked")
+                self.db.commit()
+            def rollback(self):
+                self.db.rollback()
+        w.db = Locked(self.db)
+        w.execute("INSERT INTO `allocations` VALUES (?,?)", (1, "abc"))
+        clock.advance(1.0)
+        self.flushLoggedErrors(sqlite3.OperationalError)
+        self.failUnlessEqual(self.count("allocations"), 0)
+        self.failUnlessIn(b"wormhole_relay_db_flush_failures_total 1\n",
+                          m.render())
+        # the failed batch goes first, and nothing is lost
+        w.execute("INSERT INTO `allocations` VALUES (?,?)", (2, "abc"))
+        clock.advance(1.0)
+        rows = self.db.execute("SELECT `channel_id` FROM `allocations`")
+        self.failUnlessEqual([row[0] for row in rows.fetchall()], [1, 2])
+        self.failIf(clock.getDelayedCalls())
+
+    def test_rebuild(self):
+        r = Relay(self.db, self.welcome)
+        c = r.get_channel(1)
+        c.add_side(u"abc")
+        c.add_message(u"abc", u"1", u"msg1A", 1.0)
+        c.add_side(u"def")
+        c.add_message(u"def", u"1", u"msg1B", 2.0)
+        r.get_channel(2).add_side(u"ghi")
+        self.failUnlessEqual(self.count("messages"), 0)
+        r.writer.flush()
+        self.failUnlessEqual(self.count("messages"), 2)
+        self.failUnlessEqual(self.count("allocations"), 3)
+
+        r2 = Relay(self.db, self.welcome)
+        self.failUnlessEqual(r2.get_allocated(), set([1, 2]))
+        c2 = r2.channels[1]
+        self.failUnlessEqual(c2.sides, set([u"abc", u"def"]))
+        self.failUnlessEqual(c2.messages, [(u"1", u"msg1A"),
+                                           (u"1", u"msg1B")])
+        self.failUnlessEqual(c2.last_message_time, 2.0)
+
+        self.failUnlessEqual(r2.maybe_free_child(1, u"abc"), False)
+        self.failUnlessEqual(r2.maybe_free_child(1, u"def"), True)
+        r2.writer.flush()
+        self.failUnlessEqual(self.count("messages"), 0)
+        self.failUnlessEqual(self.count("allocations"), 1)
+
+    def test_upgrade(self):
+        fn = self.mktemp()
+        db = sqlite3.connect(fn)
+        db.executescript(get_schema(1))
+        db.execute("INSERT INTO version (version) VALUES (?)", (1,))
+        db.commit()
+        db.close()
+        db = get_db(fn)
+        self.failUnlessEqual(db.execute("SELECT version FROM version")
+                             .fetchone()[0], 2)
+        indexes = [row["name"] for row in
+                   db.execute("SELECT name FROM sqlite_master"
+                              " WHERE type='index'").fetchall()]
+        self.failUnlessIn("messages_when_idx", indexes)
+
+class Expiry(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.relay = Relay(get_db(":memory:"),
+                           {"current_version": __version__},
+                           clock=self.clock)
+
+    def add_channel(self, side, when):
+        channel_id = self.relay.allocator.allocate()
+        channel = self.relay.get_channel(channel_id)
+        channel.add_side(side)
+        if when is not None:
+            channel.add_message(side, u"1", u"msg", when)
+        return channel_id
+
+    def test_prune_in_slices(self):
+        now = 10*DAY
+        stale = [self.add_channel(u"old", 1.0) for i in range(250)]
+        empty = self.add_channel(u"empty", None)
+        fresh = [self.add_channel(u"new", now - 1.0) for i in range(5)]
+        self.relay.prune_old_channels(now)
+        # the first slice is done right away, the rest on later turns
+        self.failUnlessEqual(len(self.relay.channels),
+                             256 - relay_server.PRUNE_SLICE)
+        self.relay.prune_old_channels(now) # no overlapping prunes
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+        self.failUnlessEqual(set(self.relay.channels), set(fresh))
+        self.failUnlessEqual(self.relay.get_allocated(), set(fresh))
+        for channel_id in stale + [empty]:
+            self.failIf(channel_id in self.relay.channels)
+        self.relay.writer.flush()
+
+    def test_activity_postpones(self):
+        now = 10*DAY
+        channel_id = self.add_channel(u"abc", 1.0)
+        channel = self.relay.channels[channel_id]
+        channel.add_message(u"abc", u"2", u"msg2", now - 1.0)
+        self.relay.prune_old_channels(now)
+        self.failUnlessEqual(self.relay.get_allocated(), set([channel_id]))
+        # re-queued at its newer time, without a second entry
+        self.failUnlessEqual(self.relay._expiry, [(now - 1.0, channel_id)])
+        later = now + relay_server.CHANNEL_EXPIRATION_TIME
+        self.relay.prune_old_channels(later)
+        self.failUnlessEqual(self.relay.get_allocated(), set())
+        self.relay.writer.flush()
+
+class Encoding(unittest.TestCase):
+    def test_cached_response(self):
+        welcome = {"current_version": __version__, "motd": u"hi \u2603"}
+        r = Relay(get_db(":memory:"), welcome)
+        c = r.get_channel(1)
+        empty = c.get_messages(DummyRequest([]))
+        self.failUnlessEqual(unjson(empty),
+                             {"welcome": welcome, "messages": []})
+        c.add_message(u"abc", u"1", u"msg1A", 1.0)
+        c.add_message(u"def", u"1", u"msg1B", 2.0)
+        resp = c.get_messages(DummyRequest([]))
+        expected = {"welcome": welcome,
+                    "messages": [{"phase": u"1", "body": u"msg1A"},
+                                 {"phase": u"1", "body": u"msg1B"}]}
+        self.failUnlessEqual(unjson(resp), expected)
+        self.failUnless(resp.endswith(b"\n"))
+        # nothing changed, so the same bytes are handed out again
+        self.failUnlessIdentical(c.get_messages(DummyRequest([])), resp)
+        c.add_message(u"abc", u"2", u"msg2A", 3.0)
+        resp2 = c.get_messages(DummyRequest([]))
+        self.failUnlessEqual(len(unjson(resp2)["messages"]), 3)
+        r.writer.flush()
+
+class EventFraming(unittest.TestCase):
+    def test_frame_event(self):
+        self.failUnlessEqual(frame_event(u"one\ntwo"),
+                             b"data: one\ndata: two\n\n")
+        self.failUnlessEqual(frame_event(b"{}", name="welcome", id="7",
+                                         retry=b"1000"),
+                             b"event: welcome\n\n"
+                             b"id: 7\n\n"
+                             b"retry: 1000\n\n"
+                             b"data: {}\n\n")
+
+    def subscribe(self, channel):
+        request = DummyRequest([])
+        request.requestHeaders.setRawHeaders(b"accept", [b"text/event-stream"])
+        channel.render_GET(request)
+        return request
+
+    def test_one_write_per_event(self):
+        r = Relay(get_db(":memory:"), {})
+        c = r.get_channel(1)
+        c.add_message(u"abc", u"1", u"msg1A", 1.0)
+        subscribers = [self.subscribe(c) for i in range(3)]
+        for request in subscribers:
+            self.failUnlessEqual(request.written,
+                                 [b"event: welcome\n\ndata: {}\n\n"
+                                  b'data: {"phase": "1", "body": "msg1A"}\n\n'])
+        encoded = c.add_message(u"def", u"1", u"msg1B", 2.0)
+        c.broadcast_message(encoded)
+        framed = subscribers[0].written[1]
+        for request in subscribers:
+            self.failUnlessEqual(len(request.written), 2)
+            self.failUnlessIdentical(request.written[1], framed)
+        self.failUnlessEqual(framed,
+                             b'data: {"phase": "1", "body": "msg1B"}\n\n')
+        r.writer.flush()
+
+class Allocation(unittest.TestCase):
+    def test_short_ids_first(self):
+        a = ChannelIdAllocator()
+        first = set([a.allocate() for i in range(9)])
+        self.failUnlessEqual(first, set(range(1, 10)))
+        self.failUnlessEqual(len(a), 9)
+        cid = a.allocate()
+        self.failUnless(10 <= cid < 100, cid)
+        a.release(5)
+        self.failIfIn(5, a)
+        self.failUnlessEqual(a.allocate(), 5)
+
+    def test_claim_release(self):
+        a = ChannelIdAllocator()
+        a.claim(7)
+        a.claim(7) # idempotent
+        a.claim(123456)
+        self.failUnlessEqual(len(a), 2)
+        self.failUnlessEqual(a.allocated(), set([7, 123456]))
+        for i in range(8):
+            self.failIfEqual(a.allocate(), 7)
+        a.release(123456)
+        a.release(123456)
+        a.release(42) # never claimed
+        self.failUnlessEqual(len(a), 9)
+
+    def test_exhausted_short_range(self):
+        a = ChannelIdAllocator()
+        for cid in range(1, 1000):
+            a.claim(cid)
+        cid = a.allocate()
+        self.failUnless(1000 <= cid < 1000*1000, cid)
+        self.failUnlessIn(cid, a)
+        a.release(456)
+        self.failUnlessEqual(a.allocate(), 456)
+
+    def test_relay_tracks_channels(self):
+        r = Relay(get_db(":memory:"), {})
+        r.get_channel(17).add_side(u"abc")
+        self.failUnlessEqual(r.get_allocated(), set([17]))
+        r.maybe_free_child(17, u"abc")
+        self.failUnlessEqual(r.get_allocated(), set())
+        self.failIfIn(17, r.allocator)
+        r.writer.flush()
+
 class OneEventAtATime:
     def __init__(self, url, parser=lambda e: e):
         self.parser = parser
@@ -290,3 +609,240 @@ class OneEventAtATime:
     def disconnected(self, why):
         self.disconnected_d.callback((why,))
 
+
+class Accumulator(protocol.Protocol):
+    def __init__(self):
+        self.data = b""
+        self.received = 0
+        self.count = 0
+        self._wait = None
+        self.lost = defer.Deferred()
+    def waitForBytes(self, more):
+        assert self._wait is None
+        self.count = more
+        self._wait = defer.Deferred()
+        self._check_done()
+        return self._wait
+    def dataReceived(self, data):
+        self.received += len(data)
+        if len(self.data) < 100:
+            self.data = self.data + data[:100]
+        self._check_done()
+    def _check_done(self):
+        if self._wait and self.received >= self.count:
+            d = self._wait
+            self._wait = None
+            d.callback(self)
+    def connectionLost(self, why):
+        self.lost.callback(None)
+
+class Transit(ServerBase, unittest.TestCase):
+    token = b"a"*64
+
+    def connect(self):
+        ep = endpoints.clientFromString(reactor, self.transit)
+        return endpoints.connectProtocol(ep, Accumulator())
+
+    def test_backpressure(self):
+        # a fast sender pushing to a receiver that doesn't read must not
+        # make the relay buffer the whole stream
+        size = 40*1000*1000
+        d = defer.gatherResults([self.connect(), self.connect()])
+        def _connected(res):
+            self.a, self.b = res
+            # keep the receiver's kernel buffer small and stop reading, so
+            # the relay's writes to it back up quickly
+            self.b.transport.getHandle().setsockopt(socket.SOL_SOCKET,
+                                                    socket.SO_RCVBUF, 65536)
+            self.b.transport.pauseProducing()
+            self.a.transport.write(b"please relay " + self.token + b"\n")
+            self.b.transport.write(b"please relay " + self.token + b"\n")
+            return self.a.waitForBytes(3)
+        d.addCallback(_connected)
+        def _ready(_):
+            self.failUnlessEqual(self.a.data, b"ok\n")
+            self.a.transport.write(b"x" * size)
+            return task.deferLater(reactor, 1.0, lambda: None)
+        d.addCallback(_ready)
+        def _stalled(_):
+            transit = self._relay_server.transit
+            relayed = sum([tc.total_sent
+                           for tc in transit.active_connections])
+            self.failUnless(relayed < size/2, relayed)
+            self.b.transport.resumeProducing()
+            return self.b.waitForBytes(3+size)
+        d.addCallback(_stalled)
+        def _drained(_):
+            self.failUnlessEqual(self.b.received, 3+size)
+            self.failUnlessEqual(self.b.data[:4], b"ok\nx")
+            self.a.transport.loseConnection()
+            self.b.transport.loseConnection()
+        d.addCallback(_drained)
+        return d
+
+class TransitLimits(unittest.TestCase):
+    token = b"c"*64
+    forwarding = "reactor"
+
+    def start(self, **kwargs):
+        self.metrics = MetricsRegistry()
+        self.transit = TransitFactory(forwarding=self.forwarding,
+                                      metrics=self.metrics, **kwargs)
+        ep = endpoints.serverFromString(reactor, "tcp:0:interface=127.0.0.1")
+        d = ep.listen(self.transit)
+        def _listening(lp):
+            self.addCleanup(lp.stopListening)
+            self.endpoint = "tcp:127.0.0.1:%d" % lp.getHost().port
+        d.addCallback(_listening)
+        return d
+
+    def connect(self, request=None):
+        if request is None:
+            request = b"please relay " + self.token + b"\n"
+        ep = endpoints.clientFromString(reactor, self.endpoint)
+        d = endpoints.connectProtocol(ep, Accumulator())
+        def _connected(p):
+            p.transport.write(request)
+            return p
+        d.addCallback(_connected)
+        return d
+
+    def connect_pair(self, request=None):
+        d = self.connect(request)
+        def _first(a):
+            self.a = a
+            return self.connect()
+        d.addCallback(_first)
+        def _second(b):
+            self.b = b
+            return defer.gatherResults([self.a.waitForBytes(1),
+                                        self.b.waitForBytes(3)])
+        d.addCallback(_second)
+        return d
+
+    def wait_for_relay_idle(self, _=None):
+        # the relay may notice a disconnect a little after the client does
+        if not self.transit.active_connections:
+            return defer.succeed(None)
+        d = task.deferLater(reactor, 0.05, lambda: None)
+        d.addCallback(self.wait_for_relay_idle)
+        return d
+
+    def close_pair(self, _=None):
+        self.a.transport.loseConnection()
+        self.b.transport.loseConnection()
+        d = defer.gatherResults([self.a.lost, self.b.lost])
+        d.addCallback(self.wait_for_relay_idle)
+        return d
+
+    def test_unlimited_by_default(self):
+        d = self.start()
+        with_limits = b"please relay " + self.token + b" with-limits\n"
+        d.addCallback(lambda _: self.connect_pair(with_limits))
+        def _check(_):
+            self.failUnlessEqual(self.a.data, b"ok max-bytes=0"
+                                 b" max-seconds=0 max-rate=0\n")
+        d.addCallback(_check)
+        d.addCallback(self.close_pair)
+        return d
+
+    def test_limits_in_response(self):
+        d = self.start(max_length=1000, max_time=5, max_rate=0)
+        with_limits = b"please relay " + self.token + b" with-limits\n"
+        d.addCallback(lambda _: self.connect_pair(with_limits))
+        def _check(_):
+            self.failUnlessEqual(self.a.data, b"ok max-bytes=1000"
+                                 b" max-seconds=5 max-rate=0\n")
+            self.failUnlessEqual(self.b.data, b"ok\n")
+        d.addCallback(_check)
+        d.addCallback(self.close_pair)
+        return d
+
+    def test_forwarding(self):
+        d = self.start()
+        d.addCallback(lambda _: self.connect_pair())
+        def _ready(_):
+            self.a.transport.write(b"x" * 300*1000)
+            self.b.transport.write(b"y" * 1000)
+            return defer.gatherResults([self.a.waitForBytes(3 + 1000),
+                                        self.b.waitForBytes(3 + 300*1000)])
+        d.addCallback(_ready)
+        def _arrived(_):
+            self.failUnlessEqual(self.a.data[:4], b"ok\ny")
+            self.failUnlessEqual(self.b.data[:4], b"ok\nx")
+            self.failUnlessEqual(self.b.received, 3 + 300*1000)
+            # when one side hangs up, the other is disconnected too
+            self.a.transport.loseConnection()
+            return defer.gatherResults([self.a.lost, self.b.lost])
+        d.addCallback(_arrived)
+        d.addCallback(self.wait_for_relay_idle)
+        def _counted(_):
+            lines = self.metrics.render().decode("utf-8").splitlines()
+            self.failUnlessIn("wormhole_transit_pairs_total 1", lines)
+            self.failUnlessIn("wormhole_transit_bytes_total %d"
+                              % (300*1000 + 1000), lines)
+            self.failUnlessIn("wormhole_transit_active_connections 0", lines)
+            self.failUnlessIn("wormhole_transit_pair_seconds_count 1", lines)
+        d.addCallback(_counted)
+        return d
+
+    def test_pending_expires(self):
+        d = self.start(max_wait_time=0.2)
+        d.addCallback(lambda _: self.connect())
+        def _connected(a):
+            self.failUnlessEqual(len(self.transit.pending_requests), 0)
+            return a.lost
+        d.addCallback(_connected)
+        def _lost(_):
+            self.failUnlessEqual(self.transit.pending_requests, {})
+        d.addCallback(_lost)
+        return d
+
+    def test_length_limit(self):
+        d = self.start(max_length=1000)
+        d.addCallback(lambda _: self.connect_pair())
+        def _ready(_):
+            self.a.transport.write(b"x" * 600)
+            self.a.transport.write(b"x" * 600)
+            return defer.gatherResults([self.a.lost, self.b.lost])
+        d.addCallback(_ready)
+        def _lost(_):
+            # the write that went over the limit was not forwarded
+            self.failUnless(self.b.received <= 3+600, self.b.received)
+        d.addCallback(_lost)
+        d.addCallback(self.wait_for_relay_idle)
+        def _counted(_):
+            lines = self.metrics.render().decode("utf-8").splitlines()
+            self.failUnlessIn("wormhole_transit_failures_total 1", lines)
+        d.addCallback(_counted)
+        return d
+
+    def test_time_limit(self):
+        d = self.start(max_time=0.3)
+        d.addCallback(lambda _: self.connect_pair())
+        d.addCallback(lambda _: defer.gatherResults([self.a.lost,
+                                                     self.b.lost]))
+        d.addCallback(self.wait_for_relay_idle)
+        return d
+
+    def test_rate_limit(self):
+        d = self.start(max_length=0, max_rate=100*1000)
+        d.addCallback(lambda _: self.connect_pair())
+        def _ready(_):
+            self.started = time.time()
+            # the first 100kB is a free burst, the rest takes 1.5s
+            self.a.transport.write(b"x" * 250*1000)
+            return self.b.waitForBytes(3 + 250*1000)
+        d.addCallback(_ready)
+        def _arrived(_):
+            elapsed = time.time() - self.started
+            self.failUnless(elapsed > 1.0, elapsed)
+        d.addCallback(_arrived)
+        d.addCallback(self.close_pair)
+        return d
+
+class SplicedTransitLimits(TransitLimits):
+    forwarding = "splice"
+
+class BufferedTransitLimits(TransitLimits):
+    forwarding = "buffer"
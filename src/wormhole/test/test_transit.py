@@ -0,0 +1,628 @@
+import os, time, socket, struct, threading
+from binascii import unhexlify
+from nacl.secret import SecretBox
+from twisted.trial import unittest
+from twisted.internet.defer import gatherResults
+from twisted.internet.threads import deferToThread
+from .. import transit_common
+from ..blocking import transit
+from ..servers.transit_server import TransitConnection
+from .common import ServerBase
+
+class Handshakes(unittest.TestCase):
+    def test_relay_response(self):
+        p = transit_common.parse_relay_response
+        self.failUnlessEqual(p(b"ok\n"), {})
+        self.failUnlessEqual(p(b"ok max-bytes=1000 max-seconds=60"
+                               b" max-rate=0\n"),
+                             {"max-bytes": 1000, "max-seconds": 60,
+                              "max-rate": 0})
+        self.failUnlessRaises(transit.BadHandshake, p, b"impatient\n")
+        key = b"k"*32
+        build = transit_common.build_relay_handshake
+        self.failUnless(build(key).endswith(b" with-limits\n"))
+        self.failUnlessEqual(len(build(key, False)),
+                             len(b"please relay \n")+32*2)
+
+def legacy_relay(test):
+    # make the relay act like one from before "with-limits", which only
+    # accepts the plain request line
+    real = TransitConnection.dataReceived
+    def dataReceived(p, data):
+        if not p.got_token and b" with-limits" in p.token_buffer+data:
+            p.transport.write(b"bad handshake\n")
+            return p.disconnect()
+        return real(p, data)
+    test.patch(TransitConnection, "dataReceived", dataReceived)
+
+class Reader(unittest.TestCase):
+    def test_fed(self):
+        r = transit.HandshakeReader(None, "test")
+        self.failUnlessEqual(r.check_line(), None)
+        r.feed(b"ok max-bytes=10")
+        self.failUnlessEqual(r.check_line(), None)
+        r.feed(b"00\ntransit rec")
+        self.failUnlessEqual(r.check_line(), b"ok max-bytes=1000\n")
+        self.failUnlessEqual(r.check_for(b"transit receiver X ready\n\n"),
+                             False)
+        r.feed(b"eiver X ready\n\nrecord")
+        self.failUnlessEqual(r.check_for(b"transit receiver X ready\n\n"),
+                             True)
+        self.failUnlessEqual(r.leftover(), b"record")
+        self.failUnlessEqual(r.leftover(), b"")
+
+    def test_bad(self):
+        r = transit.HandshakeReader(None, "test")
+        r.feed(b"transit sender Y")
+        self.failUnlessRaises(transit.BadHandshake,
+                              r.check_for, b"transit sender X ready\n\n")
+        r = transit.HandshakeReader(None, "test")
+        r.feed(b"x"*200)
+        self.failUnlessRaises(transit.BadHandshake, r.check_line, 200)
+
+    def test_leftover_record(self):
+        # the first record arrives in the same segment as the "go"
+        key = b"k"*32
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        sender = transit.RecordPipe(a, key, key)
+        handshake = b"transit sender X ready\n\ngo\n"
+        a.sendall(handshake)
+        sender.send_record(b"record1")
+        r = transit.HandshakeReader(b, "test")
+        r.wait_for(handshake)
+        receiver = transit.RecordPipe(b, key, key, r.leftover())
+        self.failUnlessEqual(receiver.receive_record(), b"record1")
+
+    def test_disconnect(self):
+        a, b = socket.socketpair()
+        self.addCleanup(b.close)
+        a.sendall(b"transit ")
+        a.close()
+        r = transit.HandshakeReader(b, "test")
+        self.failUnlessRaises(transit.BadHandshake,
+                              r.wait_for, b"transit sender X ready\n\n")
+
+class Buffer(unittest.TestCase):
+    def test_read(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        rb = transit.ReceiveBuffer(b, b"abc", recv_size=8)
+        a.sendall(b"defghijklmnop")
+        self.failUnlessEqual(rb.read(2).tobytes(), b"ab")
+        self.failUnlessEqual(rb.read(5).tobytes(), b"cdefg")
+        self.failUnlessEqual(rb.read(6).tobytes(), b"hijklm")
+        # bigger than the buffer, so it has to grow
+        a.sendall(b"q"*20)
+        self.failUnlessEqual(rb.read(23).tobytes(), b"nop" + b"q"*20)
+        a.close()
+        self.failUnlessRaises(transit.TransitClosed, rb.read, 1)
+
+    def test_records(self):
+        key = b"k"*32
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        sender = transit.RecordPipe(a, key, key)
+        receiver = transit.RecordPipe(b, key, key, recv_size=100)
+        records = [b"x"*size for size in [0, 1, 50, 1000, 60, 5000]]
+        for record in records:
+            sender.send_record(record)
+        for record in records:
+            self.failUnlessEqual(receiver.receive_record(), record)
+
+class Records(unittest.TestCase):
+    def test_nonce(self):
+        # same wire format as the old unhexlify("%048x" % counter)
+        for counter in [0, 1, 255, 256, 2**40+7, 2**64-1]:
+            self.failUnlessEqual(transit_common.make_nonce(counter),
+                                 unhexlify("%048x" % counter))
+
+    def test_send_records(self):
+        key = b"k"*32
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        sender = transit.RecordPipe(a, key, key)
+        receiver = transit.RecordPipe(b, key, key)
+        records = [("r%d" % i).encode("ascii") for i in range(20)] + [b""]
+        sender.send_records(records)
+        sender.send_record(b"last")
+        for record in records + [b"last"]:
+            self.failUnlessEqual(receiver.receive_record(), record)
+
+    def test_seal(self):
+        # with or without libsodium's buffer interface, a memoryview seals
+        # to the same record as bytes, and SecretBox opens it
+        key = b"k"*32
+        data = os.urandom(10000)
+        for lib in [transit._lib, None]:
+            self.patch(transit, "_lib", lib)
+            for record in [data, memoryview(data)[100:9000], b""]:
+                pipe = transit.RecordPipe(None, key, key)
+                (header, encrypted) = pipe.seal_record(record)
+                self.failUnlessEqual(header, struct.pack(">L",
+                                                         len(encrypted)))
+                self.failUnlessEqual(SecretBox(key).decrypt(bytes(encrypted)),
+                                     bytes(record))
+        self.failUnlessRaises(transit.UsageError,
+                              transit.RecordPipe(None, key, key).seal_record,
+                              u"text")
+
+    def test_out_of_order(self):
+        key = b"k"*32
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        sender = transit.RecordPipe(a, key, key)
+        receiver = transit.RecordPipe(b, key, key)
+        sender.send_nonce = 1
+        sender.send_record(b"skipped one")
+        self.failUnlessRaises(transit.BadNonce, receiver.receive_record)
+
+    def test_send_vectored(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        chunk = b"x"*100000
+        # more than the socket will take at once, so there are partial sends
+        t = threading.Thread(target=transit.send_vectored,
+                             args=(a, [b"head", chunk, b"", chunk, b"tail"]))
+        t.start()
+        rb = transit.ReceiveBuffer(b)
+        got = rb.read(4 + 2*len(chunk) + 4).tobytes()
+        t.join()
+        self.failUnlessEqual(got, b"head" + chunk + chunk + b"tail")
+
+    def test_max_record_size(self):
+        key = b"k"*32
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        sender = transit.RecordPipe(a, key, key)
+        receiver = transit.RecordPipe(b, key, key, max_record_size=100)
+        sender.send_record(b"x"*100)
+        self.failUnlessEqual(receiver.receive_record(), b"x"*100)
+        sender.send_record(b"x"*101)
+        self.failUnlessRaises(transit.TransitError, receiver.receive_record)
+
+class Striped(unittest.TestCase):
+    def make_pipes(self, count):
+        key = b"k"*32
+        pairs = [socket.socketpair() for i in range(count)]
+        for (a, b) in pairs:
+            self.addCleanup(a.close)
+            self.addCleanup(b.close)
+        sender = transit.StripedPipe([(a, b"") for (a, b) in pairs],
+                                     key, key)
+        receiver = transit.StripedPipe([(b, b"") for (a, b) in pairs],
+                                       key, key)
+        return sender, receiver
+
+    def send_all(self, sender, records):
+        # in a thread of its own, then waits for the receiver's "ok"
+        got = []
+        def _send():
+            for record in records:
+                sender.send_record(record)
+            got.append(sender.receive_record())
+        t = threading.Thread(target=_send)
+        t.start()
+        return t, got
+
+    def test_stripe(self):
+        sender, receiver = self.make_pipes(3)
+        records = [("%d" % i).encode("ascii") * 1000 for i in range(300)]
+        t, got = self.send_all(sender, records)
+        for record in records:
+            self.failUnlessEqual(receiver.receive_record(), record)
+        receiver.send_record(b"ok")
+        t.join()
+        self.failUnlessEqual(got, [b"ok"])
+        self.failUnlessEqual(sum(s.records for s in sender.streams), 300)
+        self.failUnless(len([s for s in sender.streams if s.records]) > 1)
+
+    def test_lose_stream(self):
+        # the sender can only get this far ahead of the acks
+        self.patch(transit, "MAX_UNACKED", 50*1000)
+        sender, receiver = self.make_pipes(3)
+        records = [("%d" % i).encode("ascii") * 1000 for i in range(300)]
+        t, got = self.send_all(sender, records)
+        for record in records[:100]:
+            self.failUnlessEqual(receiver.receive_record(), record)
+        # whatever was on its way along this one is sent again
+        receiver.streams[1].skt.shutdown(socket.SHUT_RDWR)
+        for record in records[100:]:
+            self.failUnlessEqual(receiver.receive_record(), record)
+        receiver.send_record(b"ok")
+        t.join()
+        self.failUnlessEqual(got, [b"ok"])
+        self.failUnlessEqual(sender.lost, 1)
+        self.failUnlessEqual(len(sender.streams), 2)
+
+    def test_hang_up(self):
+        # they hang up as soon as they've sent the "ok", before acking our
+        # last few records: we still get the "ok"
+        sender, receiver = self.make_pipes(3)
+        records = [("%d" % i).encode("ascii") * 1000 for i in range(300)]
+        t, got = self.send_all(sender, records)
+        for record in records:
+            self.failUnlessEqual(receiver.receive_record(), record)
+        receiver.send_record(b"ok")
+        receiver.close()
+        t.join()
+        self.failUnlessEqual(got, [b"ok"])
+
+class Sizer(unittest.TestCase):
+    def test_grow_and_shrink(self):
+        s = transit.RecordSizer(max_size=1000*1000, initial=64*1000)
+        # a fast link: grows, at most doubling each time, up to the max
+        s.sent(64*1000, 0.001)
+        self.failUnlessEqual(s.size, 128*1000)
+        for i in range(10):
+            s.sent(s.size, 0.001)
+        self.failUnlessEqual(s.size, 1000*1000)
+        # a slow link: once the smoothed rate catches up, shrinks, at most
+        # halving each time, down to the minimum
+        sizes = []
+        for i in range(50):
+            s.sent(s.size, 10.0)
+            sizes.append(s.size)
+        self.failUnless(all([b >= a//2 for (a, b) in zip(sizes, sizes[1:])]))
+        self.failUnlessEqual(s.size, transit.MIN_RECORD_SIZE)
+
+    def test_legacy(self):
+        # for older receivers: never past the chunk size they're used to
+        s = transit.RecordSizer(max_size=transit.LEGACY_RECORD_SIZE)
+        for i in range(10):
+            s.sent(s.size, 0.001)
+        self.failUnlessEqual(s.size, transit.LEGACY_RECORD_SIZE)
+        # a max below MIN_RECORD_SIZE still wins, even on a slow link
+        s = transit.RecordSizer(max_size=8000)
+        for i in range(10):
+            s.sent(s.size, 10.0)
+        self.failUnlessEqual(s.size, 8000)
+
+    def test_steady(self):
+        s = transit.RecordSizer(initial=64*1000)
+        # 1MB/s settles at about TARGET seconds per record
+        for i in range(50):
+            s.sent(s.size, s.size / 1e6)
+        self.failUnlessApproximates(s.size, 1e6 * s.TARGET, 1000)
+
+    def test_rtt(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        # not TCP, so there's no RTT to be had
+        self.failUnlessEqual(transit.tcp_rtt(a), None)
+
+class Direct(unittest.TestCase):
+    def connect_both(self, s, r, streams=1):
+        pipes = {}
+        def _connect(who, t):
+            try:
+                pipes[who] = t.connect(streams=streams)
+            except transit.TransitError as e:
+                pipes[who] = e
+        threads = [threading.Thread(target=_connect, args=(who, t))
+                   for (who, t) in [("s", s), ("r", r)]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return pipes["s"], pipes["r"]
+
+    def test_race(self):
+        key = b"k"*32
+        s = transit.TransitSender("tcp:127.0.0.1:1")
+        r = transit.TransitReceiver("tcp:127.0.0.1:1")
+        # every hint twice, one that is refused, and one we can't parse
+        s.add_their_direct_hints(r.get_direct_hints()*2
+                                 + ["tcp:127.0.0.1:1", "bogus"])
+        r.add_their_direct_hints(s.get_direct_hints()*2)
+        for t in [s, r]:
+            t.add_their_relay_hints([])
+            t.set_transit_key(key)
+        before = threading.active_count()
+        spipe, rpipe = self.connect_both(s, r)
+        self.addCleanup(spipe.close)
+        self.addCleanup(rpipe.close)
+        # the connecting happened in the two threads we gave it
+        self.failUnlessEqual(threading.active_count(), before)
+        spipe.send_record(b"record1")
+        self.failUnlessEqual(rpipe.receive_record(), b"record1")
+        rpipe.send_record(b"ack")
+        self.failUnlessEqual(spipe.receive_record(), b"ack")
+
+    def test_streams(self):
+        key = b"k"*32
+        s = transit.TransitSender("tcp:127.0.0.1:1")
+        r = transit.TransitReceiver("tcp:127.0.0.1:1")
+        s.add_their_direct_hints(r.get_direct_hints())
+        r.add_their_direct_hints(s.get_direct_hints())
+        for t in [s, r]:
+            t.add_their_relay_hints([])
+            t.set_transit_key(key)
+        spipe, rpipe = self.connect_both(s, r, streams=3)
+        self.addCleanup(spipe.close)
+        self.addCleanup(rpipe.close)
+        self.failUnlessEqual(len(spipe.streams), 3)
+        self.failUnlessEqual(len(rpipe.streams), 3)
+        self.failUnlessIn("3 streams", s.describe())
+        records = [("%d" % i).encode("ascii") * 1000 for i in range(50)]
+        for record in records:
+            spipe.send_record(record)
+        for record in records:
+            self.failUnlessEqual(rpipe.receive_record(), record)
+
+    def test_losers_closed(self):
+        # a listener that completes a handshake on every connection it
+        # gets, like several paths to the same receiver would
+        key = b"k"*32
+        s = transit.TransitSender("tcp:127.0.0.1:1")
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+        self.addCleanup(listener.close)
+        hint = "tcp:127.0.0.1:%d" % listener.getsockname()[1]
+        s.add_their_direct_hints([hint]*3)
+        s.add_their_relay_hints([])
+        s.set_transit_key(key)
+        # all at once, or the first would win before the others start
+        self.patch(transit, "STAGGER", 0)
+        accepted = []
+        def _serve():
+            for i in range(3):
+                skt, _ = listener.accept()
+                skt.sendall(transit_common.build_receiver_handshake(key))
+                accepted.append(skt)
+        t = threading.Thread(target=_serve)
+        t.start()
+        skt = s.establish_socket()
+        self.addCleanup(skt.close)
+        t.join()
+        got = []
+        for a in accepted:
+            a.settimeout(5)
+            data = b""
+            try:
+                while not data.endswith(b"go\n"):
+                    more = a.recv(1000)
+                    if not more:
+                        break
+                    data += more
+            except socket.error:
+                pass # a reset is a hang-up too
+            got.append(data.endswith(b"go\n"))
+            a.close()
+        # one won, and the other two were hung up on
+        self.failUnlessEqual(sorted(got), [False, False, True])
+
+    def test_fail(self):
+        s = transit.TransitSender("tcp:127.0.0.1:1")
+        s.add_their_direct_hints(["tcp:127.0.0.1:1"])
+        s.add_their_relay_hints(["tcp:127.0.0.1:1"])
+        s.set_transit_key(b"k"*32)
+        self.patch(transit, "TIMEOUT", 0.5)
+        self.failUnlessRaises(transit.TransitError, s.establish_socket)
+
+    def test_fail_fast(self):
+        # with every hint refused, we only wait for the other side to
+        # reach us for a little while, not for the whole timeout
+        s = transit.TransitSender("tcp:127.0.0.1:1")
+        s.add_their_direct_hints(["tcp:127.0.0.1:1"])
+        s.add_their_relay_hints(["tcp:127.0.0.1:1"])
+        s.set_transit_key(b"k"*32)
+        self.patch(transit, "INBOUND_GRACE", 0.2)
+        started = time.time()
+        self.failUnlessRaises(transit.TransitError, s.establish_socket)
+        self.failUnless(time.time() - started < transit.TIMEOUT)
+
+def silent_listener(test):
+    # completes the TCP handshake (the kernel does that), then says nothing,
+    # like a hint that will eventually time out
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    test.addCleanup(listener.close)
+    return "tcp:127.0.0.1:%d" % listener.getsockname()[1]
+
+class FakeOwner:
+    _transit_key = b"k"*32
+    def __init__(self, direct, relay):
+        self._their_direct_hints = direct
+        self._their_relay_hints = relay
+    def _send_this(self, stream=0):
+        return b"hello\n"
+    def _expect_this(self, stream=0):
+        return b"never\n"
+
+class Staggered(unittest.TestCase):
+    def test_rank(self):
+        mine = ["127.0.0.1", "192.168.1.20"]
+        hints = ["tcp:example.com:1", "tcp:8.8.8.8:1", "tcp:10.0.0.5:1",
+                 "tcp:192.168.1.7:1", "tcp:127.0.0.1:1", "tcp:172.20.0.1:1",
+                 "tcp:172.40.0.1:1", "bogus"]
+        ranks = [transit_common.rank_hint(hint, mine) for hint in hints]
+        self.failUnlessEqual(ranks, [2, 2, 1, 0, 1, 1, 2, 2])
+
+    def test_stagger(self):
+        hints = [silent_listener(self) for i in range(3)]
+        relay = silent_listener(self)
+        racer = transit.Racer(FakeOwner(hints, [relay]))
+        self.addCleanup(racer.close)
+        racer.start_outbound()
+        started = time.time()
+        self.failUnlessEqual(len(racer.attempts), 1)
+        racer.run(started + transit.STAGGER*1.5)
+        self.failUnlessEqual(len(racer.attempts), 2)
+        self.failIf(racer.relays_started)
+        racer.run(started + transit.RELAY_DELAY + 0.1)
+        # all three direct ones by now, and the relay without waiting for
+        # them to fail
+        self.failUnlessEqual(len(racer.attempts), 4)
+        self.failUnless(racer.relays_started)
+
+    def test_next_after_failure(self):
+        refused = "tcp:127.0.0.1:1"
+        racer = transit.Racer(FakeOwner([refused, silent_listener(self)],
+                                        []))
+        self.addCleanup(racer.close)
+        racer.start_outbound()
+        # the refused one goes right away, so the next one can't wait for
+        # the stagger
+        racer.run(time.time() + transit.STAGGER/2)
+        self.failUnlessEqual(len(racer.attempts), 1)
+
+class Resolving(unittest.TestCase):
+    def fake_getaddrinfo(self, names):
+        # 'names' maps the hostnames we pretend to resolve to the ports (on
+        # 127.0.0.1) they resolve to, or to an Event to wait for first
+        real_getaddrinfo = socket.getaddrinfo
+        def _getaddrinfo(host, port, *args):
+            if host not in names:
+                return real_getaddrinfo(host, port, *args)
+            if len(args) > 3 and args[3] & socket.AI_NUMERICHOST:
+                raise socket.gaierror(socket.EAI_NONAME, "not an address")
+            if isinstance(names[host], threading.Event):
+                names[host].wait()
+                return []
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                     ("127.0.0.1", p)) for p in names[host]]
+        self.patch(socket, "getaddrinfo", _getaddrinfo)
+
+    def test_every_address(self):
+        # the first address is refused, but the hint isn't lost
+        listener = silent_listener(self)
+        port = int(listener.split(":")[2])
+        self.fake_getaddrinfo({"relay.example": [1, port]})
+        racer = transit.Racer(FakeOwner([], ["tcp:relay.example:4001"]))
+        self.addCleanup(racer.close)
+        racer.start_outbound()
+        racer.run(time.time() + 0.5)
+        self.failUnlessEqual(len(racer.lookups), 0)
+        self.failUnlessEqual([a.address[4] for a in racer.attempts],
+                             [("127.0.0.1", port)])
+
+    def test_slow_lookup(self):
+        # a hostname that takes a while to resolve holds nothing else up
+        stuck = threading.Event()
+        self.addCleanup(stuck.set)
+        self.fake_getaddrinfo({"slow.example": stuck})
+        self.patch(transit, "RELAY_DELAY", 0)
+        racer = transit.Racer(FakeOwner([silent_listener(self)],
+                                        ["tcp:slow.example:4001"]))
+        self.addCleanup(racer.close)
+        racer.start_outbound()
+        started = time.time()
+        racer.run(started + 0.3)
+        self.failUnless(time.time() - started < 1.0)
+        self.failUnless(racer.relays_started)
+        self.failUnlessEqual(len(racer.lookups), 1)
+        self.failUnlessEqual(len(racer.attempts), 1)
+
+class Relayed(ServerBase, unittest.TestCase):
+    def make_pair(self):
+        key = b"k"*32
+        s = transit.TransitSender(self.transit)
+        r = transit.TransitReceiver(self.transit)
+        for (us, them) in [(s, r), (r, s)]:
+            us.set_transit_key(key)
+            # only the relay, so we can't accidentally connect directly
+            us.add_their_direct_hints([])
+            us.add_their_relay_hints(them.get_relay_hints())
+        return s, r
+
+    def test_relay_early(self):
+        # the sender's only direct hint never answers, but we don't wait for
+        # it to time out before trying the relay
+        s, r = self.make_pair()
+        s.add_their_direct_hints([silent_listener(self)])
+        started = time.time()
+        d = gatherResults([deferToThread(s.connect),
+                           deferToThread(r.connect)], True)
+        def _connected(pipes):
+            self.failUnless(time.time() - started < transit.TIMEOUT/2)
+            self.failUnlessIn("relay", s.describe())
+            for pipe in pipes:
+                pipe.close()
+        d.addCallback(_connected)
+        return d
+
+    def test_relay_hostname(self):
+        # the relay's hint usually has a hostname, resolved off the race
+        s, r = self.make_pair()
+        hint = self.transit.replace("127.0.0.1", "localhost")
+        for t in [s, r]:
+            t.add_their_relay_hints([hint])
+        d = gatherResults([deferToThread(s.connect),
+                           deferToThread(r.connect)], True)
+        def _connected(pipes):
+            self.failUnlessIn("relay:" + hint, s.describe())
+            for pipe in pipes:
+                pipe.close()
+        d.addCallback(_connected)
+        return d
+
+    def test_relay_streams(self):
+        # each stream has a relay token of its own, so they pair up right
+        s, r = self.make_pair()
+        d = gatherResults([deferToThread(s.connect, streams=2),
+                           deferToThread(r.connect, streams=2)], True)
+        def _connected(pipes):
+            (self.spipe, self.rpipe) = pipes
+            self.failUnlessIn("relay", s.describe())
+            self.failUnlessIn("2 streams", r.describe())
+            records = [("%d" % i).encode("ascii") * 1000 for i in range(20)]
+            def _send():
+                for record in records:
+                    self.spipe.send_record(record)
+            def _receive():
+                return [self.rpipe.receive_record() for record in records]
+            d = gatherResults([deferToThread(_send),
+                               deferToThread(_receive)], True)
+            d.addCallback(lambda res: self.failUnlessEqual(res[1], records))
+            return d
+        d.addCallback(_connected)
+        def _done(_):
+            self.spipe.close()
+            self.rpipe.close()
+        d.addCallback(_done)
+        return d
+
+    def test_relay(self):
+        self._relay_server.transit.max_length = 123456
+        s, r = self.make_pair()
+        d = gatherResults([deferToThread(s.connect),
+                           deferToThread(r.connect)], True)
+        def _connected(pipes):
+            (self.spipe, self.rpipe) = pipes
+            self.failUnlessEqual(s.relay_limits,
+                                 {"max-bytes": 123456, "max-seconds": 0,
+                                  "max-rate": 0})
+            self.failUnlessIn("relay", s.describe())
+            return deferToThread(self.spipe.send_record, b"record1")
+        d.addCallback(_connected)
+        d.addCallback(lambda _: deferToThread(self.rpipe.receive_record))
+        def _received(record):
+            self.failUnlessEqual(record, b"record1")
+            self.spipe.close()
+            self.rpipe.close()
+        d.addCallback(_received)
+        return d
+
+    def test_legacy_relay(self):
+        legacy_relay(self)
+        s, r = self.make_pair()
+        d = gatherResults([deferToThread(s.connect),
+                           deferToThread(r.connect)], True)
+        def _connected(pipes):
+            self.failUnlessIn("relay", s.describe())
+            self.failUnlessEqual(s.relay_limits, {})
+            for pipe in pipes:
+                pipe.close()
+        d.addCallback(_connected)
+        return d
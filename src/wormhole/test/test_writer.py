@@ -0,0 +1,57 @@
+import os, time
+from twisted.trial import unittest
+from ..blocking import writer
+
+class Writer(unittest.TestCase):
+    def test_write(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            w = writer.FileWriter(f, 30, sync_every=10)
+            for i in range(3):
+                w.write(("%d" % i).encode("ascii") * 10)
+            w.close()
+            self.failUnlessEqual(w.written, 30)
+            self.failUnlessEqual(w.syncs, 3)
+        with open(fn, "rb") as f:
+            self.failUnlessEqual(f.read(), b"0"*10 + b"1"*10 + b"2"*10)
+
+    def test_out_of_order(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            w = writer.FileWriter(f, 9)
+            w.write_at(6, b"ghi")
+            w.write_at(0, b"abc")
+            w.write_at(3, b"def")
+            w.close()
+            self.failUnlessEqual(w.syncs, 0)
+        with open(fn, "rb") as f:
+            self.failUnlessEqual(f.read(), b"abcdefghi")
+
+    def test_preallocate(self):
+        if not hasattr(os, "posix_fallocate"):
+            raise unittest.SkipTest("no posix_fallocate")
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            w = writer.FileWriter(f, 100*1000)
+            if not w.preallocated:
+                raise unittest.SkipTest("filesystem can't preallocate")
+            self.failUnlessEqual(os.fstat(f.fileno()).st_size, 100*1000)
+            w.close()
+
+    def test_abort(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            w = writer.FileWriter(f, 100*1000, offset=5)
+            w.write(b"abcde")
+            while w.written < 5:
+                time.sleep(0.01)
+            w.abort()
+            # nothing past what was written, even if it was preallocated
+            self.failUnlessEqual(os.fstat(f.fileno()).st_size, 10)
+
+    def test_error(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            w = writer.FileWriter(f, 10)
+            w.write_at(-1, b"nope")
+            self.failUnlessRaises((OSError, ValueError, IOError), w.close)
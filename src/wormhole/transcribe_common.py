@@ -0,0 +1,158 @@
+from __future__ import print_function
+import os, sys, time, re
+from binascii import hexlify, unhexlify
+from spake2 import SPAKE2_Symmetric
+from nacl.secret import SecretBox
+from nacl.exceptions import CryptoError
+from nacl import utils
+from . import __version__
+from .errors import ServerError, WrongPasswordError, UsageError
+from .util.hkdf import HKDF
+
+# The parts of the client that don't depend upon how it talks to the server:
+# what goes into the messages, and what we make of the ones we get.
+# blocking/transcribe.py and aio/transcribe.py both build on them, so the
+# two can't disagree about the protocol. Their subclasses do the I/O.
+
+SECOND = 1
+MINUTE = 60*SECOND
+
+class ChannelCommon:
+    def __init__(self, relay, channel_id, side, handle_welcome):
+        self._channel_url = "%s%d" % (relay, channel_id)
+        self._side = side
+        self._handle_welcome = handle_welcome
+        self._messages = set() # (phase,body) , body is bytes
+        self._sent_messages = set() # (phase,body)
+        self._started = time.time()
+        self._wait = 0.5*SECOND
+        self._timeout = 3*MINUTE
+
+    def _outbound_message(self, phase, msg):
+        # returns the payload to POST for 'msg', which get() must not return
+        if not isinstance(phase, type(u"")): raise UsageError(type(phase))
+        if not isinstance(msg, type(b"")): raise UsageError(type(msg))
+        self._sent_messages.add( (phase,msg) )
+        return {"side": self._side,
+                "phase": phase,
+                "body": hexlify(msg).decode("ascii")}
+
+    def _add_inbound_messages(self, messages):
+        for msg in messages:
+            phase = msg["phase"]
+            body = unhexlify(msg["body"].encode("ascii"))
+            self._messages.add( (phase, body) )
+
+    def _find_inbound_message(self, phase):
+        for (their_phase,body) in self._messages - self._sent_messages:
+            if their_phase == phase:
+                return body
+        return None
+
+class WormholeCommon:
+    motd_displayed = False
+    version_warning_displayed = False
+
+    def __init__(self, appid, relay):
+        if not isinstance(appid, type(b"")): raise UsageError
+        self.appid = appid
+        self.relay = relay
+        if not self.relay.endswith("/"): raise UsageError
+        self.side = hexlify(os.urandom(5)).decode("ascii")
+        self.code = None
+        self.key = None
+        self.verifier = None
+        self.channel = None
+        self._sent_data = False
+        self._got_data = False
+        self._closed = False
+
+    def handle_welcome(self, welcome):
+        if ("motd" in welcome and
+            not self.motd_displayed):
+            motd_lines = welcome["motd"].splitlines()
+            motd_formatted = "\n ".join(motd_lines)
+            print("Server (at %s) says:\n %s" % (self.relay, motd_formatted),
+                  file=sys.stderr)
+            self.motd_displayed = True
+
+        # Only warn if we're running a release version (e.g. 0.0.6, not
+        # 0.0.6-DISTANCE-gHASH). Only warn once.
+        if ("-" not in __version__ and
+            not self.version_warning_displayed and
+            welcome["current_version"] != __version__):
+            print("Warning: errors may occur unless both sides are running the same version", file=sys.stderr)
+            print("Server claims %s is current, but ours is %s"
+                  % (welcome["current_version"], __version__), file=sys.stderr)
+            self.version_warning_displayed = True
+
+        if "error" in welcome:
+            raise ServerError(welcome["error"], self.relay)
+
+    def set_code(self, code): # used for human-made pre-generated codes
+        if not isinstance(code, str): raise UsageError
+        if self.code is not None: raise UsageError
+        self._set_code_and_channel_id(code)
+        self._start()
+
+    def _set_code_and_channel_id(self, code):
+        if self.code is not None: raise UsageError
+        mo = re.search(r'^(\d+)-', code)
+        if not mo:
+            raise ValueError("code (%s) must start with NN-" % code)
+        self.code = code
+        channel_id = int(mo.group(1))
+        self.channel = self._channel_manager.connect(channel_id)
+
+    def _start(self):
+        # allocate the rest now too, so it can be serialized
+        self.sp = SPAKE2_Symmetric(self.code.encode("ascii"),
+                                   idSymmetric=self.appid)
+        self.msg1 = self.sp.start()
+
+    def _got_pake(self, pake_msg):
+        self.key = self.sp.finish(pake_msg)
+        self.verifier = self.derive_key(self.appid+b":Verifier")
+
+    def derive_key(self, purpose, length=SecretBox.KEY_SIZE):
+        if not isinstance(purpose, type(b"")): raise UsageError
+        return HKDF(self.key, length, CTXinfo=purpose)
+
+    def _check_ready(self):
+        if self.code is None: raise UsageError
+        if self.channel is None: raise UsageError
+
+    def _seal_data(self, outbound_data):
+        # Without predefined roles, we can't derive predictably unique keys
+        # for each side, so we use the same key for both. We use random
+        # nonces to keep the messages distinct, and the Channel automatically
+        # ignores reflections.
+        data_key = self.derive_key(b"data-key")
+        return self._encrypt_data(data_key, outbound_data)
+
+    def _open_data(self, inbound_encrypted):
+        data_key = self.derive_key(b"data-key")
+        try:
+            return self._decrypt_data(data_key, inbound_encrypted)
+        except CryptoError:
+            raise WrongPasswordError
+
+    def _encrypt_data(self, key, data):
+        assert isinstance(key, type(b"")), type(key)
+        assert isinstance(data, type(b"")), type(data)
+        if len(key) != SecretBox.KEY_SIZE: raise UsageError
+        box = SecretBox(key)
+        nonce = utils.random(SecretBox.NONCE_SIZE)
+        return box.encrypt(data, nonce)
+
+    def _decrypt_data(self, key, encrypted):
+        assert isinstance(key, type(b"")), type(key)
+        assert isinstance(encrypted, type(b"")), type(encrypted)
+        if len(key) != SecretBox.KEY_SIZE: raise UsageError
+        box = SecretBox(key)
+        data = box.decrypt(encrypted)
+        return data
+
+    def __del__(self):
+        if not self._closed:
+            print("Error: a Wormhole instance was not closed", file=sys.stderr)
@@ -0,0 +1,228 @@
+from __future__ import print_function
+import re, socket, struct
+from binascii import hexlify
+from nacl.secret import SecretBox
+from .util import ipaddrs
+from .util.hkdf import HKDF
+
+# The parts of transit that don't depend upon how the I/O is done: the
+# handshakes, the hints, and the keys. blocking/transit.py and aio/transit.py
+# both build on them, so the two can't disagree about what goes on the wire.
+
+# The beginning of each TCP connection consists of the following handshake
+# messages. The sender transmits the same text regardless of whether it is on
+# the initiating/connecting end of the TCP connection, or on the
+# listening/accepting side. Same for the receiver.
+#
+#  sender -> receiver: transit sender TXID_HEX ready\n\n
+#  receiver -> sender: transit receiver RXID_HEX ready\n\n
+#
+# Any deviations from this result in the socket being closed. The handshake
+# messages are designed to provoke an invalid response from other sorts of
+# servers (HTTP, SMTP, echo).
+#
+# If the sender is satisfied with the handshake, and this is the first socket
+# to complete negotiation, the sender does:
+#
+#  sender -> receiver: go\n
+#
+# and the next byte on the wire will be from the application.
+#
+# If this is not the first socket, the sender does:
+#
+#  sender -> receiver: nevermind\n
+#
+# and closes the socket.
+
+# So the receiver looks for "transit sender TXID_HEX ready\n\ngo\n" and hangs
+# up upon the first wrong byte. The sender lookgs for "transit receiver
+# RXID_HEX ready\n\n" and then makes a first/not-first decision about sending
+# "go\n" or "nevermind\n"+close().
+#
+# When both sides agreed to use several streams (see StripedPipe), the one
+# above is stream 0. Each other stream has a key of its own (stream_key()),
+# and so its own handshake messages and relay token, and is set up the same
+# way, but only along the path that stream 0 took.
+
+def build_receiver_handshake(key):
+    hexid = HKDF(key, 32, CTXinfo=b"transit_receiver")
+    return b"transit receiver "+hexlify(hexid)+b" ready\n\n"
+
+def build_sender_handshake(key):
+    hexid = HKDF(key, 32, CTXinfo=b"transit_sender")
+    return b"transit sender "+hexlify(hexid)+b" ready\n\n"
+
+def stream_key(key, stream):
+    if stream == 0:
+        return key
+    return HKDF(key, SecretBox.KEY_SIZE,
+                CTXinfo=("transit_stream_key_%d" % stream).encode("ascii"))
+
+def build_relay_handshake(key, with_limits=True):
+    token = HKDF(key, 32, CTXinfo=b"transit_relay_token")
+    if not with_limits:
+        return b"please relay "+hexlify(token)+b"\n"
+    # "with-limits" asks the relay to tell us its limits in the "ok" line.
+    # Relays from before it was added refuse the longer line, so if we get
+    # anything but "ok" (see LegacyRelay), we ask again the old way.
+    return b"please relay "+hexlify(token)+b" with-limits\n"
+
+def parse_relay_response(line):
+    # The relay says "ok\n", or "ok max-bytes=N max-seconds=N max-rate=N\n"
+    # (0 means unlimited). Returns a dict of the limits it told us about.
+    words = line.rstrip(b"\n").split(b" ")
+    if words[0] != b"ok":
+        raise BadHandshake("relay said '%r'" % (line,))
+    limits = {}
+    for word in words[1:]:
+        mo = re.search(br'^([\w-]+)=(\d+)$', word)
+        if mo:
+            limits[mo.group(1).decode("ascii")] = int(mo.group(2))
+    return limits
+
+class BadHandshake(Exception):
+    pass
+
+class LegacyRelay(BadHandshake):
+    # the relay refused our "with-limits" request line
+    pass
+
+# The hint format is: TYPE,VALUE= /^([a-zA-Z0-9]+):(.*)$/ . VALUE depends
+# upon TYPE, and it can have more colons in it. For TYPE=tcp (the only one
+# currently defined), ADDR,PORT = /^(.*):(\d+)$/ , so ADDR can have colons.
+# ADDR can be a hostname, ipv4 dotted-quad, or ipv6 colon-hex. If the hint
+# publisher wants anonymity, their only hint's ADDR will end in .onion .
+
+def parse_hint_tcp(hint):
+    assert isinstance(hint, str)
+    # return tuple or None for an unparseable hint
+    mo = re.search(r'^([a-zA-Z0-9]+):(.*)$', hint)
+    if not mo:
+        print("unparseable hint '%s'" % (hint,))
+        return None
+    hint_type = mo.group(1)
+    if hint_type != "tcp":
+        print("unknown hint type '%s' in '%s'" % (hint_type, hint))
+        return None
+    hint_value = mo.group(2)
+    mo = re.search(r'^(.*):(\d+)$', hint_value)
+    if not mo:
+        print("unparseable TCP hint '%s'" % (hint,))
+        return None
+    hint_host = mo.group(1)
+    try:
+        hint_port = int(mo.group(2))
+    except ValueError:
+        print("non-numeric port in TCP hint '%s'" % (hint,))
+        return None
+    return hint_host, hint_port
+
+# (first octet, lowest and highest second octet)
+_PRIVATE = [(10, 0, 255), (172, 16, 31), (192, 168, 168), (169, 254, 254),
+            (127, 0, 255), (100, 64, 127)] # the last is carrier-grade NAT
+
+def _ipv4(host):
+    if not re.search(r'^\d+\.\d+\.\d+\.\d+$', host):
+        return None
+    return tuple([int(octet) for octet in host.split(".")])
+
+def rank_hint(hint, my_addresses):
+    # 0: on one of our own subnets (we guess a /24), 1: some other private
+    # address, 2: anything else (public addresses, hostnames, IPv6)
+    mo = re.search(r'^tcp:(.*):\d+$', hint)
+    octets = _ipv4(mo.group(1)) if mo else None
+    if not octets:
+        return 2
+    for addr in my_addresses:
+        mine = _ipv4(addr)
+        if mine and mine[0] != 127 and mine[:3] == octets[:3]:
+            return 0
+    for (first, low, high) in _PRIVATE:
+        if octets[0] == first and low <= octets[1] <= high:
+            return 1
+    return 2
+
+def make_nonce(counter):
+    # 24 bytes, big-endian. We'd need 2**64 records to outgrow the low half.
+    assert counter < 2**64
+    return b"\x00"*16 + struct.pack(">Q", counter)
+
+class TransitCommon:
+    # what TransitSender and TransitReceiver have in common, in either
+    # client. Subclasses set is_sender.
+    def __init__(self, transit_relay):
+        self._transit_relay = transit_relay
+        self._transit_key = None
+        self._start_server()
+
+    def _start_server(self):
+        # nobody is accept()ed until the race begins: until then, the
+        # kernel holds on to early connections for us
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("", 0))
+        listener.listen(5)
+        _, port = listener.getsockname()
+        self.my_addresses = ipaddrs.find_addresses()
+        self.my_direct_hints = ["tcp:%s:%d" % (addr, port)
+                                for addr in self.my_addresses]
+        self.listener = listener
+
+    def get_direct_hints(self):
+        return self.my_direct_hints
+    def get_relay_hints(self):
+        return [self._transit_relay]
+
+    def add_their_direct_hints(self, hints):
+        self._their_direct_hints = [str(h) for h in hints]
+    def add_their_relay_hints(self, hints):
+        self._their_relay_hints = [str(h) for h in hints]
+
+    def set_transit_key(self, key):
+        # a sender that learns the key (and our hints) first may connect to
+        # us before we know it: the listener's backlog holds that connection
+        # until the race accepts it
+        self._transit_key = key
+
+    def _send_this(self, stream=0):
+        key = stream_key(self._transit_key, stream)
+        if self.is_sender:
+            return build_sender_handshake(key)
+        else:
+            return build_receiver_handshake(key)
+
+    def _expect_this(self, stream=0):
+        key = stream_key(self._transit_key, stream)
+        if self.is_sender:
+            return build_receiver_handshake(key)
+        else:
+            return build_sender_handshake(key) + b"go\n"
+
+    def _stream_choices(self, streams):
+        # what an inbound connection for each of 'streams' will send us
+        choices = {}
+        for stream in streams:
+            key = stream_key(self._transit_key, stream)
+            if self.is_sender:
+                choices[build_receiver_handshake(key)] = (
+                    stream, build_sender_handshake(key), b"")
+            else:
+                choices[build_sender_handshake(key)] = (
+                    stream, build_receiver_handshake(key), b"go\n")
+        return choices
+
+    def _sender_record_key(self):
+        if self.is_sender:
+            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
+                        CTXinfo=b"transit_record_sender_key")
+        else:
+            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
+                        CTXinfo=b"transit_record_receiver_key")
+
+    def _receiver_record_key(self):
+        if self.is_sender:
+            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
+                        CTXinfo=b"transit_record_receiver_key")
+        else:
+            return HKDF(self._transit_key, SecretBox.KEY_SIZE,
+                        CTXinfo=b"transit_record_sender_key")